@@ -0,0 +1,271 @@
+# ─── Analytics CLI ────────────────────────────────
+# Lecture hors ligne des fichiers écrits par le bot (voir « Analytics » dans bot.py) :
+#   python analytics.py summary
+#   python analytics.py funnel start fr_Cours fr_Remise code_issued
+#   python analytics.py paths --length 3 --to code_issued
+#   python analytics.py bench --events 10000000   # fichier synthétique : débits et durées
+# Tous les calculs sont vectorisés avec NumPy (pip install numpy), qui n'est pas une
+# dépendance du bot lui-même.
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit("analytics.py nécessite NumPy : pip install numpy")
+
+MAGIC = b"SEV1"
+HEADER = struct.Struct("<4sII")
+EVENT_SIZE = 8 + 8 + 4  # ts float64, user_hash uint64, id uint32
+
+
+# ─── Lecture ──────────────────────────────────────
+# Chaque bloc a son propre vocabulaire : les ids locaux sont ramenés à un vocabulaire
+# global commun à tous les fichiers (un fichier par worker en mode multi-processus).
+
+def read_events(paths):
+    ids = {}
+    ts_parts, user_parts, event_parts = [], [], []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            magic, count, vocabulary_size = HEADER.unpack_from(data, offset)
+            if magic != MAGIC:
+                sys.exit(f"{path} : bloc invalide à l'octet {offset}")
+            start = offset + HEADER.size + vocabulary_size
+            end = start + count * EVENT_SIZE
+            if end > len(data):
+                # Dernier bloc tronqué (arrêt brutal pendant l'écriture) : ignoré
+                print(f"{path} : bloc final incomplet ignoré", file=sys.stderr)
+                break
+            local_names = json.loads(data[offset + HEADER.size:start])
+            mapping = np.array([ids.setdefault(name, len(ids)) for name in local_names], dtype=np.uint32)
+            ts_parts.append(np.frombuffer(data, "<f8", count, start))
+            user_parts.append(np.frombuffer(data, "<u8", count, start + count * 8))
+            event_parts.append(mapping[np.frombuffer(data, "<u4", count, start + count * 16)])
+            offset = end
+    names = sorted(ids, key=ids.get)
+    if not ts_parts:
+        return names, np.empty(0, "f8"), np.empty(0, "u8"), np.empty(0, "u4")
+    return names, np.concatenate(ts_parts), np.concatenate(user_parts), np.concatenate(event_parts)
+
+
+# ─── Requêtes ─────────────────────────────────────
+
+def summary(names, ts, users, events):
+    counts = np.bincount(events, minlength=len(names))
+    # Utilisateurs distincts : premier élément de chaque couple (événement, utilisateur) trié
+    order = np.lexsort((users, events))
+    sorted_events, sorted_users = events[order], users[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (sorted_events[1:] != sorted_events[:-1]) | (sorted_users[1:] != sorted_users[:-1])
+    distinct = np.bincount(sorted_events[first], minlength=len(names))
+    return [(names[i], int(counts[i]), int(distinct[i])) for i in np.argsort(-counts, kind="stable")]
+
+
+def funnel(ts, users, events, steps):
+    # Étape k atteinte si l'utilisateur a fait l'événement k après avoir atteint l'étape k-1.
+    # Pour chaque étape on garde (utilisateurs triés, date de première atteinte) : la
+    # condition de l'étape suivante se vérifie par searchsorted sur ce tableau.
+    order = np.argsort(ts, kind="stable")
+    ts, users, events = ts[order], users[order], events[order]
+    reached_users = reached_at = None
+    counts = []
+    for step in steps:
+        idx = np.flatnonzero(events == step)
+        if reached_users is not None:
+            candidates = users[idx]
+            pos = np.searchsorted(reached_users, candidates)
+            ok = pos < len(reached_users)
+            ok[ok] = reached_users[pos[ok]] == candidates[ok]
+            ok[ok] = ts[idx[ok]] >= reached_at[pos[ok]]
+            idx = idx[ok]
+        # np.unique trie les utilisateurs ; return_index donne leur première occurrence,
+        # donc la date la plus ancienne puisque les événements sont triés par date
+        reached_users, first = np.unique(users[idx], return_index=True)
+        reached_at = ts[idx[first]]
+        counts.append(len(reached_users))
+    return counts
+
+
+def top_paths(users, ts, events, vocabulary_size, length, to=None, limit=20):
+    # Suites de `length` événements consécutifs d'un même utilisateur, encodées en un entier
+    # (base vocabulary_size) pour être comptées d'un seul np.unique
+    if vocabulary_size ** length >= 2 ** 63:
+        sys.exit("Chemins trop longs pour ce vocabulaire")
+    order = np.lexsort((ts, users))
+    users, events = users[order], events[order].astype(np.int64)
+    windows = len(events) - length + 1
+    if windows <= 0:
+        return []
+    # Triés par utilisateur : même utilisateur au début et à la fin => même utilisateur partout
+    valid = users[:windows] == users[length - 1:]
+    if to is not None:
+        valid &= events[length - 1:] == to
+    starts = np.flatnonzero(valid)
+    codes = np.zeros(len(starts), dtype=np.int64)
+    for k in range(length):
+        codes = codes * vocabulary_size + events[starts + k]
+    paths, counts = np.unique(codes, return_counts=True)
+    best = np.argsort(-counts, kind="stable")[:limit]
+    result = []
+    for code, count in zip(paths[best], counts[best]):
+        path = []
+        for _ in range(length):
+            code, event = divmod(int(code), vocabulary_size)
+            path.append(event)
+        result.append((path[::-1], int(count)))
+    return result
+
+
+# ─── Banc d'essai ─────────────────────────────────
+# Fichier synthétique au format du bot (blocs de BENCH_BLOCK événements, comme un anneau de
+# taille ANALYTICS_BUFFER_SIZE vidé à moitié) : --events événements de --users utilisateurs
+# sur 30 jours. Mesure l'écriture, la lecture et chaque requête, puis le débit d'ingestion
+# d'AnalyticsRecorder (bot.py, importé seulement ici) : record() seul, puis jusqu'au disque.
+
+BENCH_BLOCK = 32768
+BENCH_FUNNEL = ["start", "fr_Cours", "fr_Remise", "code_issued"]
+BENCH_EVENTS = BENCH_FUNNEL + [f"page_{i}" for i in range(36)]
+# Poids relatifs : l'entonnoir se rétrécit, le reste des pages se partage le trafic
+BENCH_WEIGHTS = np.array([20.0, 10.0, 4.0, 1.0] + [65.0 / 36] * 36)
+
+
+def write_synthetic(path, count, user_count, seed=0):
+    rng = np.random.default_rng(seed)
+    user_hashes = rng.integers(0, 2 ** 63, user_count, dtype=np.uint64)
+    vocabulary = json.dumps(BENCH_EVENTS).encode()
+    start = time.time() - 30 * 86400
+    with open(path, "wb") as f:
+        for offset in range(0, count, BENCH_BLOCK):
+            n = min(BENCH_BLOCK, count - offset)
+            ts = start + (offset + np.arange(n)) * (30 * 86400 / count)
+            users = user_hashes[rng.integers(0, user_count, n)]
+            events = rng.choice(len(BENCH_EVENTS), n, p=BENCH_WEIGHTS / BENCH_WEIGHTS.sum()).astype("<u4")
+            f.write(HEADER.pack(MAGIC, n, len(vocabulary)) + vocabulary)
+            f.write(ts.astype("<f8").tobytes() + users.astype("<u8").tobytes() + events.tobytes())
+
+
+def timed(results, name, function, *args):
+    started = time.perf_counter()
+    value = function(*args)
+    results[name] = time.perf_counter() - started
+    return value
+
+
+async def ingest_rates(directory, count):
+    # Import tardif : bot lit sa configuration et ouvre ses fichiers à l'import
+    os.chdir(directory)
+    os.environ.setdefault("TELEGRAM_TOKEN", "1:bench")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    user_ids = [str(1_000_000 + i % 10_000) for i in range(count)]
+    names = [BENCH_EVENTS[i % len(BENCH_EVENTS)] for i in range(count)]
+
+    # record() seul : hachage de l'utilisateur et écriture dans l'anneau (plein, sans vidage)
+    recorder = bot.AnalyticsRecorder(os.path.join(directory, "record.bin"))
+    started = time.perf_counter()
+    for user_id, name in zip(user_ids, names):
+        recorder.record(user_id, name)
+    record_rate = count / (time.perf_counter() - started)
+
+    # Jusqu'au disque : vidages à mi-anneau dans le thread disque, la boucle rend la main
+    # toutes les 1000 entrées comme entre deux mises à jour
+    recorder = bot.AnalyticsRecorder(os.path.join(directory, "ingest.bin"), flush_interval=3600)
+    recorder.start()
+    started = time.perf_counter()
+    for i, (user_id, name) in enumerate(zip(user_ids, names), 1):
+        recorder.record(user_id, name)
+        if i % 1000 == 0:
+            await asyncio.sleep(0)
+    await recorder.stop()
+    ingest_rate = count / (time.perf_counter() - started)
+    lost = recorder.ring.dropped + recorder.lost
+    return record_rate, ingest_rate, lost
+
+
+def run_bench(count, user_count, ingest):
+    directory = tempfile.mkdtemp(prefix="seshat-analytics-")
+    path = os.path.join(directory, "analytics.bin")
+    durations = {}
+    timed(durations, "write", write_synthetic, path, count, user_count)
+    names, ts, users, events = timed(durations, "read", read_events, [path])
+    timed(durations, "summary", summary, names, ts, users, events)
+    counts = timed(durations, "funnel", funnel, ts, users, events, [names.index(step) for step in BENCH_FUNNEL])
+    timed(durations, "paths", top_paths, users, ts, events, len(names), 3)
+    print(f"{count} événements, {user_count} utilisateurs, {os.path.getsize(path) / 1e6:.0f} Mo ({path})")
+    for name, seconds in durations.items():
+        print(f"{name:<30} {seconds:>8.2f} s {count / seconds / 1e6:>8.1f} M événements/s")
+    print("entonnoir " + " → ".join(f"{step} {reached}" for step, reached in zip(BENCH_FUNNEL, counts)))
+    record_rate, ingest_rate, lost = asyncio.run(ingest_rates(directory, ingest))
+    print(f"{'record()':<30} {record_rate / 1e3:>8.0f} k événements/s")
+    print(f"{'record() + écriture':<30} {ingest_rate / 1e3:>8.0f} k événements/s ({lost} perdus)")
+
+
+# ─── Ligne de commande ────────────────────────────
+
+def event_id(names, name):
+    try:
+        return names.index(name)
+    except ValueError:
+        sys.exit(f"Événement inconnu : {name} (voir « summary »)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Entonnoirs et parcours dans les menus du bot")
+    parser.add_argument("-f", "--file", action="append", help="Fichier(s) d'événements (défaut : analytics*.bin)")
+    parser.add_argument("--days", type=float, help="Seulement les N derniers jours")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("summary", help="Événements et utilisateurs distincts par événement")
+    funnel_parser = commands.add_parser("funnel", help="Utilisateurs atteignant chaque étape, dans l'ordre")
+    funnel_parser.add_argument("steps", nargs="+")
+    paths_parser = commands.add_parser("paths", help="Suites d'événements les plus fréquentes")
+    paths_parser.add_argument("--length", type=int, default=3)
+    paths_parser.add_argument("--to", help="Seulement les suites qui finissent par cet événement")
+    paths_parser.add_argument("--top", type=int, default=20)
+    bench_parser = commands.add_parser("bench", help="Durées des requêtes et débit d'ingestion sur des données synthétiques")
+    bench_parser.add_argument("--events", type=int, default=10_000_000)
+    bench_parser.add_argument("--users", type=int, default=200_000)
+    bench_parser.add_argument("--ingest", type=int, default=1_000_000, help="Événements passés à AnalyticsRecorder")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        return run_bench(args.events, args.users, args.ingest)
+
+    paths = args.file or sorted(glob.glob("analytics*.bin"))
+    if not paths:
+        sys.exit("Aucun fichier d'événements")
+    names, ts, users, events = read_events(paths)
+    if args.days is not None:
+        keep = ts >= time.time() - args.days * 86400
+        ts, users, events = ts[keep], users[keep], events[keep]
+    print(f"{len(ts)} événements, {len(np.unique(users))} utilisateurs", file=sys.stderr)
+
+    if args.command == "summary":
+        for name, count, distinct in summary(names, ts, users, events):
+            print(f"{name:<30} {count:>10} {distinct:>10}")
+    elif args.command == "funnel":
+        counts = funnel(ts, users, events, [event_id(names, step) for step in args.steps])
+        for i, (step, count) in enumerate(zip(args.steps, counts)):
+            previous = counts[i - 1] if i else count
+            rate = f"{100 * count / previous:6.1f} %" if previous else "     - "
+            print(f"{step:<30} {count:>10} {rate}")
+    else:
+        to = event_id(names, args.to) if args.to else None
+        for path, count in top_paths(users, ts, events, max(len(names), 1), args.length, to, args.top):
+            print(f"{count:>10}  " + " → ".join(names[event] for event in path))
+
+
+if __name__ == "__main__":
+    main()
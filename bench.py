@@ -0,0 +1,2053 @@
+# ─── Benchmark ────────────────────────────────────
+# Banc d'essai hors ligne : l'Application réelle (build_application, setup_handlers, stores,
+# anti-flood…) est construite avec une fausse couche HTTP qui répond à l'API Telegram sans
+# réseau. Chaque commande et chaque callback_data enregistrés aujourd'hui deviennent un
+# scénario : des Update synthétiques sont envoyés avec N traitements en parallèle, et on
+# mesure ops/s, latences p50/p99, appels API par opération et mémoire.
+#   python bench.py                               # résumé lisible
+#   python bench.py --output bench.json           # résultats JSON, à comparer d'un commit à l'autre
+#   python bench.py --compare avant.json --output apres.json
+#   python bench.py --log                         # logs du bot actifs, écrits dans bot.log
+# Les autres mesures sont regroupées en suites (--suite, répétable ; --suite all pour tout) :
+#   python bench.py --suite redemption            # latence d'une remise, de 1k à 1M codes stockés
+#   python bench.py --suite ingress --replay updates.jsonl   # webhook contre polling, mises à jour enregistrées
+#   python bench.py --suite startup               # démarrage à froid de bot.py avec 500k remises
+# Les fichiers du bot (remises.json, journaux…) sont écrits dans un dossier temporaire.
+
+import argparse
+import asyncio
+import atexit
+import contextlib
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+try:
+    import resource  # Absent sous Windows
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# ─── Fausse API Telegram ──────────────────────────
+
+def fake_api_result(endpoint, params):
+    if endpoint == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "Seshat", "username": "seshat_bench_bot"}
+    if endpoint in ("sendMessage", "editMessageText"):
+        chat_id = int(params.get("chat_id") or 1)
+        return {
+            "message_id": int(params.get("message_id") or 1),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+    return True
+
+
+def make_request_class(base):
+    class FakeRequest(base):
+        # latency : délai simulé d'un aller-retour vers Telegram, en secondes
+        def __init__(self, latency=0.0):
+            super().__init__()
+            self.latency = latency
+            self.calls = 0
+            self.bytes_sent = 0  # Corps JSON des requêtes envoyées à l'API
+            self.answered = {}  # chat_id -> instant (perf_counter) du dernier appel pour ce chat
+            self.updates = deque()  # servies par getUpdates, pour le mode polling
+            self._arrived = asyncio.Event()
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def push_update(self, data):
+            self.updates.append(data)
+            self._arrived.set()
+
+        async def _get_updates(self, params):
+            # Long polling : rend la main dès qu'une mise à jour arrive, ou après timeout
+            if not self.updates:
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), float(params.get("timeout") or 0))
+                except asyncio.TimeoutError:
+                    pass
+            return [self.updates.popleft() for _ in range(min(len(self.updates), 100))]
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            self.calls += 1
+            if request_data is not None:
+                self.bytes_sent += len(request_data.json_payload)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            params = request_data.json_parameters if request_data else {}
+            endpoint = url.rsplit("/", 1)[-1]
+            if endpoint == "getUpdates":
+                result = await self._get_updates(params)
+            else:
+                result = fake_api_result(endpoint, params)
+            if "chat_id" in params:
+                self.answered[int(params["chat_id"])] = time.perf_counter()
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeRequest
+
+
+# ─── Updates synthétiques ─────────────────────────
+
+LOCALES = ("fr", "en", "ht")
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "language_code": LOCALES[user_id % len(LOCALES)]}
+
+
+def message_update(update_id, user_id, text):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Seshat"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def scenarios(bot, app):
+    # nom -> (fabrique d'Update(update_id, user_id), préparation éventuelle par utilisateur)
+    found = {}
+    for group in app.handlers.values():
+        for handler in group:
+            for command in sorted(getattr(handler, "commands", ())):
+                found[f"command:{command}"] = (lambda i, u, c=command: message_update(i, u, f"/{c}"), None)
+    found["command:start+deeplink"] = (
+        lambda i, u, payload=bot.sign_deep_link("fr_Seminaires", "bench"): message_update(i, u, f"/start {payload}"),
+        None,
+    )
+    for data in sorted(set(bot.CALLBACK_ROUTES) | set(bot.catalog.pages)):
+        found[f"callback:{data}"] = (lambda i, u, d=data: callback_update(i, u, d), None)
+    found["message:question"] = (lambda i, u: message_update(i, u, "comment payer ?"), None)
+    found["message:email"] = (
+        lambda i, u: message_update(i, u, f"bench{u}@example.com"),
+        lambda u: bot.user_states.set(str(u), "awaiting_email"),
+    )
+    return found
+
+
+def retarget(data, update_id, user_id):
+    # Copie d'une mise à jour enregistrée, rattachée à un nouvel update_id et un utilisateur neuf
+    def walk(value):
+        if isinstance(value, list):
+            return [walk(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        value = {key: walk(item) for key, item in value.items()}
+        for key in ("from", "chat"):
+            if isinstance(value.get(key), dict) and not value[key].get("is_bot"):
+                value[key] = {**value[key], "id": user_id}
+        return value
+    data = walk(data)
+    data["update_id"] = update_id
+    return data
+
+
+# ─── Mesure ───────────────────────────────────────
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def handler_errors(bot):
+    return sum(value for (name, _), value in bot.metrics.counters.items() if name == "bot_handler_errors_total")
+
+
+async def admitted(bot, app, update):
+    # Comme en production : admission anti-flood (comptée dans pending) puis traitement
+    if bot.flood_guard.admit_update(update):
+        await app.process_update(update)
+
+
+@contextlib.contextmanager
+def unthrottled(guard):
+    # Seaux et plafond géants pour les suites qui mesurent autre chose que l'anti-flood :
+    # rien n'est refusé, mais pending reste compté
+    limits = (guard.rate, guard.burst, guard.max_pending)
+    guard.rate = guard.burst = guard.max_pending = 10 ** 9
+    try:
+        yield
+    finally:
+        guard.rate, guard.burst, guard.max_pending = limits
+
+
+async def settle(bot, timeout=5):
+    # Fin d'une suite : les mises à jour admises doivent toutes avoir été traitées
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and bot.flood_guard.pending:
+        await asyncio.sleep(0.01)
+    assert bot.flood_guard.pending == 0, f"flood_guard.pending = {bot.flood_guard.pending}"
+
+
+async def run_scenario(bot, app, request, make_update, prepare, ops, concurrency, first_id, trace_memory):
+    from telegram import Update
+
+    # Un utilisateur neuf par opération : ni l'anti-flood ni l'anti-double-tap ne jettent
+    # les envois du banc, mais leurs coûts sont bien mesurés
+    users = range(first_id, first_id + ops)
+    if prepare is not None:
+        for user_id in users:
+            prepare(user_id)
+    updates = [Update.de_json(make_update(first_id + i, user_id), app.bot) for i, user_id in enumerate(users)]
+
+    latencies = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(update):
+        async with limit:
+            started = time.perf_counter()
+            # Même chemin qu'en production : admission anti-flood puis traitement
+            if bot.flood_guard.admit_update(update):
+                await app.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    calls_before, errors_before = request.calls, handler_errors(bot)
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(update) for update in updates))
+    elapsed = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    result = {
+        "ops": ops,
+        "ops_per_s": round(ops / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "api_calls_per_op": round((request.calls - calls_before) / ops, 2),
+        "errors": handler_errors(bot) - errors_before,
+    }
+    if peak is not None:
+        result["python_peak_kb"] = peak // 1024
+    return result
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # octets sous macOS, Ko ailleurs
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "ops": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+
+def report(name, result):
+    figures = "  ".join(f"{key} {value}" for key, value in result.items() if key != "ops")
+    print(f"{name:<40} {figures}", file=sys.stderr)
+
+
+class Bench:
+    # Ce que les suites partagent : le module bot, l'Application construite sur la fausse API
+    # et les options de la ligne de commande. Les ids d'utilisateur sont distribués ici pour
+    # qu'aucune suite ne retombe sur un utilisateur déjà vu (anti-flood, anti-doublon).
+    def __init__(self, bot, app, request, args):
+        self.bot = bot
+        self.app = app
+        self.request = request
+        self.args = args
+        self.workdir = os.getcwd()
+        self._next_id = 1_000_000
+
+    def ids(self, count):
+        first = self._next_id
+        self._next_id += count
+        return first
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+
+SUITES = {}
+
+
+def suite(name, description):
+    def register(function):
+        SUITES[name] = (function, description)
+        return function
+    return register
+
+
+@suite("handlers", "Chaque commande, callback_data et message à travers l'Application (défaut)")
+async def handlers_suite(bench):
+    found = scenarios(bench.bot, bench.app)
+    args = bench.args
+    results = {}
+    for name in found:
+        if args.only and not any(pattern in name for pattern in args.only):
+            continue
+        make_update, prepare = found[name]
+        if args.warmup:
+            await run_scenario(bench.bot, bench.app, bench.request, make_update, prepare, args.warmup, args.concurrency,
+                               bench.ids(args.warmup), False)
+        results[name] = await run_scenario(
+            bench.bot, bench.app, bench.request, make_update, prepare, args.ops, args.concurrency, bench.ids(args.ops),
+            args.trace_memory,
+        )
+        print(f"{name:<40} {results[name]['ops_per_s']:>10.0f} ops/s  p50 {results[name]['p50_ms']:>8.3f} ms  "
+              f"p99 {results[name]['p99_ms']:>8.3f} ms", file=sys.stderr)
+    return results
+
+
+# ─── Remises : latence selon le volume stocké ─────
+# Une remise = store.set() + await store.flush(), comme save_remise. Les stores sont préremplis
+# de N codes ; la latence doit rester plate de 1k à 1M (plus de réécriture complète du fichier).
+# Les compactions qui tombent pendant la mesure y sont comptées ; snapshot_ms est en plus la
+# latence d'une remise qui déclenche un snapshot (copie du dict sur la boucle), forcé en fin de
+# mesure pour le mode journal.
+
+BASE36 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def fake_code(i):
+    # Code au format du bot, distinct pour chaque i < 36^4 (1,68 M)
+    suffix = ""
+    for _ in range(4):
+        i, digit = divmod(i, 36)
+        suffix = BASE36[digit] + suffix
+    return f"ASU-{suffix}"
+
+
+def fake_entry(i, expires_at=1893456000):
+    return {"code": fake_code(i), "expiration": "01 January 2030", "expires_at": expires_at}
+
+
+def filled_store(bot, backend, size, path, make_entry=fake_entry):
+    if backend == "journal":
+        with open(path, "w") as f:
+            json.dump({str(i): make_entry(i) for i in range(size)}, f, separators=(",", ":"))
+        return bot.JournalStore(path)
+    store = bot.SqliteStore(path, "remises")
+    with store._connection() as db:
+        db.executemany(
+            'INSERT OR REPLACE INTO "remises" (k, v) VALUES (?, ?)',
+            ((str(i), json.dumps(make_entry(i), separators=(",", ":"))) for i in range(size)),
+        )
+    return store
+
+
+@suite("redemption", "Latence d'une remise enregistrée, de 1k à --max-codes codes déjà stockés")
+async def redemption_suite(bench):
+    results = {}
+    size = 1000
+    while size <= bench.args.max_codes:
+        for backend in ("journal", "sqlite"):
+            path = bench.path(f"redemption-{size}.{'json' if backend == 'journal' else 'sqlite3'}")
+            started = time.perf_counter()
+            store = filled_store(bench.bot, backend, size, path)
+            load_s = time.perf_counter() - started
+            latencies = []
+            # Clés tirées parmi les existantes (nouveau code pour un client connu) et au-delà
+            keys = [str(random.randrange(size * 2)) for _ in range(bench.args.redemptions)]
+            for i, key in enumerate(keys):
+                started = time.perf_counter()
+                store.set(key, fake_entry(size + i))
+                await store.flush()
+                latencies.append(time.perf_counter() - started)
+            name = f"redemption:{backend}:{size}"
+            results[name] = latency_summary(latencies)
+            results[name]["load_s"] = round(load_s, 3)
+            if backend == "journal":
+                while store._compacting:
+                    await asyncio.sleep(0.01)
+                store.request_compaction()
+                started = time.perf_counter()
+                store.set(key, fake_entry(size))
+                await store.flush()
+                results[name]["snapshot_ms"] = round((time.perf_counter() - started) * 1000, 3)
+                while store._compacting:
+                    await asyncio.sleep(0.01)
+            report(name, results[name])
+            del store
+            for leftover in (path, path + ".journal", path + "-wal", path + "-shm"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        size *= 10
+    return results
+
+
+# ─── Entrée : webhook contre polling ──────────────
+# Le même flux de mises à jour entre par les deux chemins de production, au rythme --rate :
+# - webhook : POST HTTP vers make_web_app (TelegramWebhookHandler -> enqueue_updates) ;
+# - polling : l'Updater de PTB lit la fausse API getUpdates.
+# Les deux finissent dans ThrottledQueue puis l'Application. Latence = de l'envoi au dernier
+# appel de l'API Telegram pour ce chat (réponse envoyée). Mises à jour : --replay (une Update
+# JSON par ligne, telle que reçue par le webhook ; ids réécrits vers des utilisateurs neufs),
+# sinon un mélange synthétique /start, boutons et question, écrit dans updates.jsonl.
+
+INGRESS_MIX = ("command:start", "callback:fr_FAQ", "callback:fr_Livres", "callback:fr_Remise", "message:question")
+
+
+def ingress_updates(bench):
+    if bench.args.replay:
+        with open(bench.args.replay) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    found = scenarios(bench.bot, bench.app)
+    first = bench.ids(bench.args.ops)
+    recorded = [found[INGRESS_MIX[i % len(INGRESS_MIX)]][0](first + i, first + i) for i in range(bench.args.ops)]
+    with open(bench.path("updates.jsonl"), "w") as f:
+        f.writelines(json.dumps(data) + "\n" for data in recorded)
+    return recorded
+
+
+async def drive_ingress(bench, recorded, send):
+    if not recorded:
+        return {}
+    request = bench.request
+    first = bench.ids(len(recorded))
+    updates = [retarget(data, first + i, first + i) for i, data in enumerate(recorded)]
+    sent = {}
+    calls_before = request.calls
+    started = time.perf_counter()
+
+    async def one(i, data):
+        await asyncio.sleep(max(0.0, started + i / bench.args.rate - time.perf_counter()))
+        sent[first + i] = time.perf_counter()
+        await send(data)
+
+    await asyncio.gather(*(one(i, data) for i, data in enumerate(updates)))
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline and any(request.answered.get(chat, 0) < at for chat, at in sent.items()):
+        await asyncio.sleep(0.005)
+    done = {chat: request.answered[chat] for chat, at in sent.items() if request.answered.get(chat, 0) >= at}
+    result = latency_summary([done[chat] - sent[chat] for chat in done])
+    result["ops_per_s"] = round(len(done) / (max(done.values(), default=started) - started or 1), 1)
+    result["api_calls_per_op"] = round((request.calls - calls_before) / len(updates), 2)
+    result["unanswered"] = len(updates) - len(done)
+    return result
+
+
+@suite("ingress", "Latence p50/p99 de bout en bout, webhook (HTTP) contre polling (getUpdates), à --rate mises à jour/s")
+async def ingress_suite(bench):
+    import httpx
+    import tornado.httpserver
+    import tornado.netutil
+
+    bot, app, request = bench.bot, bench.app, bench.request
+    recorded = ingress_updates(bench)
+    results = {}
+    await app.start()
+    try:
+        webhook_path, secret_token = bot.webhook_settings(app.bot.token)
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        server = tornado.httpserver.HTTPServer(bot.make_web_app(bot.enqueue_updates(app), webhook_path, secret_token))
+        server.add_sockets(sockets)
+        url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/{webhook_path}"
+        acks = []
+        limits = httpx.Limits(max_connections=64)
+        async with httpx.AsyncClient(limits=limits, headers={"X-Telegram-Bot-Api-Secret-Token": secret_token}) as client:
+            async def post(data):
+                started = time.perf_counter()
+                response = await client.post(url, json=data)
+                response.raise_for_status()
+                acks.append(time.perf_counter() - started)
+
+            await drive_ingress(bench, recorded[:bench.args.warmup], post)
+            acks.clear()
+            results["ingress:webhook"] = await drive_ingress(bench, recorded, post)
+            results["ingress:webhook"]["ack_p99_ms"] = latency_summary(acks)["p99_ms"]
+        server.stop()
+        report("ingress:webhook", results["ingress:webhook"])
+
+        async def push(data):
+            request.push_update(data)
+
+        await app.updater.start_polling(timeout=1)
+        try:
+            await drive_ingress(bench, recorded[:bench.args.warmup], push)
+            results["ingress:polling"] = await drive_ingress(bench, recorded, push)
+        finally:
+            await app.updater.stop()
+        report("ingress:polling", results["ingress:polling"])
+    finally:
+        await app.stop()
+    return results
+
+
+# ─── Menu principal : clavier pré-encodé ──────────
+# Coût d'un appel au handler /start (menu principal), appelé directement sans passer par
+# l'Application : temps par appel et pic d'allocation Python par appel (tracemalloc). En face,
+# l'envoi seul avec le clavier pré-encodé du catalogue, puis l'ancien comportement : clavier
+# InlineKeyboardMarkup reconstruit à chaque appel et sérialisé par PTB.
+
+async def time_calls(calls):
+    # calls : fabriques de coroutines, une par appel ; temps moyen puis pic d'allocation moyen
+    started = time.perf_counter()
+    for call in calls:
+        await call()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    peaks = 0
+    for call in calls:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        await call()
+        peaks += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return {
+        "ops": len(calls),
+        "us_per_call": round(elapsed / len(calls) * 1e6, 2),
+        "alloc_peak_bytes": peaks // len(calls),
+    }
+
+
+@suite("start_menu", "Temps et allocations par appel du menu principal : clavier pré-encodé contre reconstruit")
+async def start_menu_suite(bench):
+    from telegram import InlineKeyboardMarkup, Update
+    from telegram.constants import ParseMode
+    from telegram.ext import CallbackContext
+
+    bot, app = bench.bot, bench.app
+    with open(bot.PAGES_FILE, encoding="utf-8") as f:
+        spec = json.load(f)["pages"]["start_menu"]
+    count = bench.args.micro_ops
+    first = bench.ids(count)
+    updates = [Update.de_json(message_update(first + i, first + i, "/start"), app.bot) for i in range(count)]
+    contexts = []
+    for update in updates:
+        context = CallbackContext.from_update(update, app)
+        context.args = []
+        contexts.append(context)
+    welcome = bot.catalog.message(bot.DEFAULT_LOCALE, "welcome")
+    page = bot.catalog.get("start_menu")
+
+    async def cached(update):
+        await update.message.reply_text(welcome, reply_markup=page.reply_markup, parse_mode=ParseMode.HTML)
+
+    async def rebuilt(update):
+        markup = InlineKeyboardMarkup([[bot.render_button("start_menu", button) for button in row] for row in spec["buttons"]])
+        await update.message.reply_text(welcome, reply_markup=markup, parse_mode=ParseMode.HTML)
+
+    results = {
+        "start_menu:handler": await time_calls([lambda u=u, c=c: bot.start(u, c) for u, c in zip(updates, contexts)]),
+        "start_menu:send_cached": await time_calls([lambda u=u: cached(u) for u in updates]),
+        "start_menu:send_rebuilt": await time_calls([lambda u=u: rebuilt(u) for u in updates]),
+    }
+    for name, result in results.items():
+        report(name, result)
+    return results
+
+
+# ─── Routage des callbacks : coût selon le nombre de pages ─
+# Catalogue synthétique de N pages (10 à 1000). Par tap : le CallbackQueryHandler unique et la
+# recherche dans un dict comme route_callback, contre l'ancienne chaîne d'un
+# CallbackQueryHandler à regex ancrée par page, essayés dans l'ordre jusqu'au bon.
+# mean : taps répartis sur toutes les pages ; last : bouton de la dernière page enregistrée.
+
+def dispatch_cost(handlers_for, updates, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for update in updates:
+            for handler in handlers_for(update):
+                if handler.check_update(update):
+                    break
+    return round((time.perf_counter() - started) / (repeat * len(updates)) * 1e6, 3)
+
+
+@suite("dispatch", "Coût de routage d'un callback de 10 à 1000 pages : dict contre une regex par page")
+async def dispatch_suite(bench):
+    from telegram import Update
+    from telegram.ext import CallbackQueryHandler
+
+    bot, app = bench.bot, bench.app
+    results = {}
+    for pages in (10, 100, 1000):
+        page_ids = [f"fr_page{i}" for i in range(pages)]
+        first = bench.ids(pages)
+        updates = [Update.de_json(callback_update(first + i, first + i, page_id), app.bot) for i, page_id in enumerate(page_ids)]
+        routes = dict.fromkeys(page_ids, bot.handle_page)
+        router = CallbackQueryHandler(bot.route_callback)
+        regexes = [CallbackQueryHandler(bot.handle_page, pattern=f"^{page_id}$") for page_id in page_ids]
+
+        def routed(update):
+            data = update.callback_query.data
+            routes.get(data) or bot.CALLBACK_NAMESPACES.get(bot.callback_namespace(data))
+            return (router,)
+
+        repeat = max(1, 20000 // pages)
+        last = updates[-1:]
+        results[f"dispatch:dict:{pages}"] = {
+            "mean_us": dispatch_cost(routed, updates, repeat),
+            "last_us": dispatch_cost(routed, last, repeat * pages),
+        }
+        # La chaîne de regex est O(N) par tap : moins de répétitions pour garder un temps raisonnable
+        repeat = max(1, 200 // pages)
+        results[f"dispatch:regex:{pages}"] = {
+            "mean_us": dispatch_cost(lambda update: regexes, updates, repeat),
+            "last_us": dispatch_cost(lambda update: regexes, last, repeat * pages),
+        }
+        report(f"dispatch:dict:{pages}", results[f"dispatch:dict:{pages}"])
+        report(f"dispatch:regex:{pages}", results[f"dispatch:regex:{pages}"])
+    return results
+
+
+# ─── Émission des codes : débit et collisions ─────
+# Un CodePool vide émet --codes codes (10^6 par défaut), lots de pré-tirage compris. Par palier :
+# débit d'émission cumulé, tirages rejetés (collisions avec un code déjà émis) rapportés aux
+# codes émis, et vérification qu'aucun code n'a été servi deux fois. Enfin, le temps de
+# construction du bitmap au démarrage à partir de tous ces codes.
+
+@suite("code_pool", "Débit d'émission et taux de collision d'un CodePool jusqu'à --codes codes")
+async def code_pool_suite(bench):
+    bot = bench.bot
+    pool = bot.CodePool(lambda: ())
+    issued = []
+    results = {}
+    started = time.perf_counter()
+    checkpoint = 10_000
+    while len(issued) < bench.args.codes:
+        issued.append(pool.pop())
+        if len(issued) == checkpoint or len(issued) == bench.args.codes:
+            elapsed = time.perf_counter() - started
+            name = f"code_pool:issue:{len(issued)}"
+            results[name] = {
+                "codes_per_s": round(len(issued) / elapsed),
+                "collisions": pool.collisions,
+                "collision_rate": round(pool.collisions / len(issued), 5),
+                "space_used": round(len(issued) / (len(bot.CODE_PREFIXES) * bot.CODE_SPACE_PER_PREFIX), 4),
+                "duplicates": len(issued) - len(set(issued)),
+            }
+            report(name, results[name])
+            checkpoint *= 10
+    started = time.perf_counter()
+    bot.CodePool(lambda: iter(issued)).warm_up()
+    results[f"code_pool:warm_up:{len(issued)}"] = {"warm_up_ms": round((time.perf_counter() - started) * 1000, 1)}
+    report(f"code_pool:warm_up:{len(issued)}", results[f"code_pool:warm_up:{len(issued)}"])
+    return results
+
+
+# ─── Écritures disque : retard de la boucle ───────
+# --users utilisateurs envoient leur e-mail dans la même seconde (émission d'un code, écriture
+# dans remises) sur un store prérempli de --lag-codes codes. Un chronomètre qui dort 1 ms en
+# boucle mesure le retard de la boucle d'événements pendant ce temps. En face, l'ancien
+# comportement : remises.json réécrit en entier, de façon synchrone, à chaque remise.
+
+class RewriteStore(dict):
+    # Émulation de save_remises() d'avant le journal : json.dump de tout le fichier dans le handler
+    def __init__(self, path, data):
+        super().__init__(data)
+        self.path = path
+
+    def set(self, key, value):
+        self[key] = value
+        with open(self.path, "w") as f:
+            json.dump(self, f)
+
+    def delete(self, key):
+        self.pop(key, None)
+
+    def request_compaction(self):
+        pass
+
+    async def flush(self):
+        pass
+
+
+async def measure_loop_lag(stop, samples, interval=0.001):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+@suite("loop_lag", "Retard de la boucle pendant --users remises simultanées : journal en thread contre réécriture synchrone")
+async def loop_lag_suite(bench):
+    from telegram import Update
+
+    bot, app, args = bench.bot, bench.app, bench.args
+    make_update, prepare = scenarios(bot, app)["message:email"]
+
+    async def one(delay, update, latencies):
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+        if bot.flood_guard.admit_update(update):
+            await app.process_update(update)
+        latencies.append(time.perf_counter() - started)
+    data = {str(i): fake_entry(i) for i in range(args.lag_codes)}
+    stores = {
+        "journal": lambda: filled_store(bot, "journal", args.lag_codes, bench.path("lag-remises.json")),
+        "sync_rewrite": lambda: RewriteStore(bench.path("lag-rewrite.json"), data),
+    }
+    original = bot.remises_store
+    max_pending = bot.flood_guard.max_pending
+    bot.flood_guard.max_pending = args.users * 2
+    results = {}
+    try:
+        for name, make_store in stores.items():
+            store = make_store()
+            bot.remises_store = bot.code_index.store = bot.expiry_index.store = store
+            first = bench.ids(args.users)
+            for user_id in range(first, first + args.users):
+                prepare(user_id)
+            updates = [Update.de_json(make_update(user_id, user_id), app.bot) for user_id in range(first, first + args.users)]
+            samples, latencies, stop = [], [], asyncio.Event()
+            ticker = asyncio.create_task(measure_loop_lag(stop, samples))
+            started = time.perf_counter()
+            await asyncio.gather(*(one(i / args.users, update, latencies) for i, update in enumerate(updates)))
+            await store.flush()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await ticker
+            result = latency_summary(latencies)
+            lag = latency_summary(samples)
+            result.update({
+                "ops_per_s": round(len(updates) / elapsed, 1),
+                "lag_p50_ms": lag["p50_ms"],
+                "lag_p99_ms": lag["p99_ms"],
+                "lag_max_ms": lag["max_ms"],
+            })
+            results[f"loop_lag:{name}"] = result
+            report(f"loop_lag:{name}", result)
+    finally:
+        bot.remises_store = bot.code_index.store = bot.expiry_index.store = original
+        bot.flood_guard.max_pending = max_pending
+    return results
+
+
+# ─── Instrumentation : surcoût ───────────────────
+# Même appel avec et sans le chronométrage de bot.metrics, alternés appel par appel (GC
+# suspendu) pour que le bruit touche les deux côtés ; médiane de --rounds tours :
+# - handler vide : coût absolu de call_instrumented ;
+# - appel API seul : InstrumentedRequest.do_request autour de la fausse API, contre la fausse
+#   API nue ;
+# - handler /start réel : handler et appels API instrumentés comme en production, contre rien
+#   d'instrumenté ;
+# - tap sur une page (fr_FAQ) : route_callback (table, série pré-résolue, analytics) contre
+#   handle_page appelé directement. Objectif : surcoût < 5 %.
+
+async def interleaved(direct_calls, wrapped_calls, rounds):
+    ratios, direct_times, wrapped_times = [], [], []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            direct_total = wrapped_total = 0.0
+            for direct, wrapped in zip(direct_calls, wrapped_calls):
+                started = time.perf_counter()
+                await direct()
+                middle = time.perf_counter()
+                await wrapped()
+                direct_total += middle - started
+                wrapped_total += time.perf_counter() - middle
+            direct_times.append(direct_total / len(direct_calls))
+            wrapped_times.append(wrapped_total / len(wrapped_calls))
+            ratios.append(wrapped_total / direct_total)
+    finally:
+        gc.enable()
+    direct, wrapped = sorted(direct_times)[rounds // 2], sorted(wrapped_times)[rounds // 2]
+    return {
+        "direct_us": round(direct * 1e6, 3),
+        "instrumented_us": round(wrapped * 1e6, 3),
+        "overhead_us": round((wrapped - direct) * 1e6, 3),
+        "overhead_pct": round(100 * (sorted(ratios)[rounds // 2] - 1), 2),
+    }
+
+
+@suite("instrumentation", "Surcoût du chronométrage des handlers et des appels API (objectif < 5 %)")
+async def instrumentation_suite(bench):
+    from telegram import Update
+    from telegram.ext import CallbackContext
+    from telegram.request import HTTPXRequest, RequestData
+
+    bot, args = bench.bot, bench.args
+    plain = make_request_class(HTTPXRequest)
+    instrumented_request = type("InstrumentedFakeRequest", (bot.InstrumentedRequest, plain), {})
+    # Deux Applications identiques, l'une sur la fausse API nue, l'autre sur la même fausse API
+    # enveloppée par InstrumentedRequest
+    apps = {"direct": bench.app, "wrapped": bot.build_application("1:bench", request=instrumented_request())}
+    await apps["wrapped"].initialize()
+    count = args.micro_ops
+    contexts = {}
+    for key, app, make_update in (
+        ("direct", apps["direct"], lambda i: message_update(i, i, "/start")),
+        ("wrapped", apps["wrapped"], lambda i: message_update(i, i, "/start")),
+        ("tap", apps["direct"], lambda i: callback_update(i, i, "fr_FAQ")),
+        ("routed_tap", apps["direct"], lambda i: callback_update(i, i, "fr_FAQ")),
+    ):
+        first = bench.ids(count)
+        contexts[key] = []
+        for i in range(count):
+            update = Update.de_json(make_update(first + i), app.bot)
+            context = CallbackContext.from_update(update, app)
+            context.args = []
+            contexts[key].append((update, context))
+
+    async def noop(update, context):
+        return None
+
+    handlers = {
+        "noop": (noop, bot.instrumented("bench_noop", noop), "direct", "direct"),
+        "start": (bot.start, bot.instrumented("bench_start", bot.start), "direct", "wrapped"),
+        "callback": (bot.handle_page, bot.route_callback, "tap", "routed_tap"),
+    }
+    data = RequestData()
+    url = "https://api.telegram.org/bot1:bench/sendChatAction"
+    requests = (plain(), instrumented_request())
+    results = {}
+    for name, (direct, wrapped, direct_key, wrapped_key) in handlers.items():
+        direct_calls = [lambda u=u, c=c: direct(u, c) for u, c in contexts[direct_key]]
+        wrapped_calls = [lambda u=u, c=c: wrapped(u, c) for u, c in contexts[wrapped_key]]
+        # Premier passage hors mesure : nouveaux abonnés, caches, pages déjà affichées
+        for call in direct_calls + (wrapped_calls if wrapped_key != direct_key else []):
+            await call()
+        results[f"instrumentation:{name}"] = await interleaved(direct_calls, wrapped_calls, args.rounds)
+    api_calls = [[lambda r=r: r.do_request(url, "POST", data)] * count for r in requests]
+    results["instrumentation:api_call"] = await interleaved(*api_calls, args.rounds)
+    await apps["wrapped"].shutdown()
+    for name, result in results.items():
+        report(name, result)
+    return results
+
+
+# ─── Balayage des codes expirés ───────────────────
+# remises préremplie de --max-codes codes, dont 1k, 10k puis 100k échus. Mesures : construction
+# des tas d'échéances au démarrage (warm_up), balayage (sweep + écriture des suppressions),
+# comparé au parcours complet qu'il remplace, puis construction du bitmap du CodePool à partir
+# de remises et du registre codes_emis.log, qui garde les codes balayés.
+
+@suite("sweep", "Coût du balayage des codes expirés dans --max-codes codes stockés")
+async def sweep_suite(bench):
+    bot, size = bench.bot, bench.args.max_codes
+    now = time.time()
+    results = {}
+    for due in (1_000, 10_000, 100_000):
+        if due > size:
+            break
+        expired = set(random.sample(range(size), due))
+        path = bench.path("sweep-remises.json")
+        store = filled_store(bot, "journal", size, path, lambda i: fake_entry(i, int(now) - 60 if i in expired else int(now) + 86400 * 30))
+        index = bot.ExpiryIndex(store)
+        started = time.perf_counter()
+        index.warm_up()
+        warm_up_s = time.perf_counter() - started
+        started = time.perf_counter()
+        scanned = sum(1 for _, entry in store.items() if bot.is_expired(entry, now))
+        scan_s = time.perf_counter() - started
+        started = time.perf_counter()
+        evicted = index.sweep(now)
+        await store.flush()
+        sweep_s = time.perf_counter() - started
+        name = f"sweep:{size}:{due}"
+        results[name] = {
+            "evicted": evicted,
+            "warm_up_s": round(warm_up_s, 3),
+            "sweep_ms": round(sweep_s * 1000, 2),
+            "us_per_evicted": round(sweep_s / max(evicted, 1) * 1e6, 2),
+            "full_scan_ms": round(scan_s * 1000, 2),
+        }
+        assert scanned == evicted == due
+        report(name, results[name])
+        if due == 1_000:
+            # Registre : tous les codes émis, balayés compris
+            with open(bench.path("sweep-codes.log"), "w") as f:
+                f.writelines(fake_code(i) + "\n" for i in range(size))
+            started = time.perf_counter()
+            stored_codes = [entry["code"] for _, entry in store.items()]
+
+            def issued_codes():
+                yield from stored_codes
+                with open(bench.path("sweep-codes.log")) as f:
+                    for line in f:
+                        yield line.rstrip("\n")
+
+            pool = bot.CodePool(issued_codes)
+            pool.warm_up()
+            results[f"sweep:{size}:code_pool_warm_up"] = {
+                "warm_up_s": round(time.perf_counter() - started, 3),
+                "taken": pool._taken_count - len(pool),
+            }
+            report(f"sweep:{size}:code_pool_warm_up", results[f"sweep:{size}:code_pool_warm_up"])
+        # Compaction lancée par le flush terminée avant d'effacer ses fichiers
+        while store._compacting:
+            await asyncio.sleep(0.01)
+        await asyncio.get_running_loop().run_in_executor(bot.COMPACTION_EXECUTOR, lambda: None)
+        del store, index
+        for leftover in (path, path + ".journal", path + ".journal.old"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return results
+
+
+# ─── Multi-worker : montée de 1 à 8 workers ───────
+# Le vrai mode multi-worker (WorkerPool, processus spawn, SQLite partagé) contre une fausse
+# API Telegram servie en HTTP par ce processus (TELEGRAM_API_URL), avec --worker-api-latency
+# ms par appel. Les mises à jour sont réparties par WorkerPool.dispatch comme dans le frontal
+# du webhook, d'un bloc, puis on attend la réponse de chacune. Débit et latences pour 1, 2,
+# 4 puis 8 workers ; la répartition par worker est relue dans les instantanés de métriques
+# que chaque worker publie pour le /metrics du frontal.
+# Sur une machine à un seul cœur, seul le recouvrement des attentes réseau peut progresser.
+
+def stub_bot_api(answered, latency):
+    import tornado.web
+
+    class StubBotApi(tornado.web.RequestHandler):
+        async def post(self, token, endpoint):
+            params = {key: values[0].decode() for key, values in self.request.body_arguments.items()}
+            if latency:
+                await asyncio.sleep(latency)
+            if "chat_id" in params:
+                answered[int(params["chat_id"])] = time.perf_counter()
+            self.write({"ok": True, "result": fake_api_result(endpoint, params)})
+
+        get = post
+
+    return tornado.web.Application([(r"/bot([^/]+)/(\w+)", StubBotApi)])
+
+
+def listen_locally(application):
+    import tornado.httpserver
+    import tornado.netutil
+
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    return server, f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+
+
+async def wait_answered(answered, sent, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and any(answered.get(chat, 0) < at for chat, at in sent.items()):
+        await asyncio.sleep(0.005)
+    return {chat: answered[chat] for chat, at in sent.items() if answered.get(chat, 0) >= at}
+
+
+def worker_update_counts(bot):
+    # Mises à jour traitées par worker, d'après les instantanés metrics.wN.json
+    counts = {}
+    for snapshot in bot.read_worker_metrics():
+        for line in snapshot.get("bot_handler_duration_seconds", []):
+            if line.startswith("bot_handler_duration_seconds_count"):
+                worker = line.split('worker="', 1)[1].split('"', 1)[0]
+                counts[worker] = counts.get(worker, 0) + int(line.rsplit(" ", 1)[1])
+    return [counts.get(str(i), 0) for i in range(len(counts))]
+
+
+@suite("workers", "Débit et latence du mode multi-worker de 1 à 8 processus, API Telegram en HTTP local")
+async def workers_suite(bench):
+    bot, args = bench.bot, bench.args
+    answered = {}
+    server, api_url = listen_locally(stub_bot_api(answered, args.worker_api_latency / 1000))
+    recorded = [scenarios(bot, bench.app)[INGRESS_MIX[i % len(INGRESS_MIX)]][0](i, i) for i in range(len(INGRESS_MIX))]
+    loop = asyncio.get_running_loop()
+    results = {}
+    try:
+        for count in (1, 2, 4, 8):
+            env = {
+                "BOT_WORKERS": str(count),
+                "STORE_BACKEND": "sqlite",
+                "STORE_DB_FILE": bench.path(f"workers-{count}.sqlite3"),
+                "TELEGRAM_API_URL": api_url,
+                "THROTTLE_MAX_PENDING": str(args.ops * 2),
+                "WORKER_METRICS_INTERVAL": "0.5",
+                "LOG_LEVEL": "INFO" if args.log else "WARNING",
+            }
+            saved = {key: os.environ.get(key) for key in env}
+            os.environ.update(env)
+            try:
+                started = time.perf_counter()
+                pool = bot.WorkerPool(count)
+            finally:
+                for key, value in saved.items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+            try:
+                # Un /start par worker : prêt quand chacun a répondu
+                first = bench.ids(count * 2)
+                first += -first % count
+                ready = {}
+                for user_id in range(first, first + count):
+                    ready[user_id] = time.perf_counter()
+                    await pool.dispatch(message_update(user_id, user_id, "/start"))
+                await wait_answered(answered, ready, 120)
+                ready_s = time.perf_counter() - started
+
+                first = bench.ids(args.ops)
+                sent = {}
+                for i in range(args.ops):
+                    sent[first + i] = time.perf_counter()
+                    await pool.dispatch(retarget(recorded[i % len(recorded)], first + i, first + i))
+                done = await wait_answered(answered, sent, 120)
+                result = latency_summary([done[chat] - sent[chat] for chat in done])
+                result["ops_per_s"] = round(len(done) / (max(done.values()) - min(sent.values())), 1)
+                result["unanswered"] = args.ops - len(done)
+                result["ready_s"] = round(ready_s, 2)
+                await asyncio.sleep(1)  # Dernier instantané de métriques
+                result["updates_per_worker"] = worker_update_counts(bot)
+            finally:
+                await loop.run_in_executor(None, pool.stop)
+            results[f"workers:{count}"] = result
+            report(f"workers:{count}", result)
+    finally:
+        server.stop()
+    return results
+
+
+# ─── Démarrage à froid ────────────────────────────
+# Sur l'offre gratuite de Render, le service s'endort : la première mise à jour réveille un
+# processus neuf. `python -X importtime -c "import bot"` donne le coût des imports (remises.json
+# n'est lu qu'après l'ouverture du port) ; `python bot.py` est ensuite lancé en webhook, --startup-codes
+# remises sur disque et API Telegram bouchonnée (TELEGRAM_API_URL). Depuis le lancement du
+# processus : premier health check répondu, réponse au premier /start reçu par le webhook,
+# premier code de remise servi, puis fin des warm-ups (jauge bot_warm_up_seconds).
+# WARM_UP_CHUNK=10^9 (une seule tranche) reproduit l'ancien démarrage, où la construction des
+# index bloquait la boucle avant la première réponse.
+
+STARTUP_MODES = {"chunked": None, "blocking": str(10 ** 9)}
+
+
+def import_times(env, cwd):
+    # (ms pour importer bot, [(module importé directement par bot, ms cumulées)])
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import bot"],
+        env=env, cwd=cwd, capture_output=True, text=True, check=True,
+    ).stderr
+    total, children = 0.0, []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == "bot":
+            total = int(cumulative) / 1000
+        elif depth == 1:
+            children.append((name.strip(), round(int(cumulative) / 1000, 1)))
+    return total, sorted(children, key=lambda child: -child[1])
+
+
+def write_startup_files(directory, size):
+    with open(os.path.join(directory, "remises.json"), "w") as f:
+        json.dump({str(i): fake_entry(i) for i in range(size)}, f, separators=(",", ":"))
+    with open(os.path.join(directory, "codes_emis.log"), "w") as f:
+        f.writelines(fake_code(i) + "\n" for i in range(size))
+
+
+async def cold_start(bot, env, cwd, answered, user_id):
+    import httpx
+    import socket
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    url = f"http://127.0.0.1:{port}"
+    webhook_path, secret_token = bot.webhook_settings(env["TELEGRAM_TOKEN"])
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret_token}
+    result = {}
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "bot.py")],
+        env={**env, "PORT": str(port)}, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        async with httpx.AsyncClient(timeout=120) as client:
+            while True:
+                try:
+                    await client.get(url + "/")
+                    break
+                except httpx.TransportError:
+                    if process.poll() is not None:
+                        raise RuntimeError(f"bot.py exited with {process.returncode}")
+                    await asyncio.sleep(0.005)
+            result["health_s"] = round(time.perf_counter() - started, 3)
+
+            # Premier /start, puis la première remise (le pool de codes doit être prêt)
+            for key, update in (
+                ("first_response_s", message_update(user_id, user_id, "/start")),
+                ("first_code_s", callback_update(user_id + 1, user_id, "fr_Remise")),
+            ):
+                sent = {user_id: time.perf_counter()}
+                await client.post(f"{url}/{webhook_path}", json=update, headers=headers)
+                done = await wait_answered(answered, sent, 120)
+                result[key] = round(done[user_id] - started, 3) if done else None
+
+            while True:
+                metrics = (await client.get(url + "/metrics")).text
+                warm_up = next(float(line.split()[1]) for line in metrics.splitlines() if line.startswith("bot_warm_up_seconds "))
+                if warm_up:
+                    break
+                await asyncio.sleep(0.02)
+            result["warm_up_done_s"] = round(time.perf_counter() - started, 3)
+            result["warm_up_s"] = round(warm_up, 3)
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+@suite("startup", "Démarrage à froid avec --startup-codes remises : imports, health check, première réponse, warm-ups")
+async def startup_suite(bench):
+    bot, args = bench.bot, bench.args
+    answered = {}
+    server, api_url = listen_locally(stub_bot_api(answered, 0))
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "TELEGRAM_API_URL": api_url,
+        "WEBHOOK_URL": "https://bench.invalid",
+        "LOG_LEVEL": "INFO" if args.log else "WARNING",
+    }
+    results = {}
+    try:
+        for mode, chunk in STARTUP_MODES.items():
+            # Un dossier par lancement : chacun part des mêmes fichiers
+            directory = bench.path(f"startup-{mode}")
+            os.makedirs(directory)
+            write_startup_files(directory, args.startup_codes)
+            if not results:
+                total, children = import_times(env, directory)
+                results["startup:import"] = {"import_bot_ms": round(total, 1), **{f"import_{name}_ms": ms for name, ms in children[:6]}}
+                report("startup:import", results["startup:import"])
+            run_env = dict(env)
+            if chunk is not None:
+                run_env["WARM_UP_CHUNK"] = chunk
+            result = await cold_start(bot, run_env, directory, answered, bench.ids(2))
+            results[f"startup:{mode}:{args.startup_codes}"] = result
+            report(f"startup:{mode}:{args.startup_codes}", result)
+    finally:
+        server.stop()
+    return results
+
+
+# ─── Doublons : renvois de Telegram et doubles taps ─
+# Rafale de --ops utilisateurs simultanés, chacun enchaînant /start, /language en, le bouton
+# FAQ, le bouton Remise puis son e-mail. Chaque message arrive deux fois avec le même
+# update_id (renvoi après un webhook lent) et chaque bouton est tapé deux fois (deux
+# update_id). Le filtre du groupe -1 est comparé à lui-même désactivé (TTL nuls) : appels
+# API et enregistrements envoyés au disque (stores et événements analytics) par utilisateur.
+# Les mises à jour sont admises par l'anti-flood, aux seaux agrandis : il n'en retire aucune.
+
+def duplicate_burst(user_id, first_id):
+    # [(update, copie)] dans l'ordre de l'utilisateur ; la copie part en même temps que l'original
+    steps = []
+    for i, (kind, value) in enumerate((
+        ("message", "/start"),
+        ("message", "/language en"),
+        ("tap", "fr_FAQ"),
+        ("tap", "fr_Remise"),
+        ("message", f"bench{user_id}@example.com"),
+    )):
+        update_id = first_id + 2 * i
+        if kind == "message":
+            update = message_update(update_id, user_id, value)
+            steps.append((update, dict(update)))
+        else:
+            steps.append((callback_update(update_id, user_id, value), callback_update(update_id + 1, user_id, value)))
+    return steps
+
+
+def disk_records(bot):
+    stores = (bot.remises_store, bot.issued_codes, bot.subscribers_store, bot.user_languages)
+    return sum(store._queued for store in stores) + (bot.analytics.recorded if bot.analytics else 0)
+
+
+@suite("duplicates", "Rafale de renvois (même update_id) et de doubles taps : appels API et écritures, filtre actif ou non")
+async def duplicates_suite(bench):
+    from telegram import Update
+
+    bot, app, request, args = bench.bot, bench.app, bench.request, bench.args
+    ttls = (bot.seen_updates.ttl, bot.recent_taps.ttl)
+    results = {}
+
+    async def user_burst(steps):
+        for pair in steps:
+            await asyncio.gather(*(admitted(bot, app, Update.de_json(data, app.bot)) for data in pair))
+
+    try:
+        for mode in ("dedup", "no_dedup"):
+            if mode == "no_dedup":
+                bot.seen_updates.ttl = bot.recent_taps.ttl = 0  # Toute entrée est déjà expirée
+            first = bench.ids(args.ops)
+            bursts = [duplicate_burst(first + i, bench.ids(10)) for i in range(args.ops)]
+            calls, records, errors = request.calls, disk_records(bot), handler_errors(bot)
+            started = time.perf_counter()
+            with unthrottled(bot.flood_guard):
+                await asyncio.gather(*(user_burst(steps) for steps in bursts))
+            elapsed = time.perf_counter() - started
+            await bot.remises_store.flush()
+            result = {
+                "users": args.ops,
+                "updates": args.ops * 10,
+                "api_calls_per_user": round((request.calls - calls) / args.ops, 2),
+                "disk_records_per_user": round((disk_records(bot) - records) / args.ops, 2),
+                "ms_per_user": round(elapsed * 1000 / args.ops, 3),
+                "errors": handler_errors(bot) - errors,
+            }
+            results[f"duplicates:{mode}"] = result
+            report(f"duplicates:{mode}", result)
+    finally:
+        bot.seen_updates.ttl, bot.recent_taps.ttl = ttls
+    return results
+
+
+# ─── Pages déjà affichées : édition évitée ────────
+# Coût d'un tap sur un bouton de page, de process_update à l'appel API : temps CPU et octets
+# envoyés à l'API par tap. « skip » : le même message reçoit encore le tap de la page qu'il
+# affiche (seul answerCallbackQuery part) ; « edit » : chaque tap vient d'un autre message,
+# la page est envoyée par editMessageText. Anti-double-tap coupé : les taps sont supposés
+# espacés de plus de CALLBACK_DEBOUNCE_SECONDS ; admission anti-flood comprise, seaux
+# agrandis. Tours alternés, meilleur retenu.
+
+EDITED_PAGE = "fr_FAQ"
+
+
+@suite("edits", "CPU et octets envoyés par tap sur une page déjà affichée (édition évitée) contre une page à éditer")
+async def edits_suite(bench):
+    from telegram import Update
+
+    bot, app, request, args = bench.bot, bench.app, bench.request, bench.args
+    count = args.micro_ops
+    user_id = bench.ids(1)
+    shown_message = bench.ids(1)
+
+    def taps(mode):
+        first = bench.ids(count)
+        updates = []
+        for i in range(count):
+            data = callback_update(first + i, user_id, EDITED_PAGE)
+            if mode == "skip":
+                data["callback_query"]["message"]["message_id"] = shown_message
+            updates.append(Update.de_json(data, app.bot))
+        return updates
+
+    ttl = bot.recent_taps.ttl
+    bot.recent_taps.ttl = 0
+    best = {}
+    try:
+        # Premier affichage de la page dans le message du chemin « skip »
+        with unthrottled(bot.flood_guard):
+            await admitted(bot, app, taps("skip")[0])
+        for _ in range(args.rounds):
+            for mode in ("skip", "edit"):
+                updates = taps(mode)
+                calls, sent = request.calls, request.bytes_sent
+                started = time.process_time()
+                with unthrottled(bot.flood_guard):
+                    for update in updates:
+                        await admitted(bot, app, update)
+                cpu = time.process_time() - started
+                result = {
+                    "ops": count,
+                    "cpu_us_per_tap": round(cpu / count * 1e6, 2),
+                    "api_calls_per_tap": round((request.calls - calls) / count, 2),
+                    "bytes_sent_per_tap": round((request.bytes_sent - sent) / count, 1),
+                }
+                if mode not in best or result["cpu_us_per_tap"] < best[mode]["cpu_us_per_tap"]:
+                    best[mode] = result
+    finally:
+        bot.recent_taps.ttl = ttl
+    results = {f"edits:{mode}": result for mode, result in best.items()}
+    for name, result in results.items():
+        report(name, result)
+    return results
+
+
+# ─── Flood : un utilisateur inonde, les autres attendent ─
+# L'Application tourne (file d'entrée ThrottledQueue, MAX_CONCURRENT_UPDATES traitements) et
+# l'API Telegram répond en --flood-api-latency ms. --ops utilisateurs ordinaires envoient
+# chacun un /start, au rythme --rate ; pendant ce temps un seul compte envoie --flood-rate
+# questions libres par seconde. Latence des utilisateurs ordinaires, de l'entrée dans la
+# file à leur réponse : anti-flood actif, anti-flood neutralisé (seaux et plafond géants),
+# et sans inondation pour référence.
+
+async def drain_updates(bot, app, timeout=120):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and (app.update_queue.qsize() or bot.flood_guard.pending):
+        await asyncio.sleep(0.01)
+
+
+@suite("flood", "Latence p99 des utilisateurs ordinaires pendant qu'un compte envoie --flood-rate mises à jour/s")
+async def flood_suite(bench):
+    from telegram import Update
+
+    bot, app, request, args = bench.bot, bench.app, bench.request, bench.args
+    guard = bot.flood_guard
+    limits = (guard.rate, guard.burst, guard.max_pending)
+    latency = request.latency
+    results = {}
+    request.latency = args.flood_api_latency / 1000
+    await app.start()
+    try:
+        for mode in ("guarded", "unguarded", "no_flood"):
+            if mode == "unguarded":
+                guard.rate = guard.burst = guard.max_pending = 10 ** 9
+            else:
+                guard.rate, guard.burst, guard.max_pending = limits
+            first = bench.ids(args.ops)
+            flooder = bench.ids(1)
+            flood_ids = bench.ids(int(args.flood_rate * (args.ops / args.rate + 60)))
+            stop = asyncio.Event()
+            flooded = [0, 0]  # envoyées, admises
+            throttled = sum(value for (name, _), value in bot.metrics.counters.items() if name == "bot_throttled_updates_total")
+
+            async def flood():
+                started = time.perf_counter()
+                while not stop.is_set():
+                    due = int((time.perf_counter() - started) * args.flood_rate)
+                    while flooded[0] < due:
+                        data = message_update(flood_ids + flooded[0], flooder, "comment payer ?")
+                        app.update_queue.put_nowait(Update.de_json(data, app.bot))
+                        flooded[0] += 1
+                    await asyncio.sleep(0.005)
+
+            flooding = asyncio.create_task(flood()) if mode != "no_flood" else None
+            sent = {}
+            started = time.perf_counter()
+            for i in range(args.ops):
+                await asyncio.sleep(max(0.0, started + i / args.rate - time.perf_counter()))
+                sent[first + i] = time.perf_counter()
+                app.update_queue.put_nowait(Update.de_json(message_update(first + i, first + i, "/start"), app.bot))
+            done = await wait_answered(request.answered, sent, 60)
+            stop.set()
+            if flooding is not None:
+                await flooding
+            await drain_updates(bot, app)
+            result = latency_summary([done[chat] - sent[chat] for chat in done])
+            result["unanswered"] = args.ops - len(done)
+            result["flood_sent"] = flooded[0]
+            result["flood_throttled"] = int(sum(
+                value for (name, _), value in bot.metrics.counters.items() if name == "bot_throttled_updates_total"
+            ) - throttled)
+            results[f"flood:{mode}"] = result
+            report(f"flood:{mode}", result)
+    finally:
+        guard.rate, guard.burst, guard.max_pending = limits
+        request.latency = latency
+        await app.stop()
+    return results
+
+
+# ─── Liens profonds : page directe contre menu ─────
+# Un utilisateur arrive d'un lien t.me/…?start=<payload> vers une page : une seule mise à jour
+# (/start signé) affiche la page. Sans lien, il reçoit le menu puis tape jusqu'à la page :
+# /start puis un tap par niveau, le chemin le plus court dans les boutons de pages.json. Pour
+# --ops utilisateurs simultanés (admis par l'anti-flood, plafond agrandi) et une API à
+# --deeplink-api-latency ms : appels API par utilisateur et temps jusqu'à l'affichage de la
+# page (temps de lecture entre taps exclu).
+
+DEEP_LINK_TARGETS = ("fr_Seminaires", "faq_paiement")
+
+
+def menu_path(bot, target):
+    # Callbacks à taper depuis le menu principal pour atteindre target (parcours en largeur)
+    with open(bot.PAGES_FILE, encoding="utf-8") as f:
+        specs = json.load(f)["pages"]
+    paths = {"start_menu": []}
+    queue = deque(["start_menu"])
+    while queue:
+        page_id = queue.popleft()
+        for row in specs[page_id].get("buttons", []):
+            for button in row:
+                child = button.get("callback")
+                if child in specs and child not in paths:
+                    paths[child] = paths[page_id] + [child]
+                    queue.append(child)
+    return paths[target]
+
+
+@suite("deeplinks", "Lien profond contre menu puis taps : appels API et temps jusqu'à la page")
+async def deeplinks_suite(bench):
+    from telegram import Update
+
+    bot, app, request, args = bench.bot, bench.app, bench.request, bench.args
+    latency = request.latency
+    request.latency = args.deeplink_api_latency / 1000
+    results = {}
+
+    async def visit(updates):
+        started = time.perf_counter()
+        for data in updates:
+            await admitted(bot, app, Update.de_json(data, app.bot))
+        return time.perf_counter() - started
+
+    try:
+        for target in DEEP_LINK_TARGETS:
+            taps = menu_path(bot, target)
+            payload = bot.sign_deep_link(target, "bench")
+            for mode in ("deeplink", "menu"):
+                first = bench.ids(args.ops)
+                visits = []
+                for i in range(args.ops):
+                    user_id = first + i
+                    update_ids = bench.ids(len(taps) + 1)
+                    if mode == "deeplink":
+                        visits.append([message_update(update_ids, user_id, f"/start {payload}")])
+                    else:
+                        visits.append([message_update(update_ids, user_id, "/start")] + [
+                            callback_update(update_ids + 1 + n, user_id, data) for n, data in enumerate(taps)
+                        ])
+                calls = request.calls
+                with unthrottled(bot.flood_guard):
+                    durations = await asyncio.gather(*(visit(updates) for updates in visits))
+                result = latency_summary(durations)
+                result["updates_per_user"] = len(visits[0])
+                result["api_calls_per_user"] = round((request.calls - calls) / args.ops, 2)
+                results[f"deeplinks:{target}:{mode}"] = result
+                report(f"deeplinks:{target}:{mode}", result)
+    finally:
+        request.latency = latency
+    return results
+
+
+# ─── Recherche : corpus synthétiques ─────────────
+# Corpus de 100, 1k puis 10k documents tirés d'un vocabulaire de mots inventés (fréquences
+# en loi de Zipf, comme un texte réel) : titre de 3 à 6 mots, corps de 40 à 160 mots. Pour
+# chaque taille : construction d'un SearchIndex, mémoire Python qu'il retient (tracemalloc,
+# seconde construction, tracemalloc ralentissant les allocations), puis --micro-ops questions
+# de 3 mots distincts d'un document, exactes ou avec une faute (lettre remplacée) dans le mot
+# le plus long. « hit » : le document d'origine sort premier.
+
+SEARCH_CORPUS_SIZES = (100, 1000, 10_000)
+SYLLABLES = ("ka", "lo", "mi", "ra", "te", "su", "ne", "vo", "di", "an", "or", "is", "pe", "tu", "ba", "gen")
+
+
+def synthetic_corpus(size, rng, vocabulary_size=20_000):
+    words = sorted({"".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))) for _ in range(vocabulary_size)})
+    rng.shuffle(words)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    documents = []
+    for i in range(size):
+        title = rng.choices(words, weights, k=rng.randint(3, 6))
+        body = rng.choices(words, weights, k=rng.randint(40, 160))
+        documents.append((f"doc_{i}", " ".join(title), " ".join(body)))
+    return documents
+
+
+def with_typo(word, rng):
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice([c for c in "abcdefghijklmnopqrstuvwxyz" if c != word[i]]) + word[i + 1:]
+
+
+@suite("search", "Construction, mémoire et latence p50/p99 (fautes comprises) de l'index de recherche, 100 à 10k documents")
+async def search_suite(bench):
+    bot, args = bench.bot, bench.args
+    results = {}
+    for size in SEARCH_CORPUS_SIZES:
+        rng = random.Random(size)
+        documents = synthetic_corpus(size, rng)
+        started = time.perf_counter()
+        bot.SearchIndex(documents)
+        build_ms = (time.perf_counter() - started) * 1000
+        gc.collect()
+        tracemalloc.start()
+        index = bot.SearchIndex(documents)
+        index_kb = tracemalloc.get_traced_memory()[0] // 1024
+        tracemalloc.stop()
+        result = {"documents": size, "build_ms": round(build_ms, 1), "index_kb": index_kb, "terms": len(index.postings)}
+
+        for mode in ("exact", "typo"):
+            latencies, hits = [], 0
+            for _ in range(args.micro_ops):
+                page_id, title, body = documents[rng.randrange(size)]
+                terms = rng.sample(sorted(set(f"{title} {body}".split())), 3)
+                if mode == "typo":
+                    longest = max(range(3), key=lambda k: len(terms[k]))
+                    terms[longest] = with_typo(terms[longest], rng)
+                question = " ".join(terms)
+                started = time.perf_counter()
+                found, _ = index.search(question)
+                latencies.append(time.perf_counter() - started)
+                hits += found == page_id
+            latencies.sort()
+            result[f"{mode}_p50_us"] = round(percentile(latencies, 0.50) * 1e6, 1)
+            result[f"{mode}_p99_us"] = round(percentile(latencies, 0.99) * 1e6, 1)
+            result[f"{mode}_hit_rate"] = round(hits / args.micro_ops, 3)
+        results[f"search:{size}"] = result
+        report(f"search:{size}", result)
+    return results
+
+
+# ─── API de validation des codes : charge HTTP ────
+# Le serveur tornado du bot (make_web_app, routes /codes/…) sert un CodeIndex de --api-codes
+# remises ; la charge vient d'un processus séparé (spawn) pour ne pas partager la boucle ni le
+# cœur Python du serveur. --api-requests requêtes, --concurrency en vol :
+# - GET /codes/<code>, moitié de codes attribués, moitié inconnus (404) ;
+# - POST /codes/validate, lots de --api-batch codes du même mélange.
+# Requêtes/s, codes/s et latence p50/p99 vues par le client.
+
+def codes_api_client(url, api_key, mode, count, concurrency, batch, codes, connection):
+    import httpx
+
+    async def run():
+        latencies, errors = [], 0
+        pending = iter(range(count))
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, headers={"X-Api-Key": api_key}, timeout=60) as client:
+            async def worker():
+                nonlocal errors
+                for i in pending:
+                    started = time.perf_counter()
+                    if mode == "get":
+                        response = await client.get(f"{url}/codes/{codes[i % len(codes)]}")
+                        ok = response.status_code in (200, 404)
+                    else:
+                        first = i * batch % len(codes)
+                        response = await client.post(f"{url}/codes/validate", json={"codes": codes[first:first + batch]})
+                        ok = response.status_code == 200
+                    latencies.append(time.perf_counter() - started)
+                    errors += not ok
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return latencies, time.perf_counter() - started, errors
+
+    connection.send(asyncio.run(run()))
+    connection.close()
+
+
+@suite("codes_api", "Débit et latence p50/p99 de GET /codes/<code> et POST /codes/validate sous charge HTTP")
+async def codes_api_suite(bench):
+    import multiprocessing
+
+    bot, args = bench.bot, bench.args
+    store = filled_store(bot, "journal", args.api_codes, bench.path("codes_api.json"))
+    code_index = bot.code_index
+    bot.code_index = bot.CodeIndex(store)
+    bot.code_index.warm_up()
+    server, url = listen_locally(bot.make_web_app(None, "telegram", "bench"))
+    # Moitié attribués, moitié inconnus, mélangés
+    codes = [fake_code(i) for i in range(min(args.api_codes, 5000))]
+    codes += [fake_code(args.api_codes + i) for i in range(len(codes))]
+    random.Random(0).shuffle(codes)
+    context = multiprocessing.get_context("spawn")
+    loop = asyncio.get_running_loop()
+    results = {}
+    try:
+        for mode, batch in (("get", 1), ("validate", args.api_batch)):
+            count = args.api_requests if mode == "get" else max(1, args.api_requests // 10)
+            receiver, sender = context.Pipe(duplex=False)
+            client = context.Process(
+                target=codes_api_client,
+                args=(url, bot.CODES_API_KEY, mode, count, args.concurrency, batch, codes, sender),
+            )
+            client.start()
+            sender.close()
+            latencies, elapsed, errors = await loop.run_in_executor(None, receiver.recv)
+            await loop.run_in_executor(None, client.join)
+            result = latency_summary(latencies)
+            result["requests_per_s"] = round(count / elapsed, 1)
+            result["codes_per_s"] = round(count * batch / elapsed, 1)
+            result["errors"] = errors
+            results[f"codes_api:{mode}:{args.concurrency}"] = result
+            report(f"codes_api:{mode}:{args.concurrency}", result)
+    finally:
+        server.stop()
+        bot.code_index = code_index
+    return results
+
+
+# ─── Synchronisation des coupons : lots Supabase ──
+# CouponSync réel (start, file, réveil au seuil, flush) devant un faux PostgREST
+# (httpx.MockTransport) qui répond 201 après --sync-latency ms. --sync-rows codes sont mis en
+# file d'un bloc ; on mesure le temps jusqu'à ce que tous soient synchronisés, avec des lots
+# de 1 (un upsert par code, l'ancien envoi) puis de COUPON_SYNC_BATCH. Lignes/s et requêtes.
+
+def mock_postgrest(received, latency):
+    import httpx
+
+    async def handler(request):
+        received.append(len(json.loads(request.content)))
+        if latency:
+            await asyncio.sleep(latency)
+        return httpx.Response(201)
+
+    return httpx.MockTransport(handler)
+
+
+@suite("sync", "Débit de CouponSync vers un faux Supabase : lots de 1 contre COUPON_SYNC_BATCH")
+async def sync_suite(bench):
+    import httpx
+
+    bot, args = bench.bot, bench.args
+    expires_at = datetime.now(timezone.utc) + timedelta(days=30)
+    results = {}
+    for batch_size in dict.fromkeys((1, bot.COUPON_SYNC_BATCH)):
+        received = []
+        sync = bot.CouponSync("https://supabase.bench", "bench-service-key", batch_size=batch_size)
+        await sync.start()
+        client = sync._client
+        sync._client = httpx.AsyncClient(
+            base_url=client.base_url, headers=client.headers, transport=mock_postgrest(received, args.sync_latency / 1000),
+        )
+        await client.aclose()
+        started = time.perf_counter()
+        for i in range(args.sync_rows):
+            sync.enqueue(fake_code(i), expires_at)
+        while sync.synced < args.sync_rows:
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - started
+        await sync.stop()
+        result = {
+            "rows": sync.synced,
+            "requests": len(received),
+            "rows_per_s": round(sync.synced / elapsed, 1),
+            "elapsed_s": round(elapsed, 3),
+        }
+        results[f"sync:batch_{batch_size}"] = result
+        report(f"sync:batch_{batch_size}", result)
+    return results
+
+
+# ─── Diffusions : débit et priorité interactive ───
+# Un Broadcaster neuf, seau de TELEGRAM_GLOBAL_RATE jetons/s, envoie une page à
+# --broadcast-subscribers abonnés par la fausse API. Comme InstrumentedRequest en production,
+# chaque appel à l'API prend un jeton du seau, réponses interactives comprises. On mesure les
+# messages/s de la campagne, puis la latence d'un /start (--broadcast-interactive-rate/s,
+# utilisateurs neufs) sans diffusion et pendant la diffusion : elle ne doit pas attendre le seau.
+
+BROADCAST_PAGE = "fr_Seminaires"
+
+
+async def interactive_latencies(bench, stop, rate):
+    from telegram import Update
+
+    bot, app = bench.bot, bench.app
+    latencies = []
+    started = time.perf_counter()
+    while not stop():
+        first = bench.ids(1)
+        update = Update.de_json(message_update(first, first, "/start"), app.bot)
+        before = time.perf_counter()
+        await admitted(bot, app, update)
+        latencies.append(time.perf_counter() - before)
+        await asyncio.sleep(max(0.0, started + len(latencies) / rate - time.perf_counter()))
+    return latencies
+
+
+@suite("broadcast", "Messages/s d'une diffusion au débit configuré et latence des réponses interactives pendant qu'elle tourne")
+async def broadcast_suite(bench):
+    bot, app, request, args = bench.bot, bench.app, bench.request, bench.args
+    bucket = bot.TokenBucket(bot.TELEGRAM_GLOBAL_RATE)
+    subscribers = bot.JournalStore(bench.path("broadcast-abonnes.json"))
+    campaigns = bot.JournalStore(bench.path("broadcast-campagnes.json"))
+    since = int(time.time()) - 1
+    first = bench.ids(args.broadcast_subscribers)
+    for user_id in range(first, first + args.broadcast_subscribers):
+        subscribers.set(str(user_id), {"since": since})
+    broadcaster = bot.Broadcaster(bucket, subscribers, campaigns)
+    do_request = request.do_request
+
+    async def rated_request(*call_args, **kwargs):
+        bucket.take()
+        return await do_request(*call_args, **kwargs)
+
+    request.do_request = rated_request
+    results = {}
+    try:
+        with unthrottled(bot.flood_guard):
+            deadline = time.perf_counter() + args.broadcast_idle_seconds
+            idle = await interactive_latencies(bench, lambda: time.perf_counter() >= deadline, args.broadcast_interactive_rate)
+            result = latency_summary(sorted(idle))
+            results["broadcast:interactive_idle"] = result
+            report("broadcast:interactive_idle", result)
+
+            broadcaster.start(app.bot)
+            started = time.perf_counter()
+            campaign_id = broadcaster.start_campaign(BROADCAST_PAGE)
+            finished = lambda: campaign_id not in broadcaster._tasks
+            during = await interactive_latencies(bench, finished, args.broadcast_interactive_rate)
+            elapsed = time.perf_counter() - started
+            await broadcaster.stop()
+    finally:
+        request.do_request = do_request
+    campaign = campaigns[campaign_id]
+    result = {
+        "sent": campaign["sent"],
+        "failed": campaign["failed"],
+        "rate_limit_per_s": bucket.rate,
+        "messages_per_s": round(campaign["sent"] / elapsed, 1),
+        "api_calls_per_s": round((campaign["sent"] + len(during)) / elapsed, 1),
+        "elapsed_s": round(elapsed, 3),
+    }
+    results["broadcast:campaign"] = result
+    report("broadcast:campaign", result)
+    result = latency_summary(sorted(during))
+    results["broadcast:interactive_during"] = result
+    report("broadcast:interactive_during", result)
+    await subscribers.flush()
+    await campaigns.flush()
+    return results
+
+
+# ─── Catalogue de livres : cache et rafraîchissement ─
+# BookCatalog réel devant un faux Supabase (httpx.MockTransport, --books-api-latency ms par
+# requête) : tables books (--books-rows livres publiés, ETag, filtre updated_at) et bundles.
+# Un livre est modifié chaque seconde côté « Supabase ». Pendant --books-seconds,
+# --concurrency lecteurs affichent la page à --books-rate affichages/s au total, avec
+# BOOKS_MAX_AGE réduit à --books-max-age s : taux de hit du cache (sinon stale ou miss),
+# latence des affichages (page recomposée à chaque nouvelle version comprise) et durée des
+# rafraîchissements lancés en tâche de fond.
+
+def book_row(i, updated_at):
+    return {
+        "id": f"book-{i}",
+        "title": f"Livre {i}",
+        "author": "Seshat",
+        "short_description": "Un livre du banc d'essai",
+        "key_benefits": ["Premier bienfait", "Deuxième bienfait"],
+        "is_featured": i % 10 == 0,
+        "is_published": True,
+        "created_at": "2024-01-01T00:00:00+00:00",
+        "updated_at": updated_at.isoformat(),
+    }
+
+
+def mock_supabase_books(rows, latency, served):
+    import httpx
+
+    async def handler(request):
+        if latency:
+            await asyncio.sleep(latency)
+        table = request.url.path.rsplit("/", 1)[-1]
+        if table == "bundles":
+            return httpx.Response(200, json=[{"title": "Pack", "slug": "pack", "book_ids": list(rows)[:3]}])
+        since = request.url.params.get("updated_at")
+        selected = list(rows.values())
+        if since is not None:
+            since = datetime.fromisoformat(since.removeprefix("gte."))
+            selected = [row for row in selected if datetime.fromisoformat(row["updated_at"]) >= since]
+        etag = f'"{max((row["updated_at"] for row in selected), default="")}-{len(selected)}"'
+        if request.headers.get("If-None-Match") == etag:
+            served["not_modified"] += 1
+            return httpx.Response(304)
+        served["rows"] += len(selected)
+        return httpx.Response(200, json=selected, headers={"ETag": etag})
+
+    return httpx.MockTransport(handler)
+
+
+@suite("books", "Taux de hit du cache des livres et durée des rafraîchissements pendant des affichages concurrents")
+async def books_suite(bench):
+    import httpx
+
+    bot, args = bench.bot, bench.args
+    published_at = datetime.now(timezone.utc) - timedelta(days=1)
+    rows = {f"book-{i}": book_row(i, published_at) for i in range(args.books_rows)}
+    served = {"rows": 0, "not_modified": 0}
+    books = bot.BookCatalog("https://supabase.bench", "bench-service-key", max_age=args.books_max_age, retry_interval=0)
+    books._client = httpx.AsyncClient(
+        base_url="https://supabase.bench/rest/v1", transport=mock_supabase_books(rows, args.books_api_latency / 1000, served),
+    )
+    refresh = books.refresh
+    refreshes = []
+
+    async def timed_refresh():
+        started = time.perf_counter()
+        await refresh()
+        refreshes.append(time.perf_counter() - started)
+
+    books.refresh = timed_refresh
+    static_page = bot.catalog.get(bot.BOOKS_PAGE, bot.DEFAULT_LOCALE)
+    counted = lambda: {
+        dict(labels)["result"]: value for (name, labels), value in bot.metrics.counters.items() if name == "bot_books_cache_total"
+    }
+    before = counted()
+    stop = time.perf_counter() + args.books_seconds
+    latencies = []
+
+    async def reader(offset):
+        interval = args.concurrency / args.books_rate
+        next_read = time.perf_counter() + offset * interval / args.concurrency
+        while next_read < stop:
+            await asyncio.sleep(max(0.0, next_read - time.perf_counter()))
+            started = time.perf_counter()
+            books.render(static_page, LOCALES[offset % len(LOCALES)])
+            latencies.append(time.perf_counter() - started)
+            next_read += interval
+
+    async def editor():
+        # Un livre modifié par seconde dans la boutique
+        i = 0
+        while time.perf_counter() < stop:
+            await asyncio.sleep(1)
+            key = f"book-{i % args.books_rows}"
+            rows[key] = dict(rows[key], title=f"Livre {i} (réédition)", updated_at=datetime.now(timezone.utc).isoformat())
+            i += 1
+
+    await asyncio.gather(editor(), *(reader(i) for i in range(args.concurrency)))
+    if books._refresh_task is not None:
+        await asyncio.gather(books._refresh_task, return_exceptions=True)
+    await books.stop()
+    after = counted()
+    reads = {result: after.get(result, 0) - before.get(result, 0) for result in ("hit", "stale", "miss")}
+    result = latency_summary(sorted(latencies))
+    result["hit_rate"] = round(reads["hit"] / max(sum(reads.values()), 1), 4)
+    result["stale"] = int(reads["stale"])
+    result["miss"] = int(reads["miss"])
+    result["catalog_versions"] = books.version
+    results = {"books:reads": result}
+    report("books:reads", result)
+    result = latency_summary(sorted(refreshes))
+    result["rows_fetched"] = served["rows"]
+    result["not_modified"] = served["not_modified"]
+    results["books:refresh"] = result
+    report("books:refresh", result)
+    return results
+
+
+# ─── Logging : temps pris à la boucle ─────────────
+# Pendant --log-seconds, --log-rate mises à jour/s, chacune avec les lignes INFO qu'elle produit
+# en production : « Received /start » du handler et « HTTP Request » de httpx pour sa réponse.
+# Temps passé dans les appels de logging sur le thread de la boucle (là où tournent les
+# handlers), par mise à jour et en part de la durée du test, puis lignes écrites :
+# - basicconfig : l'ancienne configuration, écriture formatée sur le thread appelant ;
+# - setup_logging : file + QueueListener, JSON, échantillonnage par défaut (LOG_RATE_LIMIT) ;
+# - setup_logging_unsampled : idem sans limite, pour isoler le coût de la file.
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+@suite("logging", "Temps passé à loguer sur la boucle à --log-rate mises à jour/s : basicConfig contre setup_logging")
+async def logging_suite(bench):
+    bot, args = bench.bot, bench.args
+    root = logging.getLogger()
+    saved = (root.handlers[:], root.level, logging.root.manager.disable, bot.LOG_FILE, bot.LOG_RATE_LIMIT)
+    start_logger, httpx_logger = logging.getLogger(), logging.getLogger("httpx")
+    results = {}
+    logging.disable(logging.NOTSET)
+    try:
+        for mode in ("basicconfig", "setup_logging", "setup_logging_unsampled"):
+            path = bench.path(f"logging-{mode}.log")
+            listener = None
+            if mode == "basicconfig":
+                logging.basicConfig(
+                    filename=path, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO, force=True,
+                )
+            else:
+                bot.LOG_FILE = path
+                bot.LOG_RATE_LIMIT = saved[4] if mode == "setup_logging" else {}
+                listener = bot.setup_logging()
+            count = int(args.log_rate * args.log_seconds)
+            first = bench.ids(count)
+            spent = 0.0
+            started = time.perf_counter()
+            for i in range(count):
+                await asyncio.sleep(max(0.0, started + i / args.log_rate - time.perf_counter()))
+                before = time.perf_counter()
+                start_logger.info("Received /start from user %s", first + i, extra={"event": "start"})
+                httpx_logger.info('HTTP Request: %s %s "%s %d %s"', "POST", "https://api.telegram.org/bot1:bench/sendMessage", "HTTP/1.1", 200, "OK")
+                spent += time.perf_counter() - before
+            elapsed = time.perf_counter() - started
+            if listener is not None:
+                listener.stop()
+                atexit.unregister(listener.stop)
+            for handler in root.handlers:
+                handler.close()
+            result = {
+                "updates": count,
+                "loop_us_per_update": round(spent / count * 1e6, 2),
+                "loop_share_pct": round(100 * spent / elapsed, 2),
+                "lines_written": count_lines(path),
+            }
+            results[f"logging:{mode}"] = result
+            report(f"logging:{mode}", result)
+    finally:
+        root.handlers[:], level, disabled, bot.LOG_FILE, bot.LOG_RATE_LIMIT = saved
+        root.setLevel(level)
+        logging.disable(disabled)
+    return results
+
+
+async def bench(args):
+    import bot
+    import telegram
+    from telegram.request import BaseRequest
+
+    if args.log:
+        bot.setup_logging()
+    request = make_request_class(BaseRequest)(args.api_latency / 1000)
+    app = bot.build_application("1:bench", request=request)
+    names = list(SUITES) if "all" in args.suite else list(dict.fromkeys(args.suite))
+    results = {}
+    async with app:
+        await bot.on_startup(app)
+        await bot.subsystem_warm_up.wait()  # Index prêts : les scénarios ne mesurent pas leur construction
+        context = Bench(bot, app, request, args)
+        for name in names:
+            results.update(await SUITES[name][0](context))
+            await settle(bot)
+        await bot.on_stop(app)
+        await bot.on_shutdown(app)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "python_telegram_bot": telegram.__version__,
+            "platform": platform.platform(),
+            "ops": args.ops,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency,
+            "suites": names,
+            "cpus": os.cpu_count(),
+        },
+        "peak_rss_kb": peak_rss_kb(),
+        "scenarios": results,
+    }
+
+
+def compare(previous, current):
+    # Variation de chaque mesure chiffrée présente dans les deux fichiers, par scénario
+    for name, now in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        changes = [
+            f"{key} {100 * (value / before[key] - 1):+7.1f} %"
+            for key, value in now.items()
+            if key != "ops" and isinstance(value, (int, float)) and isinstance(before.get(key), (int, float)) and before[key]
+        ]
+        if changes:
+            print(f"{name:<40} " + "   ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Banc d'essai hors ligne du bot",
+        epilog="Suites : " + "; ".join(f"{name} : {description}" for name, (_, description) in SUITES.items()),
+    )
+    parser.add_argument("--suite", action="append", choices=[*SUITES, "all"], help="Suite à lancer (défaut : handlers)")
+    parser.add_argument("--ops", type=int, default=500, help="Mises à jour par scénario")
+    parser.add_argument("--warmup", type=int, default=50, help="Mises à jour de chauffe par scénario, non mesurées")
+    parser.add_argument("--concurrency", type=int, default=16, help="Mises à jour traitées en parallèle")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Latence simulée de l'API Telegram (ms)")
+    parser.add_argument("--only", action="append", help="Seulement les scénarios contenant ce texte")
+    parser.add_argument("--max-codes", type=int, default=1_000_000, help="redemption : plus grand nombre de codes stockés")
+    parser.add_argument("--redemptions", type=int, default=2000, help="redemption : remises mesurées par taille")
+    parser.add_argument("--codes", type=int, default=1_000_000, help="code_pool : codes émis")
+    parser.add_argument("--users", type=int, default=500, help="loop_lag : utilisateurs simultanés")
+    parser.add_argument("--lag-codes", type=int, default=10_000, help="loop_lag : codes déjà stockés")
+    parser.add_argument("--startup-codes", type=int, default=500_000, help="startup : remises dans remises.json au lancement")
+    parser.add_argument("--worker-api-latency", type=float, default=50, help="workers : latence de la fausse API (ms)")
+    parser.add_argument("--micro-ops", type=int, default=5000, help="Appels par mesure des micro-bancs")
+    parser.add_argument("--rounds", type=int, default=5, help="Tours alternés des micro-bancs (meilleur retenu)")
+    parser.add_argument("--rate", type=float, default=200, help="ingress : mises à jour envoyées par seconde")
+    parser.add_argument("--flood-rate", type=float, default=2000, help="flood : mises à jour/s du compte qui inonde")
+    parser.add_argument("--flood-api-latency", type=float, default=20, help="flood : latence de la fausse API (ms)")
+    parser.add_argument("--deeplink-api-latency", type=float, default=50, help="deeplinks : latence de la fausse API (ms)")
+    parser.add_argument("--api-codes", type=int, default=100_000, help="codes_api : remises servies par l'API")
+    parser.add_argument("--api-requests", type=int, default=5000, help="codes_api : requêtes GET (POST : un dixième)")
+    parser.add_argument("--api-batch", type=int, default=100, help="codes_api : codes par POST /codes/validate")
+    parser.add_argument("--sync-rows", type=int, default=2000, help="sync : codes mis en file")
+    parser.add_argument("--sync-latency", type=float, default=10, help="sync : latence du faux Supabase (ms)")
+    parser.add_argument("--broadcast-subscribers", type=int, default=300, help="broadcast : abonnés de la campagne")
+    parser.add_argument("--broadcast-interactive-rate", type=float, default=5, help="broadcast : /start par seconde")
+    parser.add_argument("--broadcast-idle-seconds", type=float, default=3, help="broadcast : mesure sans diffusion (s)")
+    parser.add_argument("--books-rows", type=int, default=200, help="books : livres publiés dans le faux Supabase")
+    parser.add_argument("--books-rate", type=float, default=500, help="books : affichages/s de la page livres")
+    parser.add_argument("--books-seconds", type=float, default=10, help="books : durée de la mesure (s)")
+    parser.add_argument("--books-max-age", type=float, default=2, help="books : BOOKS_MAX_AGE de la mesure (s)")
+    parser.add_argument("--books-api-latency", type=float, default=50, help="books : latence du faux Supabase (ms)")
+    parser.add_argument("--log-rate", type=float, default=1000, help="logging : mises à jour/s")
+    parser.add_argument("--log-seconds", type=float, default=5, help="logging : durée de chaque mesure (s)")
+    parser.add_argument("--replay", help="ingress : mises à jour enregistrées (une Update JSON par ligne)")
+    parser.add_argument("--log", action="store_true", help="Garde les logs INFO du bot (fichier bot.log) pour mesurer leur coût")
+    parser.add_argument("--trace-memory", action="store_true", help="Pic de mémoire Python par scénario (plus lent)")
+    parser.add_argument("--output", help="Fichier JSON des résultats (défaut : sortie standard)")
+    parser.add_argument("--compare", help="Résultats JSON d'un commit précédent")
+    args = parser.parse_args()
+    args.suite = args.suite or ["handlers"]
+
+    workdir = tempfile.mkdtemp(prefix="seshat-bench-")
+    os.chdir(workdir)
+    # Avant l'import de bot : configuration lue au chargement du module
+    # (valeurs vides plutôt qu'absentes : load_dotenv ne remplace pas une variable déjà définie)
+    os.environ.update({
+        "TELEGRAM_TOKEN": "1:bench",
+        "ANALYTICS_FILE": os.path.join(workdir, "analytics.bin"),
+        "THROTTLE_MAX_PENDING": str(max(args.concurrency * 4, 256)),
+        "SUPABASE_URL": "",
+        "NEXT_PUBLIC_SUPABASE_URL": "",
+        "BOT_WORKERS": "1",
+        "LOG_FILE": os.path.join(workdir, "bot.log"),
+        "CODES_API_KEY": "bench-codes-api-key",  # Routes /codes/… exposées (suite codes_api)
+    })
+    sys.path.insert(0, ROOT)
+    if not args.log:
+        logging.disable(logging.WARNING)
+
+    results = asyncio.run(bench(args))
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    print(f"Files written to {workdir}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,346 @@
 # ─── Standard Library ─────────────────────────────
 import os
+import re
+import csv
+import glob
 import json
 import random
+import secrets
 import string
 import logging
-from datetime import datetime, timedelta
+import logging.handlers
+import atexit
+import signal
+import sqlite3
+import hashlib
+import hmac
+import html
+import heapq
+import functools
+import math
+import shutil
+import unicodedata
+import argparse
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Queue
+from types import MappingProxyType
+from datetime import datetime, timedelta, timezone
 import asyncio  # Needed for nested event loop
+import bisect
 
 # ─── Fix for Windows / VS Code Async Loop ────────
 
 # ─── Third-Party Libraries ────────────────────────
 from dotenv import load_dotenv
+import httpx  # Dépendance de python-telegram-bot
+import tornado.web  # Installé par python-telegram-bot[webhooks]
+
+load_dotenv()  # Avant toute lecture de configuration par os.getenv
 
 # ─── Telegram Bot API ─────────────────────────────
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    ApplicationHandlerStop,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 
 
-# ─── Enable logging (optional but helpful) ────
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-
-# ─── Command handler ──────────────────────────
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        text=(
-            "🏠 <b>Menu Principal :</b>\n\n"
-            "Choisissez une option ci-dessous :"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=main_menu()
-    )
+# ─── Metrics ──────────────────────────────────────
+# Compteurs et histogrammes en mémoire, exposés au format texte Prometheus sur /metrics.
+# Chaque handler enregistré dans setup_handlers est chronométré, ainsi que chaque appel
+# sortant vers l'API Telegram (voir InstrumentedRequest).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            self.counts[i] += 1  # au-delà du dernier palier, seul +Inf (= count) compte
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.help = {}
+        self.counters = defaultdict(float)  # (name, labels) -> valeur
+        self.histograms = {}                # (name, labels) -> Histogram
+        self.gauges = {}                    # name -> fonction appelée au moment du scrape
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        self.counters[(name, labels)] += value
+
+    def histogram(self, name, labels):
+        # Histogram d'une série, créé au premier appel : à garder sous la main sur les chemins
+        # chauds plutôt que de le rechercher à chaque mesure
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        return histogram
+
+    def observe(self, name, labels, value):
+        self.histogram(name, labels).observe(value)
+
+    def gauge(self, name, text, read):
+        self.describe(name, "gauge", text)
+        self.gauges[name] = read
+
+    def samples(self, extra_labels=()):
+        # name -> lignes d'échantillons ; extra_labels est ajouté à chaque série (worker="2")
+        samples = defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            samples[name].append(f"{name}{format_labels(extra_labels + labels)} {value:g}")
+        for (name, labels), histogram in self.histograms.items():
+            labels = extra_labels + labels
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                samples[name].append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+            samples[name].append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            samples[name].append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+            samples[name].append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for name, read in self.gauges.items():
+            samples[name].append(f"{name}{format_labels(extra_labels)} {read():g}")
+        return samples
+
+    def render(self, snapshots=()):
+        # snapshots : samples() d'autres processus (workers), fusionnés famille par famille :
+        # HELP et TYPE n'apparaissent qu'une fois par nom, comme l'exige le format texte
+        samples = self.samples()
+        for snapshot in snapshots:
+            for name, name_samples in snapshot.items():
+                samples[name].extend(name_samples)
+
+        lines = []
+        for name, name_samples in samples.items():
+            kind, text = self.help.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(name_samples)
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_duration_seconds", "histogram", "Durée de traitement par handler")
+metrics.describe("bot_handler_errors_total", "counter", "Exceptions levées par handler")
+metrics.describe("bot_api_request_duration_seconds", "histogram", "Durée des appels sortants à l'API Telegram")
+metrics.describe("bot_api_errors_total", "counter", "Appels à l'API Telegram en échec")
+
+
+def handler_series(name):
+    # (labels, Histogram) d'un handler, à résoudre une fois, pas à chaque mise à jour
+    labels = (("handler", name),)
+    return labels, metrics.histogram("bot_handler_duration_seconds", labels)
+
+
+async def call_instrumented(series, callback, update, context):
+    labels, histogram = series
+    started = time.perf_counter()
+    try:
+        return await callback(update, context)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+def instrumented(name, callback):
+    # Même mesure que call_instrumented, sans l'appel intermédiaire
+    labels, histogram = handler_series(name)
+
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    _series = {}  # url -> (labels, Histogram), une entrée par méthode de l'API
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        series = self._series.get(url)
+        if series is None:
+            labels = (("method", url.rsplit("/", 1)[-1]),)
+            series = self._series[url] = (labels, metrics.histogram("bot_api_request_duration_seconds", labels))
+        telegram_rate.take()  # Compte dans le débit global partagé avec les diffusions
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data=request_data, **kwargs)
+        except Exception:
+            metrics.inc("bot_api_errors_total", series[0])
+            raise
+        finally:
+            series[1].observe(time.perf_counter() - started)
+
+
+# ─── Logging ──────────────────────────────────────
+# Les écritures (stderr ou LOG_FILE) se font dans le thread d'un QueueListener : la boucle ne
+# fait que déposer l'enregistrement dans une file. Le message n'est composé (%s + args) qu'au
+# moment de l'écriture, dans ce thread : d'où logging.info("... %s", x) plutôt qu'une f-string,
+# et des arguments qui ne changent plus après l'appel (ids, compteurs, chaînes).
+# Sortie en lignes JSON compactes ; LOG_FORMAT=text redonne l'ancien format lisible.
+# setup_logging() n'est appelé que par les points d'entrée (bot lancé, worker) : un module qui
+# importe bot (bench.py, tests, sous-commande deeplinks) garde sa propre configuration.
+# Événements bruyants : un appel peut porter extra={"event": "start"}, sinon l'événement est
+# le nom du logger (httpx…). Par événement :
+#   LOG_SAMPLE="start=0.1"       n'écrit qu'une fraction des enregistrements
+#   LOG_RATE_LIMIT="start=10"    au plus N enregistrements par seconde
+# Les WARNING et au-delà passent toujours. Le nombre d'enregistrements écartés depuis le
+# dernier écrit est joint à celui-ci (champ « dropped »).
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_FILE = os.getenv("LOG_FILE")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+metrics.describe("bot_log_dropped_total", "counter", "Enregistrements de log écartés, par événement et raison")
+
+
+def parse_log_rates(value):
+    # "start=0.1,httpx=5" -> {"start": 0.1, "httpx": 5.0}
+    rates = {}
+    for item in value.split(","):
+        event, _, rate = item.partition("=")
+        if event.strip() and rate.strip():
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+LOG_SAMPLE = parse_log_rates(os.getenv("LOG_SAMPLE", ""))
+LOG_RATE_LIMIT = parse_log_rates(os.getenv("LOG_RATE_LIMIT", "start=10,httpx=20"))
+# Attributs propres à tout LogRecord : le reste vient de extra= et part dans la ligne JSON
+LOG_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def log_event(record):
+    return getattr(record, "event", record.name)
+
+
+class LogSampler(logging.Filter):
+    # Appelé sur le thread qui logue, avant la mise en file : doit rester bon marché
+    def __init__(self, sample, rate_limit):
+        super().__init__()
+        self.sample = sample
+        self.rate_limit = rate_limit
+        self._buckets = {}  # événement -> TokenBucket, créé au premier enregistrement
+        self._dropped = defaultdict(int)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        event = log_event(record)
+        reason = None
+        rate = self.sample.get(event)
+        if rate is not None and random.random() >= rate:
+            reason = "sampled"
+        elif event in self.rate_limit:
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = self._buckets[event] = TokenBucket(self.rate_limit[event])
+            if not bucket.try_take():
+                reason = "rate_limited"
+        if reason is not None:
+            self._dropped[event] += 1
+            metrics.inc("bot_log_dropped_total", (("event", event), ("reason", reason)))
+            return False
+        dropped = self._dropped.pop(event, 0)
+        if dropped:
+            record.dropped = dropped
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # QueueHandler.prepare formaterait le message sur le thread appelant : l'enregistrement
+        # part tel quel, le listener le formate
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            # Sortie bloquée (disque plein, pipe non lu) : perdre des lignes plutôt que la boucle
+            metrics.inc("bot_log_dropped_total", (("event", log_event(record)), ("reason", "queue_full")))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.processName != "MainProcess":
+            line["process"] = record.processName  # bot-worker-N en mode multi-worker
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_FIELDS:
+                line[key] = value
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def setup_logging():
+    # Pas de thread dans les sorties : pas de lecture du thread à chaque appel (cf.
+    # « Optimization » du Logging HOWTO)
+    logging.logThreads = False
+    output = logging.FileHandler(LOG_FILE, encoding="utf-8") if LOG_FILE else logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    handler = LazyQueueHandler(Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(LogSampler(LOG_SAMPLE, LOG_RATE_LIMIT))
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [handler]
+    listener.start()
+    atexit.register(listener.stop)  # Vide la file avant la sortie du processus
+    return listener
 
 
 # ─── Build the application ────────────────────
@@ -49,793 +348,2808 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Handlers are added after the app is created in the setup_handlers function.
 
 
-def generate_discount_code():
-    prefixes = ["ASU", "TEMPLE", "INITIÉ", "SAGESSE", "ÉCLAT", "LUMIÈRE", "HARMONIE", "ARCANE"]
-    prefix = random.choice(prefixes)
-    suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-    return f"{prefix}-{suffix}"
+# ─── Discount Code Storage ────────────────────────
+# remises.json reste le snapshot complet (même format qu'avant : user_id -> {code, expiration}).
+# Chaque écriture est ajoutée en une ligne à remises.json.journal ; le journal est rejoué
+# au démarrage et fusionné dans un nouveau snapshot toutes les COMPACT_EVERY écritures, ou
+# tous les len(store) / 4 si c'est plus : réécrire le snapshot coûte O(taille), pas plus d'une
+# fois par quart du volume écrit. Le snapshot est écrit par son propre thread : le journal est
+# d'abord renommé en .journal.old, les nouvelles lignes partent dans un journal neuf, et une
+# remise n'attend jamais la réécriture du fichier complet.
+
+# Les écritures disque ne se font jamais dans la boucle d'événements : les lignes sont
+# regroupées par tour de boucle puis écrites par un thread dédié (un seul, pour garder l'ordre).
 
 DISCOUNT_FILE = "remises.json"
+COMPACT_EVERY = int(os.getenv("REMISES_COMPACT_EVERY", "1000"))
+STORAGE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+COMPACTION_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+
+# Avec BOT_WORKERS > 1, un processus frontal reçoit le webhook et répartit les mises à jour
+# entre BOT_WORKERS processus selon l'id utilisateur (voir « Multi-Worker Mode »). Les données
+# lues par plusieurs processus (remises, abonnés, campagnes) passent alors par une base SQLite
+# en mode WAL au lieu des fichiers JSON : lectures concurrentes, un seul écrivain à la fois.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WORKER_INDEX = int(os.environ["BOT_WORKER_INDEX"]) if "BOT_WORKER_INDEX" in os.environ else None
+STORE_BACKEND = os.getenv("STORE_BACKEND") or ("sqlite" if BOT_WORKERS > 1 else "journal")
+STORE_DB_FILE = os.getenv("STORE_DB_FILE", "bot.sqlite3")
+
+if BOT_WORKERS > 1 and STORE_BACKEND != "sqlite":
+    raise RuntimeError("BOT_WORKERS > 1 requires STORE_BACKEND=sqlite (JSON journals are single-process)")
+
+
+def owns_user(user_id):
+    # Vrai si les mises à jour de cet utilisateur sont traitées par ce processus
+    return WORKER_INDEX is None or int(user_id) % BOT_WORKERS == WORKER_INDEX
+
+
+def worker_path(path):
+    # Fichier propre au worker, pour les données qui ne concernent que ses utilisateurs
+    if WORKER_INDEX is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{WORKER_INDEX}{ext}"
+
+
+class BufferedStore:
+    # Tampon commun aux deux backends : les écritures d'un même tour de boucle sont
+    # regroupées puis appliquées d'un bloc par STORAGE_EXECUTOR
+    loaded = True  # JournalStore : False tant que son fichier n'a pas été lu (load)
+
+    def __init__(self):
+        self._buffer = []
+        self._flush_task = None
+        # Écritures numérotées dans l'ordre : flush() n'attend que le lot qui contient les
+        # siennes, pas ceux que d'autres handlers ajoutent pendant qu'il attend
+        self._queued = 0  # écritures demandées
+        self._saved = 0  # écritures sur le disque
+        self._waiters = []  # (numéro d'écriture attendu, future)
+
+    def load(self):
+        pass  # Rien à lire d'avance (SQLite) ; JournalStore lit ici son snapshot et son journal
+
+    def _append(self, key, value):
+        self._buffer.append(self._encode(key, value))
+        self._queued += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Hors boucle d'événements (démarrage, scripts) : écriture directe
+            batch, self._buffer = self._buffer, []
+            self._write(batch, self._prepare(batch))
+            self._written(batch)
+            self._saved = self._queued
+            return
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        # Laisse les autres handlers du même tour de boucle ajouter leurs écritures :
+        # toutes les écritures concurrentes partent en un seul bloc dans le thread disque
+        await asyncio.sleep(0)
+        loop = asyncio.get_running_loop()
+        try:
+            while self._buffer:
+                batch, self._buffer = self._buffer, []
+                try:
+                    await loop.run_in_executor(STORAGE_EXECUTOR, self._write, batch, self._prepare(batch))
+                except (OSError, sqlite3.Error):
+                    logging.exception("Write failed for %s, will retry with the next write", self.path)
+                    self._buffer[:0] = batch
+                    break
+                self._written(batch)
+                self._saved += len(batch)
+                self._wake(self._saved)
+        finally:
+            self._flush_task = None
+            # Après une erreur, les appelants repartent comme avant : le lot reste en tampon
+            self._wake(self._queued)
+
+    def _wake(self, saved):
+        waiting = []
+        for target, waiter in self._waiters:
+            if target > saved:
+                waiting.append((target, waiter))
+            elif not waiter.done():
+                waiter.set_result(None)
+        self._waiters = waiting
+
+    def _prepare(self, batch):
+        # Appelé sur le thread de la boucle, juste avant l'envoi du lot au thread disque
+        return None
+
+    def _written(self, batch):
+        pass
+
+    def request_compaction(self):
+        pass
+
+    async def flush(self):
+        # Attend que les écritures déjà demandées soient sur le disque : au plus le lot en cours
+        # d'écriture puis celui qui contient les dernières, quel que soit le débit qui suit
+        if self._flush_task is None or self._saved >= self._queued:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((self._queued, waiter))
+        await waiter
+
+
+class JournalStore(BufferedStore):
+    def __init__(self, path, compact_every=COMPACT_EVERY, load=True):
+        super().__init__()
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.old_journal_path = path + ".journal.old"  # Journal en cours de fusion dans le snapshot
+        self.compact_every = compact_every
+        self._index = {}
+        self._pending = 0
+        self._pending_before = 0
+        self._compacting = False
+        self._lock = threading.Lock()
+        self.loaded = False
+        if load:
+            self.load()
+
+    def load(self):
+        if not self.loaded:
+            self._load()
+            self.loaded = True
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+        # Un .journal.old restant vient d'une compaction interrompue : il précède le journal courant
+        for journal_path in (self.old_journal_path, self.journal_path):
+            if not os.path.exists(journal_path):
+                continue
+            with open(journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Dernière ligne tronquée (arrêt brutal pendant l'écriture) : on l'ignore
+                        logging.warning("Ligne de journal illisible ignorée dans %s", journal_path)
+                        continue
+                    if record["v"] is None:
+                        self._index.pop(record["k"], None)
+                    else:
+                        self._index[record["k"]] = record["v"]
+                    self._pending += 1
+        if self._pending >= self.compact_every or os.path.exists(self.old_journal_path):
+            self.compact()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        return self._index[key]
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key, default=None):
+        return self._index.get(key, default)
+
+    def items(self):
+        return self._index.items()
+
+    def set(self, key, value):
+        self._index[key] = value
+        self._append(key, value)
+
+    def delete(self, key):
+        if self._index.pop(key, None) is not None:
+            self._append(key, None)
+
+    def _encode(self, key, value):
+        return json.dumps({"k": key, "v": value}, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def _prepare(self, lines):
+        self._pending_before = self._pending  # Rétabli si l'écriture du lot échoue
+        return self._take_snapshot(len(lines))
+
+    def _take_snapshot(self, written):
+        # Copie prise sur le thread de la boucle : cohérente avec les lignes déjà mises en file
+        self._pending += written
+        if self._pending < max(self.compact_every, len(self._index) // 4) or self._compacting:
+            return None
+        self._pending = 0
+        self._compacting = True
+        return dict(self._index)
+
+    def _write(self, lines, snapshot=None):
+        with self._lock:
+            try:
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.writelines(lines)
+                if snapshot is not None:
+                    self._rotate_journal()
+            except OSError:
+                # Le lot est remis en tampon et réessayé (BufferedStore) : compteur et compaction
+                # reviennent à leur état d'avant _prepare, sans compter ses lignes deux fois
+                self._pending = self._pending_before
+                if snapshot is not None:
+                    self._compacting = False
+                raise
+            if snapshot is not None:
+                COMPACTION_EXECUTOR.submit(self._compact_in_background, snapshot)
+
+    def _rotate_journal(self):
+        # Le snapshot contient exactement les lignes écrites jusqu'ici : elles passent dans
+        # .journal.old, supprimé une fois le snapshot en place. Un .journal.old laissé par une
+        # compaction en échec n'est dans aucun snapshot sur disque : le journal lui est ajouté
+        if not os.path.exists(self.old_journal_path):
+            os.replace(self.journal_path, self.old_journal_path)
+            return
+        with open(self.journal_path, "rb") as journal, open(self.old_journal_path, "ab") as old:
+            shutil.copyfileobj(journal, old)
+        os.remove(self.journal_path)
+
+    def _compact_in_background(self, snapshot):
+        try:
+            self._write_snapshot(snapshot)
+            os.remove(self.old_journal_path)
+        except OSError:
+            # Le .journal.old reste et sera rejoué puis fusionné au prochain démarrage
+            logging.exception("Snapshot of %s failed", self.path)
+        finally:
+            self._compacting = False
+
+    def _write_snapshot(self, snapshot):
+        # Snapshot écrit à côté puis renommé : remises.json n'est jamais à moitié écrit
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def request_compaction(self):
+        # Le prochain flush écrira un snapshot complet (ex. après des suppressions en masse)
+        self._pending = max(self._pending, self.compact_every, len(self._index) // 4)
+
+    def compact(self):
+        # Synchrone, hors boucle d'événements (chargement) : tout le journal entre dans le snapshot
+        with self._lock:
+            self._write_snapshot(self._index)
+            # Le snapshot contient tout le journal : on peut le vider
+            open(self.journal_path, "w").close()
+            if os.path.exists(self.old_journal_path):
+                os.remove(self.old_journal_path)
+            self._pending = 0
+
+
+class SqliteStore(BufferedStore):
+    # Même interface que JournalStore, une table clé -> JSON par store. Les lectures vont
+    # à la base (les autres processus y écrivent aussi) ; les écritures pas encore commitées
+    # restent visibles localement via _unsaved, comme avec l'index en mémoire du journal.
+    def __init__(self, path, table):
+        super().__init__()
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        self._unsaved = {}  # clé -> valeur en attente d'écriture (None = suppression)
+        with self._connection() as db:
+            db.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (k TEXT PRIMARY KEY, v TEXT NOT NULL)')
+
+    def _connection(self):
+        # Une connexion par thread : lectures sur la boucle, écritures dans STORAGE_EXECUTOR
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        # Ne compte que les lignes commitées : suffisant pour les métriques et les messages
+        return self._connection().execute(f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+    def get(self, key, default=None):
+        if key in self._unsaved:
+            value = self._unsaved[key]
+            return default if value is None else value
+        row = self._connection().execute(f'SELECT v FROM "{self.table}" WHERE k = ?', (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def items(self):
+        rows = {key: json.loads(value) for key, value in self._connection().execute(f'SELECT k, v FROM "{self.table}"')}
+        for key, value in self._unsaved.items():
+            if value is None:
+                rows.pop(key, None)
+            else:
+                rows[key] = value
+        return rows.items()
+
+    def set(self, key, value):
+        self._unsaved[key] = value
+        self._append(key, value)
+
+    def delete(self, key):
+        self._unsaved[key] = None
+        self._append(key, None)
+
+    def index_field(self, field):
+        # Index d'expression SQLite : find() sur ce champ ne parcourt plus la table
+        with self._connection() as db:
+            db.execute(f"""CREATE INDEX IF NOT EXISTS "{self.table}_{field}" ON "{self.table}" (json_extract(v, '$.{field}'))""")
+
+    def find(self, field, value):
+        # (clé, valeur) dont le champ JSON vaut value, écritures locales en attente comprises
+        for key, pending in self._unsaved.items():
+            if pending is not None and pending.get(field) == value:
+                return key, pending
+        row = self._connection().execute(
+            f"""SELECT k, v FROM "{self.table}" WHERE json_extract(v, '$.{field}') = ?""", (value,)
+        ).fetchone()
+        if row is None or row[0] in self._unsaved:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _encode(self, key, value):
+        return key, value, None if value is None else json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    def _write(self, batch, _=None):
+        # Un lot = une transaction : un seul verrou d'écriture pris pour tout le tour de boucle
+        with self._connection() as db:
+            for key, _, encoded in batch:
+                if encoded is None:
+                    db.execute(f'DELETE FROM "{self.table}" WHERE k = ?', (key,))
+                else:
+                    db.execute(f'INSERT OR REPLACE INTO "{self.table}" (k, v) VALUES (?, ?)', (key, encoded))
+
+    def _written(self, batch):
+        for key, value, _ in batch:
+            # Une écriture plus récente sur la même clé reste en attente
+            if key in self._unsaved and self._unsaved[key] is value:
+                del self._unsaved[key]
+
+
+# Stores ouverts par open_store. En mode journal, leur fichier n'est lu que par load_stores(),
+# une fois le port du webhook ouvert : le health check n'attend pas la lecture de remises.json
+# (plus d'une seconde à 500k codes). Les mises à jour reçues entre-temps attendent dans la file.
+STORES = []
+
+
+def open_store(path):
+    # path : fichier JSON du mode journal ; en SQLite, son nom de base sert de nom de table
+    if STORE_BACKEND != "sqlite":
+        store = JournalStore(path, load=False)
+        STORES.append(store)
+        return store
+    store = SqliteStore(STORE_DB_FILE, os.path.splitext(os.path.basename(path))[0])
+    if os.path.exists(path) and not len(store):
+        # Première bascule vers SQLite : reprise des données du fichier JSON
+        legacy = JournalStore(path)
+        with store._connection() as db:
+            db.executemany(
+                f'INSERT OR IGNORE INTO "{store.table}" (k, v) VALUES (?, ?)',
+                ((key, json.dumps(value, ensure_ascii=False, separators=(",", ":"))) for key, value in legacy.items()),
+            )
+        # À l'import, avant setup_logging : seul un WARNING atteint la sortie par défaut
+        logging.warning("Imported %d entries from %s into %s", len(legacy), path, STORE_DB_FILE)
+    return store
+
+
+async def load_stores():
+    # Dans le thread disque : la boucle répond au health check pendant la lecture
+    loop = asyncio.get_running_loop()
+    for store in STORES:
+        if not store.loaded:
+            await loop.run_in_executor(STORAGE_EXECUTOR, store.load)
+
+
+remises_store = open_store(DISCOUNT_FILE)
+
+
+# ─── Warm-up ──────────────────────────────────────
+# Les index en mémoire (pool de codes, codes -> utilisateurs, échéances, recherche) se
+# construisent par tranches de WARM_UP_CHUNK entrées : après le démarrage, une tâche de fond
+# (SubsystemWarmUp) rend la main à la boucle entre deux tranches, et les mises à jour
+# reçues pendant ce temps sont traitées sans attendre la fin.
+# Un handler qui a besoin d'un index pas encore prêt appelle warm_up(), qui termine le même
+# générateur là où la tâche de fond l'a laissé : le travail n'est jamais fait deux fois.
+# Les entrées du store sont copiées au début (list) : un set/delete entre deux tranches ne
+# casse pas le parcours, et chaque index vérifie déjà ses entrées dans le store à la lecture.
+
+WARM_UP_CHUNK = int(os.getenv("WARM_UP_CHUNK", "5000"))
+
+
+class Warmable:
+    ready = False
+    _steps = None
+
+    def warming(self):
+        # Générateur partagé ; chaque élément produit marque la fin d'une tranche
+        if self._steps is None:
+            self._steps = self._warm_up()
+        return self._steps
+
+    def warm_up(self):
+        if not self.ready:
+            for _ in self.warming():
+                pass
+
+    def _warm_up(self):
+        raise NotImplementedError
+
+
+def chunked(iterable, size=None):
+    # Parcourt iterable en produisant None toutes les size entrées (fin de tranche)
+    size = size or WARM_UP_CHUNK
+    for i, item in enumerate(iterable, 1):
+        yield item
+        if i % size == 0:
+            yield None
 
 def load_remises():
-    if os.path.exists(DISCOUNT_FILE):
-        with open(DISCOUNT_FILE, "r") as f:
-            return json.load(f)
-    return {}
+    return remises_store
+
+async def save_remise(user_id, entry):
+    issued_codes.add(entry["code"])
+    remises_store.set(user_id, entry)
+    code_index.add(user_id, entry)
+    await asyncio.gather(issued_codes.flush(), remises_store.flush())
+
+
+class CodeIndex(Warmable):
+    # Index inverse code -> user_id, pour valider un code sans parcourir remises.json.
+    # Comme pour ExpiryIndex, une entrée n'est crue qu'après vérification dans le store :
+    # un code remplacé par un nouveau ou retiré par le balayage disparaît à la lecture,
+    # sans avoir à suivre chaque suppression.
+    # En SQLite (multi-worker), les codes émis par les autres processus ne passent pas par
+    # add() : un code absent de la map est cherché dans la base, via un index d'expression.
+    def __init__(self, store):
+        self.store = store
+        self._users = {}
+
+    def _warm_up(self):
+        for item in chunked(list(self.store.items())):
+            if item is None:
+                yield
+            else:
+                self._users[item[1]["code"]] = item[0]
+        if isinstance(self.store, SqliteStore):
+            self.store.index_field("code")
+        self.ready = True
+
+    def __len__(self):
+        return len(self._users)
+
+    def add(self, user_id, entry):
+        self.warm_up()
+        self._users[entry["code"]] = user_id
+
+    def lookup(self, code):
+        # (user_id, entry) du code, ou None s'il n'est (plus) attribué
+        self.warm_up()
+        user_id = self._users.get(code)
+        if user_id is not None:
+            entry = self.store.get(user_id)
+            if entry is not None and entry["code"] == code:
+                return user_id, entry
+            del self._users[code]
+        if isinstance(self.store, SqliteStore):
+            found = self.store.find("code", code)
+            if found is not None:
+                self._users[code] = found[0]
+            return found
+        return None
+
+
+code_index = CodeIndex(remises_store)
+
+
+# ─── Discount Code Pool ───────────────────────────
+# Les codes sont tirés d'avance par lots (aléa de `secrets`) et servis par un simple pop().
+# L'espace des codes est petit (8 préfixes × 36^4 suffixes ≈ 13,4 M) : un bitmap de 1,7 Mo
+# suffit pour savoir exactement quels codes sont déjà émis ou réservés, sans faux positif.
+# Quand la réserve passe sous CODE_POOL_LOW_WATERMARK, un nouveau lot est préparé au
+# prochain tour de la boucle d'événements, hors du handler qui a servi le code.
+# Le bitmap n'est construit qu'au démarrage des sous-systèmes (warm_up), après que le bot
+# a commencé à répondre, ou au premier code demandé si celui-ci arrive avant.
+# Un code balayé ou remplacé disparaît de remises : le bitmap est donc construit à partir de
+# remises et de codes_emis.log, registre en ajout seul de tous les codes jamais émis. Un code
+# n'est ainsi jamais réattribué (la table coupons de Supabase garderait son uses_count).
+
+CODE_PREFIXES = ["ASU", "TEMPLE", "INITIÉ", "SAGESSE", "ÉCLAT", "LUMIÈRE", "HARMONIE", "ARCANE"]
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_SUFFIX_LENGTH = 4
+CODE_SPACE_PER_PREFIX = len(CODE_ALPHABET) ** CODE_SUFFIX_LENGTH
+CODE_POOL_BATCH = int(os.getenv("CODE_POOL_BATCH", "1024"))
+CODE_POOL_LOW_WATERMARK = int(os.getenv("CODE_POOL_LOW_WATERMARK", "256"))
+
+# octet -> caractère du suffixe ; les octets >= 252 (= 7 × 36) sont jetés pour éviter le biais modulo
+_SUFFIX_TABLE = bytes(ord(CODE_ALPHABET[b % len(CODE_ALPHABET)]) for b in range(256))
+_SUFFIX_REJECTED = bytes(range(256 - 256 % len(CODE_ALPHABET), 256))
+_PREFIX_INDEX = {prefix: i for i, prefix in enumerate(CODE_PREFIXES)}
+assert 256 % len(CODE_PREFIXES) == 0, "le tirage du préfixe suppose un nombre de préfixes diviseur de 256"
+
+
+def code_slot(code):
+    # Numéro unique du code dans l'espace des codes (None pour un format inconnu)
+    prefix, _, suffix = code.rpartition("-")
+    if prefix not in _PREFIX_INDEX or len(suffix) != CODE_SUFFIX_LENGTH:
+        return None
+    try:
+        return _PREFIX_INDEX[prefix] * CODE_SPACE_PER_PREFIX + int(suffix, 36)
+    except ValueError:
+        return None
+
+
+class CodePool(Warmable):
+    def __init__(self, load_issued_codes, batch_size=CODE_POOL_BATCH, low_watermark=CODE_POOL_LOW_WATERMARK, shard=0, shards=1):
+        self.load_issued_codes = load_issued_codes
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        # En multi-worker, chaque processus ne tire que les codes dont slot % shards == shard :
+        # deux workers ne peuvent jamais émettre le même code, sans coordination entre eux
+        self.shard = shard
+        self.shards = shards
+        self._taken = bytearray((len(CODE_PREFIXES) * CODE_SPACE_PER_PREFIX + 7) // 8)
+        self._taken_count = 0
+        self._pool = []
+        self._refill_scheduled = False
+        self.collisions = 0
+
+    def _warm_up(self):
+        for code in chunked(self.load_issued_codes()):
+            if code is None:
+                yield
+                continue
+            slot = code_slot(code)
+            if slot is not None:
+                self._take(slot)
+        self.ready = True
+        self.refill()
+
+    def _take(self, slot):
+        byte, bit = divmod(slot, 8)
+        if self._taken[byte] >> bit & 1:
+            return False
+        self._taken[byte] |= 1 << bit
+        self._taken_count += 1
+        return True
+
+    def __len__(self):
+        return len(self._pool)
+
+    def refill(self):
+        self._refill_scheduled = False
+        wanted = self.batch_size
+        for _ in range(100):
+            if wanted == 0:
+                break
+            # Tout le lot est tiré en une fois ; translate() fait la conversion en C
+            draws = wanted * self.shards
+            suffixes = secrets.token_bytes(draws * CODE_SUFFIX_LENGTH * 2).translate(_SUFFIX_TABLE, _SUFFIX_REJECTED)
+            prefixes = secrets.token_bytes(draws)
+            for i in range(min(draws, len(suffixes) // CODE_SUFFIX_LENGTH)):
+                code = "{}-{}".format(
+                    CODE_PREFIXES[prefixes[i] % len(CODE_PREFIXES)],
+                    suffixes[i * CODE_SUFFIX_LENGTH:(i + 1) * CODE_SUFFIX_LENGTH].decode("ascii"),
+                )
+                slot = code_slot(code)
+                if slot % self.shards != self.shard:
+                    continue
+                if self._take(slot):
+                    self._pool.append(code)
+                    wanted -= 1
+                    if wanted == 0:
+                        break
+                else:
+                    self.collisions += 1
+        if wanted == 0:
+            return
+        if not self._pool:
+            raise RuntimeError(f"Discount code space exhausted ({self._taken_count} codes taken)")
+        logging.warning("Code pool refill came up short, %d codes left in space", len(CODE_PREFIXES) * CODE_SPACE_PER_PREFIX - self._taken_count)
+
+    def pop(self):
+        self.warm_up()
+        if not self._pool:
+            self.refill()
+        code = self._pool.pop()
+        if len(self._pool) < self.low_watermark and not self._refill_scheduled:
+            self._refill_scheduled = True
+            try:
+                asyncio.get_running_loop().call_soon(self.refill)
+            except RuntimeError:
+                self.refill()
+        return code
+
+
+ISSUED_CODES_FILE = "codes_emis.log"
+
+
+class IssuedCodes(BufferedStore):
+    # Une ligne par code émis, écrite avec la remise. Un fichier par worker (worker_path) ;
+    # la lecture prend ceux de tous les workers, le partage des codes pouvant changer avec
+    # BOT_WORKERS.
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def add(self, code):
+        self._append(code, None)
+
+    def _encode(self, code, _):
+        return code + "\n"
+
+    def _write(self, lines, _=None):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    def backfill(self, codes):
+        # Premier démarrage avec le registre : les codes déjà dans remises y entrent une fois
+        self._write([code + "\n" for code in codes])
+
+    def codes(self):
+        root, ext = os.path.splitext(ISSUED_CODES_FILE)
+        for path in sorted(glob.glob(f"{glob.escape(root)}*{ext}")):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    yield line.rstrip("\n")  # Ligne tronquée par un arrêt brutal : code_slot l'écarte
+
+
+issued_codes = IssuedCodes(worker_path(ISSUED_CODES_FILE))
+
+
+def load_issued_codes():
+    if not os.path.exists(issued_codes.path):
+        issued_codes.backfill(entry["code"] for user_id, entry in remises_store.items() if owns_user(user_id))
+    for _, entry in list(remises_store.items()):
+        yield entry["code"]
+    yield from issued_codes.codes()
+
+
+code_pool = CodePool(
+    load_issued_codes,
+    shard=WORKER_INDEX or 0,
+    shards=BOT_WORKERS if WORKER_INDEX is not None else 1,
+)
+metrics.gauge("bot_discount_codes_stored", "Codes de réduction enregistrés", lambda: len(remises_store))
+metrics.gauge("bot_code_pool_available", "Codes pré-générés disponibles", lambda: len(code_pool))
+metrics.gauge("bot_code_pool_collisions", "Tirages rejetés car déjà émis", lambda: code_pool.collisions)
+metrics.gauge("bot_code_index_entries", "Codes dans l'index inverse code -> utilisateur", lambda: len(code_index))
 
-def save_remises(data):
-    with open(DISCOUNT_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+def generate_discount_code():
+    return code_pool.pop()
+
+# ─── Conversation State ───────────────────────────
+# État de conversation par utilisateur (ex. « awaiting_email » après un clic sur Rabais).
+# Chaque entrée expire après USER_STATE_TTL secondes et le nombre d'entrées est plafonné :
+# au-delà, la plus ancienne est évincée. L'ordre d'insertion est aussi l'ordre d'expiration
+# (TTL fixe), donc la purge ne parcourt que les entrées déjà expirées.
+# Avec USER_STATES_FILE, les états sont journalisés sur disque et survivent à un redémarrage.
+# Un utilisateur est toujours servi par le même worker : chaque worker a son propre fichier.
+
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "3600"))
+USER_STATE_MAX_ENTRIES = int(os.getenv("USER_STATE_MAX_ENTRIES", "10000"))
+USER_STATES_FILE = os.getenv("USER_STATES_FILE")
+
+
+class StateStore:
+    def __init__(self, ttl, max_entries, backend=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self.evictions = 0
+        self.expirations = 0
+        if backend is not None:
+            records = sorted(backend.items(), key=lambda item: item[1]["expires_at"])
+            for key, record in records:
+                self._entries[key] = (record["value"], record["expires_at"])
+            self.purge_expired()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if entry[1] <= time.time():
+            self._drop(key)
+            self.expirations += 1
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires_at)
+        if self.backend is not None:
+            self.backend.set(key, {"value": value, "expires_at": expires_at})
+        self.purge_expired()
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self._drop(key)
+        return value
+
+    def purge_expired(self):
+        now = time.time()
+        while self._entries:
+            key, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._drop(key)
+            self.expirations += 1
+
+    def _drop(self, key):
+        if self._entries.pop(key, None) is not None and self.backend is not None:
+            self.backend.delete(key)
+
+    def stats(self):
+        return {"live": len(self._entries), "evictions": self.evictions, "expirations": self.expirations}
 
-logging.basicConfig(level=logging.INFO)
 
 # To track which users are entering emails
-user_states = {}
-
-# Main button-based menu layout
-def main_menu():
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("📘 Livres", callback_data="fr_Livres"),
-            InlineKeyboardButton("🧘 Cours", callback_data="fr_Cours")
-        ],
-        [
-            InlineKeyboardButton("🌐 Réseaux Sociaux", callback_data="fr_reseaux"),
-            InlineKeyboardButton("🎤 Séminaires", callback_data="fr_Seminaires")
-        ],
-        [
-            InlineKeyboardButton("❓ FAQ", callback_data="fr_FAQ"),
-            InlineKeyboardButton("🎁 Rabais", callback_data="fr_Remise")
-        ],
-        [
-            InlineKeyboardButton("📚 Ressources", callback_data="fr_ressources"),
-            InlineKeyboardButton("👤 ETR Coaching", callback_data="fr_coaching")
-        ],
-        [
-            InlineKeyboardButton("🙏 Faire un don", callback_data="fr_donation")
-        ],
-        [
-            InlineKeyboardButton("💬 Parler à un humain", callback_data="fr_Agent")
-        ]
-    ])
-
-
-def back_to_main_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🏠 Retour au menu principal", callback_data="start_menu")]
-    ])
-
-def ressources_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🎧 Audios", callback_data="ressources_audios")],
-        [InlineKeyboardButton("📰 Articles", callback_data="ressources_articles")],
-        [InlineKeyboardButton("📖 Biographie de Sabatha", callback_data="ressources_bio")],
-        [InlineKeyboardButton("📘 Livres", callback_data="ressources_livres")],
-        [InlineKeyboardButton("🎥 Vidéos", callback_data="ressources_videos")],
-        [InlineKeyboardButton("📌 Références", callback_data="ressources_references")],
-        [InlineKeyboardButton("🔙 Retour", callback_data="start_menu")]
-    ])
-
-def coaching_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔗 En savoir plus", url="https://www.notion.so/ERT-COACHING-1eb63fe03d3780cfbff2c4806d43b6a5?pvs=4")],
-        [InlineKeyboardButton("⚪ Standard", callback_data="coaching_standard")],
-        [InlineKeyboardButton("🟡 Intermédiaire", callback_data="coaching_intermediaire")],
-        [InlineKeyboardButton("🔴 Avancé", callback_data="coaching_avance")],
-        [InlineKeyboardButton("🔙 Retour", callback_data="start_menu")]
-    ])
-
-
-async def handle_ressources_audios(update: Update, context: ContextTypes.DEFAULT_TYPE):
+user_states = StateStore(
+    USER_STATE_TTL,
+    USER_STATE_MAX_ENTRIES,
+    backend=JournalStore(worker_path(USER_STATES_FILE)) if USER_STATES_FILE else None,
+)
+metrics.gauge("bot_user_states_live", "États de conversation en mémoire", lambda: len(user_states))
+metrics.gauge("bot_user_states_evictions", "États évincés faute de place", lambda: user_states.evictions)
+metrics.gauge("bot_user_states_expirations", "États expirés (TTL)", lambda: user_states.expirations)
+
+# ─── Supabase Coupon Sync ─────────────────────────
+# Le checkout du site valide les codes dans la table « coupons » de Supabase.
+# Les codes émis par le bot sont mis en file en mémoire (aucun appel réseau dans les
+# handlers) puis envoyés par lots : upsert groupé dès COUPON_SYNC_BATCH codes en attente,
+# ou toutes les COUPON_SYNC_INTERVAL secondes. Un lot refusé pour une erreur temporaire
+# est retenté avec un backoff exponentiel, puis remis en tête de file. Une clé refusée
+# (401/403) garde aussi le lot en file, sans retenter : il partira une fois la clé corrigée.
+# Les autres 4xx (schéma, contrainte…) sont définitifs : le lot est abandonné et compté à part
+# (bot_coupon_sync_rejected), jamais comme synchronisé.
+
+SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("NEXT_PUBLIC_SUPABASE_URL")
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+COUPON_SYNC_BATCH = int(os.getenv("COUPON_SYNC_BATCH", "100"))
+COUPON_SYNC_INTERVAL = float(os.getenv("COUPON_SYNC_INTERVAL", "5"))
+DISCOUNT_PERCENT = 15
+
+
+class CouponSync:
+    def __init__(self, base_url, api_key, batch_size=COUPON_SYNC_BATCH, interval=COUPON_SYNC_INTERVAL, max_retries=5):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_retries = max_retries
+        self._queue = deque()
+        self._wakeup = None
+        self._client = None
+        self._task = None
+        self.synced = 0
+        self.rejected = 0
+        self.failed_batches = 0
+
+    def enqueue(self, code, expires_at):
+        self._queue.append({
+            "code": code,
+            "discount_percent": DISCOUNT_PERCENT,
+            "max_uses": 1,
+            "expires_at": expires_at.isoformat(),
+            "is_active": True,
+        })
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self):
+        # Un seul client HTTP (connexions keep-alive réutilisées d'un lot à l'autre)
+        self._client = httpx.AsyncClient(
+            base_url=f"{self.base_url}/rest/v1",
+            headers={
+                "apikey": self.api_key,
+                "Authorization": f"Bearer {self.api_key}",
+                "Prefer": "resolution=merge-duplicates,return=minimal",
+            },
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+            timeout=10.0,
+        )
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._client is not None:
+            await self.flush()
+            await self._client.aclose()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self._queue:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            try:
+                result = await self._post(batch)
+            except asyncio.CancelledError:
+                # Arrêt pendant un envoi : le lot est rendu à la file pour le flush final
+                self._queue.extendleft(reversed(batch))
+                raise
+            if result == "synced":
+                self.synced += len(batch)
+            elif result == "rejected":
+                self.rejected += len(batch)
+            else:
+                # Supabase indisponible ou clé refusée : on garde le lot pour le prochain passage
+                self._queue.extendleft(reversed(batch))
+                self.failed_batches += 1
+                return
+
+    async def _post(self, batch):
+        # "synced", "rejected" (4xx définitif), "unauthorized" (401/403) ou "unavailable"
+        for attempt in range(self.max_retries):
+            try:
+                response = await self._client.post("/coupons", params={"on_conflict": "code"}, json=batch)
+                if response.status_code < 300:
+                    return "synced"
+                if response.status_code in (401, 403):
+                    # Clé de service invalide ou révoquée : réessayer tout de suite ne changera rien
+                    logging.error("Coupon sync unauthorized (%s), keeping %d codes queued", response.status_code, len(batch))
+                    return "unauthorized"
+                if response.status_code < 500 and response.status_code != 429:
+                    # Erreur définitive (schéma, contrainte…) : inutile de réessayer ce lot
+                    logging.error("Coupon sync rejected (%s), dropping %d codes: %s", response.status_code, len(batch), response.text)
+                    return "rejected"
+                logging.warning("Coupon sync failed (%s), retrying", response.status_code)
+            except httpx.HTTPError as e:
+                logging.warning("Coupon sync failed (%s), retrying", e)
+            await asyncio.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+        return "unavailable"
+
+
+coupon_sync = CouponSync(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY) if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY else None
+if coupon_sync is not None:
+    metrics.gauge("bot_coupon_sync_queued", "Codes en attente d'envoi à Supabase", lambda: len(coupon_sync._queue))
+    metrics.gauge("bot_coupon_sync_synced", "Codes envoyés à Supabase", lambda: coupon_sync.synced)
+    metrics.gauge("bot_coupon_sync_rejected", "Codes refusés définitivement par Supabase (4xx), non synchronisés", lambda: coupon_sync.rejected)
+    metrics.gauge("bot_coupon_sync_failed_batches", "Lots Supabase remis en file après échec", lambda: coupon_sync.failed_batches)
+
+
+# ─── Content Catalog ──────────────────────────────
+# Toutes les pages statiques (texte HTML + boutons) sont décrites dans pages.json.
+# Le fichier est validé et pré-rendu une seule fois ; le résultat est une map immuable
+# page_id -> Page. Si pages.json change sur le disque, il est rechargé et la nouvelle
+# map remplace l'ancienne d'un seul coup : les mises à jour en cours gardent leur version.
+# Langues : pages.json est la version française et porte la structure (cibles des boutons,
+# liens, parents). locales/<langue>.json ne contient que les textes, page par page, avec les
+# messages dynamiques et les noms de mois. Chaque langue est compilée en sa propre map de Page
+# au chargement, et un bundle qui oublie une page, un bouton ou un message est refusé.
+# Chaque Page porte ses arguments d'envoi prêts à l'emploi (message_kwargs). On retient aussi
+# quelle Page chaque message affiche : un tap qui mènerait au même contenu n'appelle pas
+# editMessageText (Telegram répondrait « message is not modified »).
+
+PAGES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages.json")
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+DEFAULT_LOCALE = "fr"  # Langue de pages.json
+
+Page = namedtuple("Page", ["id", "text", "reply_markup", "parent", "message_kwargs"])
+Bundle = namedtuple("Bundle", ["locale", "pages", "messages", "months"])
+SHOWN_PAGES_TTL = int(os.getenv("SHOWN_PAGES_TTL", "86400"))
+SHOWN_PAGES_MAX_ENTRIES = int(os.getenv("SHOWN_PAGES_MAX_ENTRIES", "20000"))
+
+
+class CatalogError(ValueError):
+    pass
+
+
+def render_button(page_id, button):
+    if set(button) not in ({"text", "callback"}, {"text", "url"}):
+        raise CatalogError(f"{page_id}: bouton invalide {button!r}")
+    if "url" in button:
+        return InlineKeyboardButton(button["text"], url=button["url"])
+    return InlineKeyboardButton(button["text"], callback_data=button["callback"])
+
+
+def compile_catalog(raw, extra_targets=()):
+    specs = raw.get("pages")
+    if not isinstance(specs, dict) or not specs:
+        raise CatalogError("pages.json doit contenir un objet « pages » non vide")
+
+    pages = {}
+    for page_id, spec in specs.items():
+        if not isinstance(spec.get("title"), str):
+            raise CatalogError(f"{page_id}: « title » manquant")
+        body = spec.get("body", "")
+        if isinstance(body, list):
+            body = "\n".join(body)
+        text = f"{spec['title']}\n\n{body}" if body else spec["title"]
+
+        parent = spec.get("parent")
+        if parent is not None and parent not in specs:
+            raise CatalogError(f"{page_id}: page parente inconnue {parent!r}")
+        if "back" in spec and parent is None:
+            raise CatalogError(f"{page_id}: « back » sans « parent »")
+
+        rows = [[render_button(page_id, b) for b in row] for row in spec.get("buttons", [])]
+        for row in spec.get("buttons", []):
+            for button in row:
+                target = button.get("callback")
+                if target is not None and target not in specs and target not in extra_targets:
+                    raise CatalogError(f"{page_id}: le bouton {button['text']!r} mène à {target!r}, qui n'existe pas")
+        if "back" in spec:
+            rows.append([InlineKeyboardButton(spec["back"], callback_data=parent)])
+
+        reply_markup = InlineKeyboardMarkup(rows).to_json() if rows else None
+        message_kwargs = MappingProxyType({"text": text, "parse_mode": ParseMode.HTML, "reply_markup": reply_markup})
+        pages[page_id] = Page(page_id, text, reply_markup, parent, message_kwargs)
+    return MappingProxyType(pages)
+
+
+def translate_pages(locale, specs, texts):
+    # Structure de pages.json, textes du bundle : les deux doivent correspondre exactement
+    missing = sorted(set(specs) - set(texts))
+    if missing:
+        raise CatalogError(f"{locale}: pages non traduites : {', '.join(missing)}")
+    unknown = sorted(set(texts) - set(specs))
+    if unknown:
+        raise CatalogError(f"{locale}: pages absentes de pages.json : {', '.join(unknown)}")
+
+    translated = {}
+    for page_id, spec in specs.items():
+        text = texts[page_id]
+        rows = spec.get("buttons", [])
+        labels = text.get("buttons", [])
+        if [len(row) for row in labels] != [len(row) for row in rows]:
+            raise CatalogError(f"{locale}/{page_id}: les boutons ne correspondent pas à pages.json")
+        if ("back" in text) != ("back" in spec):
+            raise CatalogError(f"{locale}/{page_id}: « back » ne correspond pas à pages.json")
+        translated[page_id] = dict(
+            spec,
+            title=text.get("title"),
+            body=text.get("body", ""),
+            buttons=[[dict(button, text=label) for button, label in zip(row, row_labels)] for row, row_labels in zip(rows, labels)],
+        )
+        if "back" in text:
+            translated[page_id]["back"] = text["back"]
+    return translated
+
+
+def compile_bundle(locale, raw, extra_targets=(), message_keys=None):
+    messages = raw.get("messages")
+    if not isinstance(messages, dict):
+        raise CatalogError(f"{locale}: « messages » manquant")
+    if message_keys is not None and set(messages) != message_keys:
+        raise CatalogError(f"{locale}: messages différents de pages.json : {', '.join(sorted(set(messages) ^ message_keys))}")
+    months = raw.get("months")
+    if not isinstance(months, list) or len(months) != 12:
+        raise CatalogError(f"{locale}: « months » doit lister les 12 mois")
+    return Bundle(locale, compile_catalog(raw, extra_targets), MappingProxyType(messages), tuple(months))
+
+
+def compile_locales(raw, translations, extra_targets=()):
+    base = compile_bundle(DEFAULT_LOCALE, raw, extra_targets)
+    bundles = {DEFAULT_LOCALE: base}
+    for locale, texts in translations.items():
+        pages = translate_pages(locale, raw["pages"], texts.get("pages") or {})
+        bundles[locale] = compile_bundle(locale, dict(texts, pages=pages), extra_targets, set(base.messages))
+    return MappingProxyType(bundles)
+
+
+class ContentCatalog:
+    def __init__(self, path, locales_dir=None, extra_targets=(), check_interval=1.0):
+        self.path = path
+        self.locales_dir = locales_dir
+        self.extra_targets = frozenset(extra_targets)
+        self.check_interval = check_interval
+        self._mtime = None
+        self._next_check = 0.0
+        # Au démarrage, un pages.json ou un bundle invalide doit empêcher le bot de partir
+        self.bundles = self._compile()
+
+    @property
+    def pages(self):
+        return self.bundles[DEFAULT_LOCALE].pages
+
+    def _sources(self):
+        sources = [self.path]
+        if self.locales_dir and os.path.isdir(self.locales_dir):
+            sources += sorted(
+                os.path.join(self.locales_dir, name) for name in os.listdir(self.locales_dir) if name.endswith(".json")
+            )
+        return sources
+
+    def _stamp(self, sources):
+        return tuple((source, os.stat(source).st_mtime_ns) for source in sources)
+
+    def _compile(self):
+        sources = self._sources()
+        self._mtime = self._stamp(sources)
+        with open(self.path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        translations = {}
+        for source in sources[1:]:
+            with open(source, "r", encoding="utf-8") as f:
+                translations[os.path.splitext(os.path.basename(source))[0]] = json.load(f)
+        return compile_locales(raw, translations, self.extra_targets)
+
+    def refresh(self):
+        # Un stat() au plus par check_interval ; un fichier cassé garde l'ancienne version en ligne
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            if self._stamp(self._sources()) == self._mtime:
+                return
+            self.bundles = self._compile()
+            logging.info("pages.json reloaded (%d pages, locales: %s)", len(self.pages), ", ".join(self.bundles))
+        except (OSError, ValueError) as e:
+            logging.error("pages.json reload failed, keeping the previous catalog: %s", e)
+
+    def bundle(self, locale):
+        self.refresh()
+        return self.bundles.get(locale) or self.bundles[DEFAULT_LOCALE]
+
+    def get(self, page_id, locale=DEFAULT_LOCALE):
+        return self.bundle(locale).pages.get(page_id)
+
+    def message(self, locale, key, **fields):
+        # Seuls les champs dynamiques (code, date) sont formatés à la demande
+        template = self.bundle(locale).messages[key]
+        return template.format(**fields) if fields else template
+
+
+# (chat_id, message_id) -> Page affichée. La comparaison se fait par identité : après un
+# rechargement de pages.json, les nouvelles Page ne correspondent plus et le message est réédité.
+shown_pages = StateStore(SHOWN_PAGES_TTL, SHOWN_PAGES_MAX_ENTRIES)
+metrics.describe("bot_page_edits_skipped_total", "counter", "Éditions évitées car le message affiche déjà la page")
+
+
+def shown_page_key(message):
+    return (message.chat_id, message.message_id)
+
+
+# Pages dont le contenu vient d'ailleurs que de pages.json : page_id -> render(page, locale),
+# qui reçoit la page statique (boutons, repli) et renvoie la Page à afficher
+LIVE_PAGES = {}
+
+
+async def show_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page_id):
+    locale = user_locale(update.effective_user)
+    page = catalog.get(page_id, locale)
+    render = LIVE_PAGES.get(page_id)
+    if render is not None:
+        page = render(page, locale)
     query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🎧 <b>Audios - Podcasts Mystiques</b>\n\n"
-            "Écoutez les podcasts du Comte de Sabatha sur des sujets profonds tels que :\n"
-            "• Le Vodou initiatique\n"
-            "• La Franc-maçonnerie ésotérique\n"
-            "• La Kabbale mystique\n"
-            "• La théurgie et l’âme solaire\n\n"
-            "🌐 <a href='https://t.me/+AhhmqZtBhQswNmJh'>Accéder aux podcasts sur Telegram</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
+    if query:
+        await query.answer()
+        key = shown_page_key(query.message) if query.message else None
+        if key is not None and shown_pages.get(key) is page:
+            metrics.inc("bot_page_edits_skipped_total", (("reason", "cached"),))
+            return
+        try:
+            await query.edit_message_text(**page.message_kwargs)
+        except BadRequest as e:
+            # Cache perdu (redémarrage, éviction) alors que le message affiche déjà la page
+            if "not modified" not in e.message:
+                raise
+            metrics.inc("bot_page_edits_skipped_total", (("reason", "not_modified"),))
+        if key is not None:
+            shown_pages.set(key, page)
+    else:
+        message = await update.message.reply_text(**page.message_kwargs)
+        shown_pages.set(shown_page_key(message), page)
 
 
-async def handle_ressources_articles(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "📰 <b>Articles Ésotériques</b>\n\n"
-            "Découvrez une variété d’articles profonds et inspirants rédigés par le Comte de Sabatha. "
-            "Ces textes explorent des thèmes comme l’alchimie spirituelle, la magie opérative, la franc-maçonnerie, "
-            "le symbolisme et bien d'autres mystères sacrés.\n\n"
-            "📚 <a href='https://sabatha.org/category/blog-2/'>Lire les articles sur sabatha.org</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
+async def handle_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    page_id = update.callback_query.data
+    if catalog.get(page_id) is None:
+        logging.warning("Unknown page %r", page_id)
+        await update.callback_query.answer()
+        return
+    await show_page(update, context, page_id)
+
+
+async def handle_faq_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_page(update, context, "fr_FAQ")
+
+
+# ─── FAQ Search ───────────────────────────────────
+# Un message libre (« comment payer ? ») reçoit la page la plus pertinente parmi la FAQ, les
+# cours, les séminaires et le coaching. Index inversé BM25F (titre et corps normalisés chacun
+# par leur propre longueur moyenne, le titre pèse plus) construit une fois par langue et par
+# version du catalogue : chaque posting porte déjà son poids, une recherche n'est plus
+# qu'une somme sur les postings des termes de la question.
+# Normalisation commune à l'index et aux questions : HTML retiré, minuscules, accents
+# supprimés, mots vides ignorés, puis racine grossière (suffixes français courants, y -> i)
+# pour que « payer » et « paiement » se rejoignent.
+# Fautes de frappe : un terme absent de l'index est rapproché des termes à distance
+# d'édition 1 par la méthode des suppressions (chaque terme indexé l'est aussi sous ses
+# variantes privées d'une lettre) : quelques lookups dans un dict, sans parcourir le vocabulaire.
+
+SEARCH_PREFIXES = ("faq_", "fr_Cours", "fr_Seminaires", "fr_coaching", "coaching_")
+SEARCH_MIN_SCORE = float(os.getenv("SEARCH_MIN_SCORE", "1.0"))
+SEARCH_TITLE_BOOST = 3.0  # Un mot du titre compte comme trois mots du corps
+SEARCH_FUZZY_WEIGHT = 0.7  # Poids d'un terme trouvé par correction de faute
+SEARCH_FUZZY_MIN_LENGTH = 4  # En dessous, une lettre de différence change trop le sens
+# Seuls les SEARCH_POSTINGS_LIMIT documents où un terme pèse le plus sont gardés pour ce
+# terme : on ne cherche que la meilleure page, et le coût d'une recherche reste borné
+# quand le corpus grandit.
+SEARCH_POSTINGS_LIMIT = int(os.getenv("SEARCH_POSTINGS_LIMIT", "128"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+STOPWORDS = frozenset("""
+    a ai au aux avec ce ces cet cette comment d de des du elle en est et il ils j je l la le les leur
+    m ma me mes moi mon n ne nos notre nous on ou par pas pour puis qu que quel quelle quels quelles
+    qui quoi s sa se ses si son sur t ta te tes toi ton tu un une vos votre vous y bonjour salut merci
+    an and are can do does for how i in is it me my of on the to what when where you your hello hi thanks
+    ak kijan kisa kote kouman li mwen nan nou pou se sou yo yon bonswa mesi
+""".split())
+SEARCH_SUFFIXES = sorted("""
+    issements issement ements ement ations ation itions ition tions tion ances ance ences ence
+    euses euse eux ables able ibles ible ites ite ives ive ifs if iques ique ismes isme istes iste
+    ments ment ees ee es er ez e s x
+""".split(), key=len, reverse=True)
+HTML_TAG = re.compile(r"<[^>]+>")
+SEARCH_WORD = re.compile(r"[a-z0-9]+")
+metrics.describe("bot_search_total", "counter", "Questions libres, avec ou sans page trouvée")
+
+
+def fold(text):
+    # NFKD sépare les accents des lettres ; tout ce qui n'est pas ASCII (accents, emojis) disparaît
+    return unicodedata.normalize("NFKD", HTML_TAG.sub(" ", text).casefold()).encode("ascii", "ignore").decode()
+
+
+@functools.lru_cache(maxsize=65536)  # Vocabulaire limité : chaque mot n'est racinisé qu'une fois
+def stem(word):
+    word = word.replace("y", "i")
+    for suffix in SEARCH_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def search_terms(text):
+    return [stem(word) for word in SEARCH_WORD.findall(fold(text)) if len(word) > 1 and word not in STOPWORDS]
+
+
+def deletions(term):
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+class SearchIndex:
+    def __init__(self, documents):
+        # documents : [(page_id, titre, corps)]
+        self.page_ids = [page_id for page_id, _, _ in documents]
+        fields = [
+            (Counter(search_terms(title)), Counter(search_terms(body)))
+            for _, title, body in documents
+        ]
+        averages = [
+            max(1.0, sum(sum(doc[field].values()) for doc in fields) / max(1, len(fields)))
+            for field in (0, 1)
+        ]
 
-async def handle_ressources_bio(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "📖 <b>Biographie du Comte de Sabatha :</b>\n\n"
-            "Initié dans plusieurs traditions ésotériques, le Comte de Sabatha est Maître en théurgie, adepte du rite de Memphis-Misraïm, "
-            "et héritier d’une lignée opérative oubliée. Architecte symbolique et enseignant mystique, il transmet l’art sacré de la "
-            "transmutation intérieure et la voie de l’âme solaire.\n\n"
-            "🔗 <a href='https://orcid.org/0009-0008-4649-8808'>Voir la biographie complète sur ORCID</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
+        # Fréquence de chaque terme par document, pondérée et normalisée champ par champ
+        weighted = []
+        for doc in fields:
+            terms = defaultdict(float)
+            for field, boost in ((0, SEARCH_TITLE_BOOST), (1, 1.0)):
+                norm = 1 - BM25_B + BM25_B * sum(doc[field].values()) / averages[field]
+                for term, tf in doc[field].items():
+                    terms[term] += boost * tf / norm
+            weighted.append(terms)
+
+        frequencies = Counter(term for terms in weighted for term in terms)
+        postings = defaultdict(list)
+        for doc, terms in enumerate(weighted):
+            for term, tf in terms.items():
+                idf = math.log(1 + (len(weighted) - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+                postings[term].append((doc, idf * tf * (BM25_K1 + 1) / (tf + BM25_K1)))
+        self.postings = {
+            term: tuple(heapq.nlargest(SEARCH_POSTINGS_LIMIT, entries, key=lambda entry: entry[1]))
+            for term, entries in postings.items()
+        }
+
+        # variante (terme ou terme privé d'une lettre) -> termes indexés
+        self.variants = defaultdict(list)
+        for term in self.postings:
+            if len(term) >= SEARCH_FUZZY_MIN_LENGTH:
+                for variant in deletions(term) | {term}:
+                    self.variants[variant].append(term)
+
+    def expand(self, term):
+        if term in self.postings:
+            return ((term, 1.0),)
+        if len(term) < SEARCH_FUZZY_MIN_LENGTH:
+            return ()
+        # Même terme à une lettre près : lettre en trop, en moins ou remplacée
+        candidates = {match for variant in deletions(term) | {term} for match in self.variants.get(variant, ())}
+        return tuple((match, SEARCH_FUZZY_WEIGHT) for match in candidates)
+
+    def search(self, text):
+        scores = defaultdict(float)
+        for term in set(search_terms(text)):
+            for match, weight in self.expand(term):
+                for doc, score in self.postings[match]:
+                    scores[doc] += weight * score
+        if not scores:
+            return None, 0.0
+        doc = max(scores, key=scores.get)
+        return self.page_ids[doc], scores[doc]
+
+
+class PageSearch(Warmable):
+    # Un index par langue, reconstruit quand le catalogue est rechargé
+    def __init__(self, prefixes=SEARCH_PREFIXES):
+        self.prefixes = prefixes
+        self._indexes = {}  # locale -> (Bundle indexé, SearchIndex)
+
+    def index(self, locale):
+        bundle = catalog.bundle(locale)
+        cached = self._indexes.get(bundle.locale)
+        if cached is None or cached[0] is not bundle:
+            documents = [
+                (page_id, *page.text.partition("\n\n")[::2])
+                for page_id, page in bundle.pages.items() if page_id.startswith(self.prefixes)
+            ]
+            cached = self._indexes[bundle.locale] = (bundle, SearchIndex(documents))
+        return cached[1]
+
+    def _warm_up(self):
+        # Une tranche par langue ; search() construit de toute façon l'index qui lui manque
+        for locale in list(catalog.bundles):
+            self.index(locale)
+            yield
+        self.ready = True
+
+    def search(self, text, locale):
+        page_id, score = self.index(locale).search(text)
+        return page_id if score >= SEARCH_MIN_SCORE else None
+
+
+page_search = PageSearch()
+
+
+async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE, locale):
+    page_id = page_search.search(update.message.text, locale)
+    metrics.inc("bot_search_total", (("result", "hit" if page_id else "miss"),))
+    if page_id is not None:
+        await show_page(update, context, page_id)
+    else:
+        await update.message.reply_text(catalog.message(locale, "search_no_result"), parse_mode=ParseMode.HTML)
 
-async def handle_ressources_videos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🎥 <b>Vidéo : Comment baptiser et nommer un nouveau-né</b>\n\n"
-            "# <i>Et si le prénom de ton enfant était sa première prophétie ?</i>\n\n"
-            "Un séminaire sacré pour choisir un prénom qui vibre avec l’âme de ton enfant.\n"
-            "Une invitation à écouter, ressentir, nommer avec conscience.\n\n"
-            "🕊️ <b>« Donner un nom, c'est appeler une âme à entrer dans une forme. C'est invoquer un destin. »</b>\n"
-            "— Hazrat Inayat Khan, maître soufi et musicien mystique\n\n"
-            "🔗 <a href='https://us02web.zoom.us/rec/share/xwra5bzoL2M5_N5hkOMDXMrWIhWkVfXUa2As932C9Qb7pjOZCQkY-UFIPhjhx1Xk.oQk2UTZCMVK7QuVf'>Voir la vidéo complète</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
 
-async def handle_ressources_references(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "📌 <b>Programme de Références — ASU</b>\n\n"
-            "💡 Partagez la lumière, recevez une bénédiction.\n\n"
-            "Si vous recommandez l’Académie Sapience Universelle à une personne, et que celle-ci s’inscrit à une activité (cours, séminaire, classe…), "
-            "vous recevrez un <b>code de réduction de 15%</b> valable sur toute activité de l’ASU.\n\n"
-            "🌱 Une façon de remercier ceux qui font rayonner notre mission.\n\n"
-            "📞 <b>Contactez la direction :</b>\n"
-            "WhatsApp ou SMS au <b>+1 954 663 8783</b>\n\n"
-            "📝 Merci d’envoyer :\n"
-            "• Le <b>nom complet</b> de la personne que vous avez référée\n"
-            "• L’<b>activité</b> (cours, séminaire, etc.) choisie\n"
-            "• Votre <b>nom ou numéro</b> pour que l’on puisse vous identifier comme parrain\n\n"
-            "✅ Une fois vérifié, vous recevrez votre <b>code promo personnel</b> par message."
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
+# ─── Languages ────────────────────────────────────
+# La langue d'un utilisateur vient de son choix explicite (/langue), sinon du language_code
+# envoyé par Telegram ; les langues sans bundle retombent sur DEFAULT_LOCALE. Le résultat est
+# gardé en cache par utilisateur (le choix explicite peut vivre dans SQLite en multi-worker).
 
-async def handle_coaching_standard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "⚪ <b>ETR Coaching – Niveau Standard</b>\n\n"
-            "Un accompagnement spirituel personnalisé sur 3 semaines, pour explorer tes blocages, t’aligner avec ton chemin intérieur, "
-            "et amorcer ta transformation.\n\n"
-            "🌀 <b>Ce que tu reçois :</b>\n"
-            "• Une semaine de préparation personnalisée\n"
-            "• Analyse mystique + eso-psychologie\n"
-            "• Identification de tes obstacles\n"
-            "• Recommandations pratiques + ajustements comportementaux\n\n"
-            "📲 Contacte la direction de l’ASU pour t’inscrire : +1 954 663 8783"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔗 En savoir plus", url="https://www.notion.so/ERT-COACHING-1eb63fe03d3780cfbff2c4806d43b6a5?pvs=4")],
-            [InlineKeyboardButton("🔙 Retour", callback_data="fr_coaching")]
-        ])
-    )
+LANGUAGES_FILE = "langues.json"
+LOCALE_CACHE_TTL = int(os.getenv("LOCALE_CACHE_TTL", "3600"))
+LOCALE_CACHE_MAX_ENTRIES = int(os.getenv("LOCALE_CACHE_MAX_ENTRIES", "20000"))
 
+user_languages = open_store(LANGUAGES_FILE)
+locale_cache = StateStore(LOCALE_CACHE_TTL, LOCALE_CACHE_MAX_ENTRIES)
 
-async def handle_coaching_intermediaire(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🟡 <b>ETR Coaching – Niveau Intermédiaire</b>\n\n"
-            "Un accompagnement de 6 semaines pour aller plus loin dans ta guérison intérieure, ton équilibre énergétique et ton recentrage spirituel.\n\n"
-            "🔍 <b>Inclus :</b>\n"
-            "• Bilan énergétique + lecture vibratoire\n"
-            "• Outils d’alignement personnalisé (visualisations, purification, rituels simples)\n"
-            "• Suivi hebdomadaire avec ajustements\n\n"
-            "💠 Convient à ceux qui souhaitent transformer durablement leur hygiène émotionnelle et spirituelle.\n\n"
-            "📲 Pour plus d'infos ou inscription : +1 954 663 8783"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔗 En savoir plus", url="https://www.notion.so/ERT-COACHING-1eb63fe03d3780cfbff2c4806d43b6a5?pvs=4")],
-            [InlineKeyboardButton("🔙 Retour", callback_data="fr_coaching")]
-        ])
-    )
 
+def detect_locale(language_code):
+    code = (language_code or "").split("-")[0].lower()
+    return code if code in catalog.bundles else DEFAULT_LOCALE
 
 
-async def handle_coaching_avance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🔴 <b>ETR Coaching – Niveau Avancé</b>\n\n"
-            "Un parcours de 9 semaines conçu pour éveiller ta mémoire solaire, activer ton potentiel initiatique et intégrer ta mission sacrée.\n\n"
-            "🜂 <b>Ce programme inclut :</b>\n"
-            "• Travail de libération karmique\n"
-            "• Activation des 3 corps (émotionnel, vibratoire, solaire)\n"
-            "• Rituels alchimiques hebdomadaires\n"
-            "• Guidance initiatique et transmissions mystiques\n\n"
-            "🌞 Réservé aux chercheurs prêts à transcender leurs limites et à incarner leur feu intérieur.\n\n"
-            "📲 Infos & inscriptions auprès de la direction : +1 954 663 8783"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔗 En savoir plus", url="https://www.notion.so/ERT-COACHING-1eb63fe03d3780cfbff2c4806d43b6a5?pvs=4")],
-            [InlineKeyboardButton("🔙 Retour", callback_data="fr_coaching")]
-        ])
-    )
+def user_locale(user):
+    if user is None:
+        return DEFAULT_LOCALE
+    locale = locale_cache.get(user.id)
+    if locale is None:
+        locale = user_languages.get(str(user.id)) or detect_locale(user.language_code)
+        locale_cache.set(user.id, locale)
+    return locale
 
 
-async def handle_ressources_livres(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "📘 <b>Livre disponible :</b>\n\n"
-            "🔹 <b>ASTRO-TAROLOGIE</b>\n"
-            "<i>Symbolismes, méthodes et applications d’une discipline divinatoire contemporaine.</i>\n\n"
-            "L'ouvrage <b>Astro-Tarologie</b> explore la fusion entre astrologie et tarot. Rédigé par les étudiants de l’Académie Sapience Universelle, "
-            "il propose des bases théoriques solides, des méthodologies pratiques, et une réflexion sur les dimensions psychologiques et spirituelles "
-            "de cette discipline.\n\n"
-            "🔗 <a href='https://www.scribd.com/document/824409798/ASTRO-TAROLOGIE-Symbolisme-methodes-et-applications-d-une-discipline-divinatoire-contemporaine'>Lire le livre sur Scribd</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
+def stored_locale(user_id):
+    # Sans Update (diffusions, rappels) : choix explicite, sinon langue vue au dernier /start
+    subscriber = subscribers_store.get(user_id) or {}
+    return user_languages.get(user_id) or subscriber.get("lang") or DEFAULT_LOCALE
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logging.info(f"Received /start from user {update.effective_user.id}")
+async def handle_language_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    locale = context.args[0].lower() if len(context.args) == 1 else None
+    if locale not in catalog.bundles:
+        await update.message.reply_text(catalog.message(user_locale(user), "language_usage"), parse_mode=ParseMode.HTML)
+        return
+    user_languages.set(str(user.id), locale)
+    locale_cache.pop(user.id)
     await update.message.reply_text(
-        text="👋 <b>Bienvenue chez Seshat Assistant !</b>\n\nVeuillez choisir une option ci-dessous pour commencer :",
-        reply_markup=main_menu(),
-        parse_mode=ParseMode.HTML
+        catalog.message(locale, "language_set"),
+        parse_mode=ParseMode.HTML,
+        reply_markup=catalog.get("start_menu", locale).reply_markup,
     )
 
 
-import os
-import json
+# ─── Book Catalog ─────────────────────────────────
+# La page fr_Livres est construite à partir de la table « books » de Supabase (et des packs
+# de « bundles »), la même que la boutique. Stale-while-revalidate : l'affichage sert toujours
+# la dernière version en mémoire, sans attendre le réseau ; si elle a plus de BOOKS_MAX_AGE
+# secondes, un rafraîchissement part en tâche de fond. Tant que rien n'a pu être chargé
+# (Supabase absent ou en panne au démarrage), c'est la page statique de pages.json.
+# Rafraîchissement :
+# - incrémental : seules les lignes dont updated_at dépasse le dernier filigrane sont lues,
+#   avec If-None-Match sur l'ETag de la réponse précédente (304 : rien à relire) ;
+# - complet toutes les BOOKS_FULL_REFRESH_INTERVAL secondes : livres supprimés et packs
+#   (la table bundles n'a pas de updated_at).
+# Le texte de chaque langue est recomposé une fois par version du catalogue, pas par affichage.
+
+BOOKS_PAGE = "fr_Livres"
+BOOKS_MAX_AGE = float(os.getenv("BOOKS_MAX_AGE", "300"))
+BOOKS_FULL_REFRESH_INTERVAL = float(os.getenv("BOOKS_FULL_REFRESH_INTERVAL", "3600"))
+BOOKS_RETRY_INTERVAL = float(os.getenv("BOOKS_RETRY_INTERVAL", "60"))
+BOOKS_MAX_ITEMS = int(os.getenv("BOOKS_MAX_ITEMS", "12"))
+# updated_at vaut NOW() au début de la transaction : une écriture validée tardivement peut
+# porter une date antérieure au filigrane. On relit donc une petite fenêtre en arrière.
+BOOKS_WATERMARK_OVERLAP = timedelta(seconds=60)
+SITE_URL = os.getenv("SITE_URL", "https://www.cdslibrairie.com").rstrip("/")
+BOOK_COLUMNS = "id,title,author,short_description,key_benefits,is_featured,is_published,created_at,updated_at"
+MESSAGE_MAX_LENGTH = 4096  # Limite de Telegram pour un texte de message
+metrics.describe("bot_books_cache_total", "counter", "Affichages de la page livres par état du cache")
+metrics.describe("bot_books_refresh_total", "counter", "Rafraîchissements du catalogue de livres par résultat")
+metrics.describe("bot_books_refresh_duration_seconds", "histogram", "Durée d'un rafraîchissement du catalogue de livres")
+
+
+class BookCatalog:
+    def __init__(self, base_url, api_key, max_age=BOOKS_MAX_AGE, full_refresh_interval=BOOKS_FULL_REFRESH_INTERVAL,
+                 retry_interval=BOOKS_RETRY_INTERVAL):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.max_age = max_age
+        self.full_refresh_interval = full_refresh_interval
+        self.retry_interval = retry_interval
+        self.books = {}  # id -> ligne publiée
+        self.bundles = []
+        self.watermark = None  # updated_at le plus récent déjà lu
+        self.version = 0  # Incrémenté à chaque changement visible
+        self.loaded_at = None  # Dernier rafraîchissement réussi (monotonic)
+        self.full_loaded_at = None
+        self._etag = None  # (paramètres, ETag) de la dernière lecture incrémentale
+        self._last_attempt = float("-inf")
+        self._pages = {}  # locale -> (page statique, version, Page rendue)
+        self._client = None
+        self._refresh_task = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(
+            base_url=f"{self.base_url}/rest/v1",
+            headers={"apikey": self.api_key, "Authorization": f"Bearer {self.api_key}"},
+            limits=httpx.Limits(max_connections=2, max_keepalive_connections=2),
+            timeout=10.0,
+        )
+        self.revalidate()
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+
+    def render(self, static_page, locale):
+        if self.loaded_at is None:
+            metrics.inc("bot_books_cache_total", (("result", "miss"),))
+            self.revalidate()
+            return static_page
+        if time.monotonic() - self.loaded_at > self.max_age:
+            metrics.inc("bot_books_cache_total", (("result", "stale"),))
+            self.revalidate()
+        else:
+            metrics.inc("bot_books_cache_total", (("result", "hit"),))
+        cached = self._pages.get(locale)
+        if cached is None or cached[0] is not static_page or cached[1] != self.version:
+            cached = (static_page, self.version, self._build_page(static_page, locale))
+            self._pages[locale] = cached
+        return cached[2]
+
+    def revalidate(self):
+        # Au plus un rafraîchissement à la fois, et pas plus d'un essai par retry_interval
+        if self._client is None or self._refresh_task is not None:
+            return
+        now = time.monotonic()
+        if now - self._last_attempt < self.retry_interval:
+            return
+        self._last_attempt = now
+        self._refresh_task = asyncio.get_running_loop().create_task(self.refresh())
+        self._refresh_task.add_done_callback(self._refreshed)
+
+    def _refreshed(self, task):
+        self._refresh_task = None
+
+    async def refresh(self):
+        started = time.perf_counter()
+        full = self.full_loaded_at is None or time.monotonic() - self.full_loaded_at > self.full_refresh_interval
+        try:
+            result = await (self._full_refresh() if full else self._incremental_refresh())
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            # Supabase lent ou en panne : on continue de servir la dernière version
+            logging.warning("Book catalog refresh failed: %s", e)
+            result = "error"
+        else:
+            self.loaded_at = time.monotonic()
+        metrics.inc("bot_books_refresh_total", (("result", result),))
+        metrics.observe("bot_books_refresh_duration_seconds", (("mode", "full" if full else "incremental"),), time.perf_counter() - started)
+
+    async def _get(self, path, params, etag=None):
+        headers = {"If-None-Match": etag} if etag else None
+        response = await self._client.get(path, params=params, headers=headers)
+        if response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+        return response.json(), response.headers.get("ETag")
+
+    async def _full_refresh(self):
+        rows, _ = await self._get("/books", {"select": BOOK_COLUMNS, "is_published": "eq.true"})
+        try:
+            bundles, _ = await self._get("/bundles", {"select": "title,slug,book_ids", "is_published": "eq.true", "order": "created_at.desc"})
+        except httpx.HTTPStatusError as e:
+            # supabase_bundles.sql pas encore appliqué : catalogue sans packs
+            if e.response.status_code != 404:
+                raise
+            bundles = []
+        books = {row["id"]: row for row in rows}
+        changed = books != self.books or bundles != self.bundles
+        self.books, self.bundles = books, bundles
+        self.watermark = max((row["updated_at"] for row in rows), key=datetime.fromisoformat, default=None)
+        self._etag = None
+        self.full_loaded_at = time.monotonic()
+        if changed:
+            self.version += 1
+        return "changed" if changed else "unchanged"
+
+    async def _incremental_refresh(self):
+        params = {"select": BOOK_COLUMNS, "order": "updated_at.asc"}
+        if self.watermark is not None:
+            since = datetime.fromisoformat(self.watermark) - BOOKS_WATERMARK_OVERLAP
+            params["updated_at"] = f"gte.{since.isoformat()}"
+        etag = self._etag[1] if self._etag is not None and self._etag[0] == params else None
+        rows, new_etag = await self._get("/books", params, etag)
+        self._etag = (params, new_etag) if new_etag else None
+        if rows is None:
+            return "not_modified"
+        changed = False
+        for row in rows:
+            # Les lignes dépubliées arrivent aussi (clé de service) : elles sortent du catalogue
+            if not row["is_published"]:
+                changed |= self.books.pop(row["id"], None) is not None
+            elif self.books.get(row["id"]) != row:
+                self.books[row["id"]] = row
+                changed = True
+        if rows:
+            self.watermark = max([row["updated_at"] for row in rows] + ([self.watermark] if self.watermark else []), key=datetime.fromisoformat)
+        if changed:
+            self.version += 1
+        return "changed" if changed else "unchanged"
+
+    def _build_page(self, static_page, locale):
+        # Mis en avant d'abord, puis du plus récent au plus ancien ; le message reste sous la
+        # limite de Telegram, le reste est accessible par le lien vers la boutique
+        books = sorted(self.books.values(), key=lambda row: row["created_at"], reverse=True)
+        books.sort(key=lambda row: not row["is_featured"])
+        blocks = [catalog.message(locale, "books_title")]
+        for row in books[:BOOKS_MAX_ITEMS]:
+            lines = [f"📘 <b>{html.escape(row['title'])}</b> — {html.escape(row['author'])}"]
+            if row.get("short_description"):
+                lines.append(f"<i>{html.escape(row['short_description'])}</i>")
+            lines.extend(f"• {html.escape(benefit)}" for benefit in (row.get("key_benefits") or [])[:3])
+            lines.append(catalog.message(locale, "book_link", url=f"{SITE_URL}/livre/{row['id']}"))
+            blocks.append("\n".join(lines))
+        if self.bundles:
+            blocks.append(catalog.message(locale, "bundles_title"))
+            for bundle in self.bundles[:BOOKS_MAX_ITEMS]:
+                blocks.append(f"📦 <b>{html.escape(bundle['title'])}</b>\n" + catalog.message(
+                    locale, "bundle_link", url=f"{SITE_URL}/packs/{bundle['slug']}", count=len(bundle["book_ids"])))
+        more = catalog.message(locale, "books_more", url=f"{SITE_URL}/boutique")
+        text = ""
+        for block in blocks:
+            candidate = f"{text}\n\n{block}" if text else block
+            if len(candidate) + len(more) + 2 > MESSAGE_MAX_LENGTH:
+                break
+            text = candidate
+        text = f"{text}\n\n{more}"
+        message_kwargs = MappingProxyType(dict(static_page.message_kwargs, text=text))
+        return static_page._replace(text=text, message_kwargs=message_kwargs)
+
+
+book_catalog = BookCatalog(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY) if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY else None
+if book_catalog is not None:
+    LIVE_PAGES[BOOKS_PAGE] = book_catalog.render
+    metrics.gauge("bot_books_cached", "Livres publiés dans le cache", lambda: len(book_catalog.books))
+
+
+# ─── Broadcasts ───────────────────────────────────
+# Envois groupés (nouveau séminaire, rappels…) sans dépasser les ~30 msg/s de Telegram.
+# Tous les appels sortants passent par un seau à jetons commun (voir InstrumentedRequest) :
+# les réponses interactives prennent leur jeton sans jamais attendre, tandis que les envois
+# groupés attendent qu'il reste au moins BROADCAST_RESERVE jetons. Les utilisateurs qui
+# cliquent gardent donc la priorité pendant une campagne.
+# L'avancement d'une campagne (dernier destinataire servi) est journalisé : après un
+# redémarrage, elle reprend là où elle s'était arrêtée.
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+BROADCAST_RESERVE = float(os.getenv("BROADCAST_RESERVE", "5"))
+BROADCAST_CHECKPOINT_EVERY = 50
+ADMIN_USER_IDS = {i.strip() for i in os.getenv("ADMIN_USER_IDS", "").split(",") if i.strip()}
+SUBSCRIBERS_FILE = "abonnes.json"
+CAMPAIGNS_FILE = "campagnes.json"
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # Trafic interactif : jamais d'attente, le solde peut devenir négatif
+        self._refill()
+        self.tokens -= 1
+
+    def try_take(self):
+        # Sans attente ni dette : False si aucun jeton n'est libre
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def wait_for(self, reserve):
+        # Trafic groupé : attend qu'un jeton soit libre au-delà de la réserve
+        while True:
+            self._refill()
+            missing = reserve + 1 - self.tokens
+            if missing <= 0:
+                return
+            await asyncio.sleep(missing / self.rate)
+
+
+# Chaque worker a son seau : le débit global est partagé à parts égales
+telegram_rate = TokenBucket(TELEGRAM_GLOBAL_RATE / BOT_WORKERS)
+subscribers_store = open_store(SUBSCRIBERS_FILE)
+campaigns_store = open_store(CAMPAIGNS_FILE)
+
+
+class Broadcaster:
+    def __init__(self, bucket, subscribers, campaigns, reserve=BROADCAST_RESERVE):
+        self.bucket = bucket
+        self.subscribers = subscribers
+        self.campaigns = campaigns
+        self.reserve = reserve
+        self.bot = None
+        self._tasks = {}
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, bot):
+        self.bot = bot
+        for campaign_id, campaign in list(self.campaigns.items()):
+            # Une campagne n'est reprise que par le worker qui l'a lancée
+            if campaign["status"] == "running" and campaign.get("owner", 0) == (WORKER_INDEX or 0):
+                logging.info("Resuming campaign %s after user %s", campaign_id, campaign["cursor"])
+                self._spawn(campaign_id)
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        await self.campaigns.flush()
+
+    def start_campaign(self, page_id):
+        campaign_id = f"{int(time.time())}-{page_id}"
+        self.campaigns.set(campaign_id, {
+            "page": page_id,
+            "created_at": int(time.time()),
+            "cursor": 0,
+            "sent": 0,
+            "failed": 0,
+            "status": "running",
+            "owner": WORKER_INDEX or 0,
+        })
+        self._spawn(campaign_id)
+        return campaign_id
+
+    def recipients(self, campaign):
+        # Ordre stable (id croissant) : le curseur suffit pour reprendre sans doublon
+        return sorted(
+            int(user_id) for user_id, info in self.subscribers.items()
+            if info["since"] <= campaign["created_at"] and int(user_id) > campaign["cursor"]
+        )
 
-DISCOUNT_FILE = "remises.json"
+    def _spawn(self, campaign_id):
+        task = asyncio.create_task(self._run_campaign(campaign_id))
+        self._tasks[campaign_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(campaign_id, None))
+
+    async def _run_campaign(self, campaign_id):
+        campaign = dict(self.campaigns[campaign_id])
+        try:
+            for i, chat_id in enumerate(self.recipients(campaign), start=1):
+                page = catalog.get(campaign["page"], stored_locale(str(chat_id)))
+                if page is not None and await self.send(chat_id, text=page.text, reply_markup=page.reply_markup):
+                    campaign["sent"] += 1
+                else:
+                    campaign["failed"] += 1
+                campaign["cursor"] = chat_id
+                if i % BROADCAST_CHECKPOINT_EVERY == 0:
+                    self.campaigns.set(campaign_id, dict(campaign))
+            campaign["status"] = "done"
+            logging.info("Campaign %s done: %d sent, %d failed", campaign_id, campaign["sent"], campaign["failed"])
+        finally:
+            # Aussi en cas d'arrêt : le curseur est sauvegardé pour la reprise
+            self.campaigns.set(campaign_id, campaign)
+
+    async def send(self, chat_id, text, reply_markup=None):
+        for _ in range(5):
+            await self.bucket.wait_for(self.reserve)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+                self.sent += 1
+                return True
+            except RetryAfter as e:
+                logging.warning("Flood control hit, pausing broadcasts for %ss", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                # L'utilisateur a bloqué le bot : inutile de lui écrire à nouveau
+                self.subscribers.delete(str(chat_id))
+                break
+            except TelegramError as e:
+                logging.warning("Broadcast to %s failed: %s", chat_id, e)
+                break
+        self.failed += 1
+        return False
+
+
+broadcaster = Broadcaster(telegram_rate, subscribers_store, campaigns_store)
+metrics.gauge("bot_subscribers", "Utilisateurs joignables par diffusion", lambda: len(subscribers_store))
+metrics.gauge("bot_broadcast_sent", "Messages envoyés par diffusion", lambda: broadcaster.sent)
+metrics.gauge("bot_broadcast_failed", "Messages de diffusion en échec", lambda: broadcaster.failed)
+metrics.gauge("bot_broadcast_running", "Campagnes en cours", lambda: len(broadcaster._tasks))
+
+
+# ─── Discount Code Expiry ─────────────────────────
+# Les dates d'expiration sont converties une seule fois en timestamps (les anciennes entrées
+# n'ont que le texte « %d %B %Y ») et rangées dans deux tas triés par échéance : rappels
+# « expire dans 3 jours » et expirations. Chaque passage du job ne dépile que ce qui est
+# échu : le coût est proportionnel au nombre de codes concernés, pas au nombre d'utilisateurs.
+# Les entrées du tas ne sont jamais retirées à la main : un utilisateur qui a reçu un
+# nouveau code laisse une entrée périmée, ignorée au moment où elle ressort.
+# Les tas sont construits par warm_up() après le démarrage, pas à l'import du module.
+
+EXPIRY_SWEEP_INTERVAL = int(os.getenv("EXPIRY_SWEEP_INTERVAL", "3600"))
+REMINDER_DAYS_BEFORE = 3
+
+
+def entry_expires_at(entry):
+    if "expires_at" in entry:
+        return entry["expires_at"]
+    try:
+        return int(datetime.strptime(entry["expiration"], "%d %B %Y").replace(tzinfo=timezone.utc).timestamp()) + 86400
+    except ValueError:
+        return None
+
+
+def format_expiration(entry, locale):
+    # Date affichée dans la langue de l'utilisateur ; les anciennes entrées gardent leur texte
+    if "expires_at" not in entry:
+        return entry["expiration"]
+    day = datetime.fromtimestamp(entry["expires_at"], timezone.utc)
+    return f"{day.day} {catalog.bundle(locale).months[day.month - 1]} {day.year}"
+
+
+def is_expired(entry, now=None):
+    expires_at = entry_expires_at(entry)
+    return expires_at is not None and expires_at <= (now or time.time())
+
+
+class ExpiryIndex(Warmable):
+    def __init__(self, store):
+        self.store = store
+        self._expiries = []   # (expires_at, user_id, code)
+        self._reminders = []  # (remind_at, user_id, code)
+        self.expired = 0
+        self.reminded = 0
+
+    def _warm_up(self):
+        for item in chunked(list(self.store.items())):
+            if item is None:
+                yield
+            else:
+                self._push(*item)
+        self.ready = True
+
+    def add(self, user_id, entry):
+        self.warm_up()
+        self._push(user_id, entry)
+
+    def _push(self, user_id, entry):
+        if not owns_user(user_id):
+            return  # Balayé et rappelé par le worker de cet utilisateur
+        expires_at = entry_expires_at(entry)
+        if expires_at is None:
+            logging.warning("Unreadable expiration %r for user %s", entry.get("expiration"), user_id)
+            return
+        heapq.heappush(self._expiries, (expires_at, user_id, entry["code"]))
+        if not entry.get("reminded"):
+            heapq.heappush(self._reminders, (expires_at - REMINDER_DAYS_BEFORE * 86400, user_id, entry["code"]))
+
+    def _pop_due(self, heap, now):
+        while heap and heap[0][0] <= now:
+            _, user_id, code = heapq.heappop(heap)
+            entry = self.store.get(user_id)
+            if entry is not None and entry["code"] == code:
+                yield user_id, entry
+
+    def due_reminders(self, now):
+        self.warm_up()
+        # Une entrée ajoutée pendant le warm_up peut être présente deux fois dans le tas
+        due = {user_id: entry for user_id, entry in self._pop_due(self._reminders, now) if not entry.get("reminded")}
+        return list(due.items())
+
+    def sweep(self, now):
+        self.warm_up()
+        evicted = 0
+        for user_id, _ in self._pop_due(self._expiries, now):
+            self.store.delete(user_id)
+            evicted += 1
+        self.expired += evicted
+        return evicted
+
+
+expiry_index = ExpiryIndex(remises_store)
+metrics.gauge("bot_discount_codes_expired", "Codes expirés retirés par le balayage", lambda: expiry_index.expired)
+metrics.gauge("bot_discount_reminders_sent", "Rappels d'expiration envoyés", lambda: expiry_index.reminded)
+
+
+async def sweep_discount_codes(context: ContextTypes.DEFAULT_TYPE):
+    now = time.time()
+    evicted = expiry_index.sweep(now)
+    if evicted:
+        logging.info("Expired %d discount codes", evicted)
+        remises_store.request_compaction()
+
+    for user_id, entry in expiry_index.due_reminders(now):
+        remises_store.set(user_id, dict(entry, reminded=True))
+        locale = stored_locale(user_id)
+        # File des diffusions : les rappels ne passent jamais devant les réponses interactives
+        if await broadcaster.send(
+            int(user_id),
+            text=catalog.message(locale, "code_reminder", code=entry["code"], expiration=format_expiration(entry, locale)),
+        ):
+            expiry_index.reminded += 1
+
+
+async def handle_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in ADMIN_USER_IDS:
+        return
+    if len(context.args) != 1 or catalog.get(context.args[0]) is None:
+        await update.message.reply_text("Usage : /diffusion <page_id> (une page de pages.json)")
+        return
+    campaign_id = broadcaster.start_campaign(context.args[0])
+    await update.message.reply_text(f"📣 Diffusion lancée ({campaign_id}) vers {len(subscribers_store)} abonnés.")
+
+
+# ─── Analytics ────────────────────────────────────
+# Parcours dans les menus : /start, chaque tap sur un bouton connu et chaque code émis
+# deviennent un événement (ts, user_hash, événement). L'enregistrement écrit dans trois
+# colonnes array préallouées utilisées en anneau : ni objet par événement, ni E/S.
+# L'anneau est vidé par lots toutes les ANALYTICS_FLUSH_INTERVAL secondes (ou dès qu'il est
+# à moitié plein) par le thread disque. Entonnoirs et chemins : analytics.py, hors ligne.
+
+# Le fichier est une suite de blocs ajoutés en fin de fichier, chacun autonome :
+#   en-tête      <4sII : b"SEV1", nombre d'événements n, taille du vocabulaire en octets
+#   vocabulaire  liste JSON des noms d'événements, l'id d'un événement est son indice
+#   colonnes     ts float64 × n, user_hash uint64 × n, id uint32 × n (little-endian)
+
+ANALYTICS_FILE = os.getenv("ANALYTICS_FILE", "analytics.bin")  # Vide : pas d'analytics
+ANALYTICS_BUFFER_SIZE = int(os.getenv("ANALYTICS_BUFFER_SIZE", "65536"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "10"))
+# Les ids Telegram ne sont jamais écrits : hachage à clé, stable d'un redémarrage à l'autre
+ANALYTICS_KEY = hashlib.sha256((os.getenv("ANALYTICS_SALT") or os.getenv("TELEGRAM_TOKEN") or "").encode()).digest()
+ANALYTICS_MAGIC = b"SEV1"
+ANALYTICS_HEADER = struct.Struct("<4sII")
+
+
+def user_hash(user_id):
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8, key=ANALYTICS_KEY).digest()
+    return int.from_bytes(digest, "little")
+
+
+class EventRing:
+    # Capacité fixe : si le disque ne suit plus, les événements les plus anciens sont écrasés
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ts = array("d", [0.0]) * capacity
+        self.users = array("Q", [0]) * capacity
+        self.events = array("I", [0]) * capacity
+        self.start = 0
+        self.size = 0
+        self.dropped = 0
+
+    def push(self, ts, user, event):
+        i = self.start + self.size
+        if i >= self.capacity:
+            i -= self.capacity
+        if self.size == self.capacity:
+            self.start = i + 1 if i + 1 < self.capacity else 0
+            self.dropped += 1
+        else:
+            self.size += 1
+        self.ts[i] = ts
+        self.users[i] = user
+        self.events[i] = event
+
+    def drain(self):
+        # Copie des colonnes dans l'ordre d'arrivée, puis anneau vide
+        columns = (self.ts, self.users, self.events)
+        end = self.start + self.size
+        if end <= self.capacity:
+            batch = tuple(column[self.start:end] for column in columns)
+        else:
+            end -= self.capacity
+            batch = tuple(column[self.start:] + column[:end] for column in columns)
+        self.start = self.size = 0
+        return batch
+
+
+class AnalyticsRecorder:
+    def __init__(self, path, capacity=ANALYTICS_BUFFER_SIZE, flush_interval=ANALYTICS_FLUSH_INTERVAL):
+        self.path = path
+        self.ring = EventRing(capacity)
+        self.flush_interval = flush_interval
+        # Vocabulaire borné : seuls des noms connus (pages, routes, événements fixes) sont enregistrés
+        self.names = []
+        self._ids = {}
+        self._task = None
+        self._flushes = set()
+        self.recorded = 0
+        self.lost = 0
+
+    def record(self, user_id, name):
+        event = self._ids.get(name)
+        if event is None:
+            event = self._ids[name] = len(self.names)
+            self.names.append(name)
+        self.ring.push(time.time(), user_hash(user_id), event)
+        self.recorded += 1
+        if self.ring.size * 2 >= self.ring.capacity and self._task is not None and not self._flushes:
+            # Un seul flush anticipé à la fois : sans ça, chaque événement en relançait un
+            # tant que la boucle n'avait pas laissé tourner le premier
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        if not self.ring.size:
+            return
+        batch = self.ring.drain()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(STORAGE_EXECUTOR, self._write, list(self.names), batch)
+        except OSError:
+            logging.exception("Analytics write failed, %d events lost", len(batch[0]))
+            self.lost += len(batch[0])
+
+    def _write(self, names, batch):
+        if sys.byteorder != "little":
+            for column in batch:
+                column.byteswap()
+        vocabulary = json.dumps(names, ensure_ascii=False).encode()
+        header = ANALYTICS_HEADER.pack(ANALYTICS_MAGIC, len(batch[0]), len(vocabulary))
+        with open(self.path, "ab") as f:
+            f.write(b"".join([header, vocabulary] + [column.tobytes() for column in batch]))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._flushes, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+analytics = AnalyticsRecorder(worker_path(ANALYTICS_FILE)) if ANALYTICS_FILE else None
+if analytics is not None:
+    metrics.gauge("bot_analytics_events_recorded", "Événements de navigation enregistrés", lambda: analytics.recorded)
+    metrics.gauge("bot_analytics_events_dropped", "Événements écrasés (anneau plein) ou perdus à l'écriture", lambda: analytics.ring.dropped + analytics.lost)
+
+
+# ─── Deep Links ───────────────────────────────────
+# Les liens des campagnes (TikTok, Instagram…) ouvrent t.me/<bot>?start=<payload> : /start
+# reçoit le payload et affiche directement la page visée, en un seul message, au lieu du
+# menu suivi de deux ou trois taps.
+# Payload : <page_id>-<source>-<signature>, signature = 12 caractères hex d'un HMAC-SHA256.
+# Seuls les liens générés par « python bot.py deeplinks » sont acceptés : la source
+# enregistrée (et le label de la métrique) ne peut pas être inventée par un visiteur.
+# DEEP_LINK_SECRET doit rester fixe : le changer (ou changer de token sans l'avoir défini)
+# invalide tous les liens déjà publiés.
+
+DEEP_LINK_KEY = ("deep-link:" + (os.getenv("DEEP_LINK_SECRET") or os.getenv("TELEGRAM_TOKEN") or "")).encode()
+DEEP_LINK_SIGNATURE_LENGTH = 12
+DEEP_LINK_SOURCE = re.compile(r"[A-Za-z0-9_]{1,16}")
+DEEP_LINK_MAX_LENGTH = 64  # Limite de Telegram pour le paramètre start
+metrics.describe("bot_deep_links_total", "counter", "Arrivées par lien /start signé, par source")
+
+
+def sign_deep_link(page_id, source):
+    body = f"{page_id}-{source}"
+    signature = hmac.new(DEEP_LINK_KEY, body.encode(), hashlib.sha256).hexdigest()[:DEEP_LINK_SIGNATURE_LENGTH]
+    return f"{body}-{signature}"
+
+
+def parse_deep_link(payload):
+    # (page_id, source) si le payload est authentique, None sinon
+    page_id, _, rest = payload.partition("-")
+    source, _, _ = rest.partition("-")
+    if not page_id or not DEEP_LINK_SOURCE.fullmatch(source):
+        return None
+    # En octets : un /start tapé à la main peut contenir des caractères non ASCII
+    if not hmac.compare_digest(sign_deep_link(page_id, source).encode(), payload.encode()):
+        return None
+    return page_id, source
+
+
+def write_deep_links(source, page_ids, username=None, out=sys.stdout):
+    # Génération en masse pour une campagne : CSV page_id,source,payload,lien
+    if not DEEP_LINK_SOURCE.fullmatch(source):
+        return f"Invalid source {source!r}: 1-16 characters among A-Z a-z 0-9 _"
+    unknown = [page_id for page_id in page_ids if catalog.get(page_id) is None]
+    if unknown:
+        return f"Unknown pages: {', '.join(unknown)}"
+    writer = csv.writer(out)
+    writer.writerow(["page_id", "source", "payload", "link"])
+    for page_id in page_ids:
+        payload = sign_deep_link(page_id, source)
+        if len(payload) > DEEP_LINK_MAX_LENGTH:
+            return f"Payload too long for {page_id}: {payload}"
+        writer.writerow([page_id, source, payload, f"https://t.me/{username}?start={payload}" if username else ""])
+    return None
 
-def load_remises():
-    if os.path.exists(DISCOUNT_FILE):
-        with open(DISCOUNT_FILE, "r") as f:
-            return json.load(f)
-    return {}
 
-def save_remises(data):
-    with open(DISCOUNT_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("Received /start from user %s", update.effective_user.id, extra={"event": "start"})
+    user_id = str(update.effective_user.id)
+    locale = user_locale(update.effective_user)
+    link = parse_deep_link(context.args[0]) if context.args else None
+    if context.args and (link is None or catalog.get(link[0]) is None):
+        logging.warning("Invalid /start payload %r", context.args[0])
+        metrics.inc("bot_deep_links_total", (("source", "invalid"),))
+        link = None
+    subscriber = subscribers_store.get(user_id)
+    if subscriber is None or subscriber.get("lang") != locale:
+        # La source d'un abonné est celle de sa première arrivée
+        subscriber = subscriber or {"since": int(time.time()), "source": link[1] if link else None}
+        subscribers_store.set(user_id, dict(subscriber, lang=locale))
+    if analytics is not None:
+        analytics.record(user_id, "start")
+
+    if link is not None:
+        page_id, source = link
+        metrics.inc("bot_deep_links_total", (("source", source),))
+        if analytics is not None:
+            analytics.record(user_id, f"ref:{source}")
+            analytics.record(user_id, page_id)
+        await show_page(update, context, page_id)
+        return
+
+    await update.message.reply_text(
+        text=catalog.message(locale, "welcome"),
+        reply_markup=catalog.get("start_menu", locale).reply_markup,
+        parse_mode=ParseMode.HTML
+    )
+
 
 async def show_user_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
+    locale = user_locale(update.effective_user)
     remises = load_remises()
 
-    if user_id in remises:
-        code = remises[user_id]["code"]
-        expiration = remises[user_id]["expiration"]
+    # Un code expiré pas encore balayé ne doit plus être affiché
+    if user_id in remises and not is_expired(remises[user_id]):
+        entry = remises[user_id]
 
         await update.message.reply_text(
-            text=(
-                "🔑 <b>Voici votre code de réduction :</b>\n\n"
-                f"💸 <code>{code}</code>\n\n"
-                f"📅 <i>Valable jusqu’au : {expiration}</i>"
-            ),
+            text=catalog.message(locale, "code_show", code=entry["code"], expiration=format_expiration(entry, locale)),
             parse_mode=ParseMode.HTML
         )
     else:
         await update.message.reply_text(
-            text=(
-                "⚠️ <b>Vous n’avez pas encore généré de code promo.</b>\n\n"
-                "Cliquez sur « 🎁 Rabais » dans le menu principal pour en recevoir un."
-            ),
+            text=catalog.message(locale, "code_missing"),
             parse_mode=ParseMode.HTML
         )
 
-async def handle_fr_livres(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "📚 <b>Nos Livres :</b>\n\n"
-
-            "📘 <b>La loi des cycles</b>\n"
-            "<i>Exploration des lois universelles qui gouvernent les cycles de la vie.</i>\n"
-            "🔗 <a href='https://a.co/d/a607uVz'>Voir sur Amazon</a>\n\n"
-
-            "🌹 <b>Marie-Madeleine</b>\n"
-            "<i>Relecture initiatique de la figure de Marie-Madeleine.</i>\n"
-            "🔗 <a href='https://a.co/d/cIvOQfA'>Voir sur Amazon</a>\n\n"
-
-            "🌒 <b>Vivre au-dessus du bien et du mal</b>\n"
-            "<i>Invitation à dépasser la dualité morale pour accéder à une conscience supérieure et intégrative.</i>\n"
-            "🔗 <a href='https://a.co/d/1aOQTEq'>Voir sur Amazon</a>\n\n"
-
-            "🌀 <b>La domination des égrégores</b>\n"
-            "<i>Étude sur la nature des égrégores, leur influence sur la psyché collective et la libération par le sacrifice du créateur déchu.</i>\n"
-            "🔗 <a href='https://a.co/d/4l03hWg'>Voir sur Amazon</a>\n\n"
-
-            "👁️ <b>La maladie des sens</b>\n"
-            "<i>Parcours initiatique à travers la perception, l’illusion sensorielle et la quête de l’éveil spirituel.</i>\n"
-            "🔗 <a href='https://a.co/d/1pMjZqB'>Voir sur Amazon</a>\n\n"
-
-            "🔑 <b>Les secrets du Maître</b>\n"
-            "<i>Méditation sur la mort, la victoire sur l’illusion de l’enfer et la transcendance spirituelle.</i>\n"
-            "🔗 <a href='https://a.co/d/9B25dhz'>Voir sur Amazon</a>\n\n"
-
-            "💫 <b>Du vodou colonial au vodou transcendantal</b>\n"
-            "<i>Transformation spirituelle du vodou haïtien vers une pratique axée sur la sagesse, l’amour et la liberté.</i>\n"
-            "🔗 <a href='https://a.co/d/eZQOeyR'>Voir sur Amazon</a>\n"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-
-    )
-
-async def handle_fr_remise(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-
-    user_id = str(query.from_user.id)
-    remises = load_remises()
-
-    # ✅ Vérifie s'il a déjà un code
-    if user_id in remises:
-        code = remises[user_id]["code"]
-        expiration = remises[user_id]["expiration"]
-    else:
-        # ✅ Sinon, génère un nouveau code
-        code = generate_discount_code()
-        expiration = (datetime.now() + timedelta(days=30)).strftime("%d %B %Y")
-        remises = load_remises()
-        remises[user_id] = {"code": code, "expiration": expiration}
-        save_remises(remises)
-
-
-    # ✅ Affiche le message à l’utilisateur
-    await query.edit_message_text(
-        text=(
-            "🎁 <b>Voici votre code de réduction :</b>\n\n"
-            f"💸 <code>{code}</code>\n\n"
-            "Utilisez ce code lors de votre paiement pour obtenir <b>-15%</b> sur votre prochaine inscription.\n\n"
-            f"📅 <i>Valable jusqu’au : {expiration}</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
-
-async def handle_fr_ressources(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text="📚 <b>Ressources disponibles :</b>",
-        parse_mode=ParseMode.HTML,
-        reply_markup=ressources_menu()
-    )
-
-async def handle_fr_coaching(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text="👤 <b>Coaching ETR : choisissez un niveau</b>",
-        parse_mode=ParseMode.HTML,
-        reply_markup=coaching_menu()
-    )
-
-
-async def handle_start_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text="🏠 <b>Menu Principal :</b>\n\nChoisissez une option ci-dessous :",
-        parse_mode=ParseMode.HTML,
-        reply_markup=main_menu()
-
-    )
-
-async def handle_reseaux_sociaux(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🌐 <b>Suivez-nous sur les réseaux sociaux :</b>\n\n"
-            "🎵 TikTok : <a href='https://www.tiktok.com/@meta_huamain?_t=ZM-8wiGAdMgsuW&_r=1'>@meta_huamain</a>\n"
-            "📸 Instagram : <a href='https://www.instagram.com/academie.sapience?igsh=bTZsYTBlZmJyZjZh'>@academie.sapience</a>\n"
-            "📘 Facebook : <a href='https://www.facebook.com/profile.php?id=61575811124252'>Notre page Facebook</a>\n"
-            "📢 Telegram : <a href='https://t.me/+owe0TtDXsyE0M2Qx'>Canal officiel</a>\n"
-            "💬 WhatsApp : <a href='https://chat.whatsapp.com/JDHq6TS89cU0Sd5sjd248T'>Groupe WhatsApp</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
-
-async def handle_donation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🙏 <b>Soutenir notre mission :</b>\n\n"
-            "T-MEC et l’Académie Sapience Universelle accompagnent des milliers d’âmes vers la lumière, la connaissance, et la transformation intérieure.\n\n"
-            "✨ Si notre travail vous inspire, vous pouvez contribuer à son rayonnement.\n"
-            "🧡 Chaque don compte, quelle que soit la somme.\n\n"
-            "🔗 <a href='https://www.notion.so/M-THODES-DE-PAIEMENT-1eb63fe03d3780baa43dcfcb8c0fa3f4?pvs=4'>Cliquez ici pour faire un don</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
-
-
-
-async def handle_fr_cours(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🧘 <b>COURS ÉSOTÉRIQUES PRÉENREGISTRÉS</b>\n\n"
-
-            "📌 <b>ÉTAPES D’INSCRIPTION :</b>\n\n"
-            "📝 <b>1.</b> Remplissez le formulaire unique d’inscription ci-dessous\n"
-            "💳 <b>2.</b> Effectuez le paiement par carte, Zelle, Intuit ou autre méthode acceptée\n"
-            "📞 <b>3.</b> Contactez le Comte de Sabatha via WhatsApp : <b>+1 954 663 8783</b>\n\n"
-            "✅ Vous recevrez vos accès dans les 24h via Google Classroom\n\n"
-            "🔗 <a href='https://form.jotform.com/243633811855157'>Formulaire d’inscription (toutes les classes)</a>\n\n"
-
-            "🕯️ <b>Classe Maçonnique Alchimique et Théurgique</b>\n"
-            "<i>Une voie rituelle et intérieure réservée aux véritables Maîtres — du Temple de pierre au Temple vivant.</i>\n\n"
-
-            "🪽 <b>Classe de Magie Énochienne</b>\n"
-            "<i>Un parcours guidé à travers la magie céleste et la communication avec les intelligences angéliques.</i>\n\n"
-
-            "💎 <b>Classe L’Alchimie Sexuelle</b>\n"
-            "<i>Formation sacrée pour libérer, activer et harmoniser l’énergie sexuelle — entre tantrisme et éveil intérieur.</i>\n\n"
-
-            "🌌 <b>Classe Astro Tarot</b>\n"
-            "<i>Décodage des messages de l’âme à travers les astres et la magie symbolique du Tarot.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("💳 Voir les méthodes de paiement", url="https://www.notion.so/M-THODES-DE-PAIEMENT-1eb63fe03d3780baa43dcfcb8c0fa3f4?pvs=4")],
-            [InlineKeyboardButton("🏠 Retour au menu principal", callback_data="start_menu")]
-        ])
-    )
-
-
-
-
-
-async def handle_fr_videos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🎬 <b>Vidéos disponibles :</b>\n\n"
-            "Accédez à notre bibliothèque de vidéos : cours enregistrés, replays de séminaires et formations spirituelles."
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-
-    )
-
-async def handle_fr_seminaires(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "🎤 <b>SÉMINAIRES ÉSOTÉRIQUES PRÉENREGISTRÉS</b>\n\n"
-
-            "📌 <b>ÉTAPES D’INSCRIPTION :</b>\n\n"
-            "📝 <b>1.</b> Remplissez le formulaire de préinscription ci-dessous\n"
-            "💳 <b>2.</b> Effectuez le paiement par carte, Zelle, Intuit ou autre méthode acceptée\n"
-            "📞 <b>3.</b> Contactez la direction pour confirmer votre accès\n\n"
-            "✅ Vous recevrez vos accès dans les 24h via email\n\n"
-
-            "🌀 <b>Séminaire : Création & Programmation des Égrégores</b>\n"
-            "<i>Créez, entretenez et programmez des égrégores vivants selon les lois vibratoires de l'invisible.</i>\n"
-            "📩 <b>RÉSERVATION :</b> Remplissez ce formulaire :\n"
-            "🔗 <a href='https://form.jotform.com/251465347130149'>Formulaire d’inscription</a>\n"
-            "💰 <b>Tarif :</b> 130 USD (ou 200 USD pour la série complète)\n\n"
-
-            "🌫️ <b>Séminaire : Le Pouvoir Caché de l’Âme-Désincarnée</b>\n"
-            "<i>Transformez une âme en esprit utile grâce à une guidance astrologique, ésotérique et vibratoire.</i>\n"
-            "📩 <b>RÉSERVATION :</b> Remplissez ce formulaire :\n"
-            "🔗 <a href='https://form.jotform.com/251465347130149'>Formulaire d’inscription</a>\n"
-            "💰 <b>Tarif :</b> 120 USD\n\n"
-
-            "📞 <b>Contact WhatsApp :</b> +1 954 663 8783\n"
-            "📧 <b>Email :</b> info@academiesapienceuniverselle.org"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("💳 Voir les méthodes de paiement", url="https://www.notion.so/M-THODES-DE-PAIEMENT-1eb63fe03d3780baa43dcfcb8c0fa3f4?pvs=4")],
-            [InlineKeyboardButton("🏠 Retour au menu principal", callback_data="start_menu")]
-        ])
-    )
-
-
-async def handle_fr_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text="❓ <b>FAQ — Choisissez une question :</b>",
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("📦 Accès aux cours", callback_data="faq_acces")],
-            [InlineKeyboardButton("💳 Moyens de paiement", callback_data="faq_paiement")],
-            [InlineKeyboardButton("📚 Plateformes utilisées", callback_data="faq_plateformes")],
-            [InlineKeyboardButton("📅 Dates de début", callback_data="faq_dates")],
-            [InlineKeyboardButton("🧑‍🏫 Accompagnement", callback_data="faq_accompagnement")],
-            [InlineKeyboardButton("🌍 Élèves à l'étranger", callback_data="faq_international")],
-            [InlineKeyboardButton("📞 Question personnelle", callback_data="faq_contact")],
-            [InlineKeyboardButton("📦 Livraison des livres", callback_data="faq_livraison")],
-            [InlineKeyboardButton("📝 Inscription aux cours", callback_data="faq_inscription")],
-            [InlineKeyboardButton("🎥 Replays vidéos", callback_data="faq_videos")],
-            [InlineKeyboardButton("🏠 Retour au menu principal", callback_data="start_menu")]
-        ])
-    )
-
-
-async def handle_faq_acces(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "📦 <b>Comment vais-je accéder à mes cours ou séminaires ?</b>\n\n"
-            "<i>Via Google Classroom et en vidéos préenregistrées. Un lien d'accès vous sera envoyé après inscription.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_paiement(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "💳 <b>Quels moyens de paiement acceptez-vous ?</b>\n\n"
-            "<i>Zelle, Intuit (carte), CashApp, BUH Haïti, MoneyGram et Western Union. Les instructions vous seront envoyées après inscription.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_plateformes(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "📚 <b>Quelles plateformes utilisez-vous ?</b>\n\n"
-            "<i>Google Classroom pour les cours, Telegram pour l’accompagnement personnalisé.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "📆 <b>Quand commencent les cours ?</b>\n\n"
-            "<i>Merci de contacter l’équipe pédagogique :\n📞 +1 954 663 8783\n📧 gpsabatha@gmail.com</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_accompagnement(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "👨‍🏫 <b>Y a-t-il un accompagnement ?</b>\n\n"
-            "<i>Oui, via groupes Telegram privés et contact direct avec l’enseignant si besoin.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_international(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "🌍 <b>Puis-je suivre les cours depuis l’étranger ?</b>\n\n"
-            "<i>Oui, tous nos contenus sont 100 % en ligne et accessibles dans le monde entier.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "📞 <b>Comment poser une question personnelle ?</b>\n\n"
-            "<i>Contactez-nous directement via WhatsApp :</i>\n"
-            "<a href='https://wa.me/19546638783'>https://wa.me/19546638783</a>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]
-        ])
-    )
-
-
-async def handle_faq_livraison(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "📦 <b>Comment se passe la livraison des livres ?</b>\n\n"
-            "<i>Nos livres sont disponibles sur Amazon avec livraison mondiale.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_inscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "📝 <b>Comment m’inscrire à un cours ?</b>\n\n"
-            "<i>Inscrivez-vous directement via l’assistant SESHAT en suivant les liens dans chaque section de cours.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-async def handle_faq_videos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.callback_query.answer()
-    await update.callback_query.edit_message_text(
-        text=(
-            "🎥 <b>Combien de temps ai-je accès aux vidéos ?</b>\n\n"
-            "<i>Les replays sont disponibles jusqu’à la fin officielle du programme ou formation concernée.</i>"
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Retour au FAQ", callback_data="fr_FAQ")]])
-    )
-
-
-async def handle_fr_agent(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
-        text=(
-            "💬 <b>Contacter un conseiller humain – ASU</b>\n\n"
-            "Besoin d’un accompagnement personnalisé ? D’une réponse rapide ?\n\n"
-            "📞 <b>Appelez ou envoyez un message WhatsApp :</b>\n"
-            "+1 954 663 8783\n\n"
-            "📧 <b>Email :</b> gpsabatha@gmail.com\n\n"
-            "⏰ Réponse sous 24h – du lundi au samedi\n"
-            "🙏 Merci pour votre confiance dans l’Académie Sapience Universelle."
-        ),
-        parse_mode=ParseMode.HTML,
-        reply_markup=back_to_main_menu()
-    )
-
-
-import re
-
-user_states = {}
-
 async def handle_fr_remise(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
-    user_states[user_id] = "awaiting_email"
+    user_states.set(user_id, "awaiting_email")
+    if query.message:
+        shown_pages.pop(shown_page_key(query.message))
 
     await query.edit_message_text(
-        text="🎁 Pour recevoir votre code de réduction, veuillez entrer votre adresse email :",
+        text=catalog.message(user_locale(query.from_user), "email_prompt"),
         parse_mode=ParseMode.HTML
     )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     message_text = update.message.text
+    locale = user_locale(update.effective_user)
 
     if user_states.get(user_id) == "awaiting_email":
         if re.match(r"[^@ \t\r\n]+@[^@ \t\r\n]+\.[^@ \t\r\n]+", message_text):
             user_states.pop(user_id)
 
             code = generate_discount_code()
-            expiration = (datetime.now() + timedelta(days=30)).strftime("%d %B %Y")
-            remises = load_remises()
-            remises[user_id] = {"code": code, "expiration": expiration}
-            save_remises(remises)
+            expires = datetime.now(timezone.utc) + timedelta(days=30)
+            expiration = expires.strftime("%d %B %Y")
+            entry = {"code": code, "expiration": expiration, "expires_at": int(expires.timestamp())}
+            await save_remise(user_id, entry)
+            expiry_index.add(user_id, entry)
+            if coupon_sync is not None:
+                coupon_sync.enqueue(code, expires)
+            if analytics is not None:
+                analytics.record(user_id, "code_issued")
 
             await update.message.reply_text(
-    f"✅ Merci ! Voici votre code de réduction :\n<code>{code}</code>\n\n"
-    "🎓 Ce code vous donne <b>-15%</b> sur <b>tout cours préenregistré</b> de l’Académie Sapience Universelle.\n"
-    f"📅 <i>Valable jusqu’au : {expiration}</i>",
+    catalog.message(locale, "code_issued", code=code, expiration=format_expiration(entry, locale)),
     parse_mode=ParseMode.HTML,
-    reply_markup=main_menu()
+    reply_markup=catalog.get("start_menu", locale).reply_markup
 )
 
         else:
-            await update.message.reply_text("❌ L'adresse email semble invalide. Veuillez réessayer.")
+            await update.message.reply_text(catalog.message(locale, "email_invalid"), parse_mode=ParseMode.HTML)
         return
 
+    # Question libre, en conversation privée seulement (pas de réponses dans les groupes)
+    if update.effective_chat.type == "private":
+        await answer_question(update, context, locale)
+
+
+# ─── Flood Protection ─────────────────────────────
+# Un utilisateur qui martèle les boutons ou envoie des rafales de messages ne doit pas ralentir
+# les autres. Chaque mise à jour passe par flood_guard.admit_update() avant d'entrer dans la file de
+# l'Application (polling et webhook) ou dans le répartiteur d'un worker : le surplus est jeté
+# avant tout handler, appel API ou écriture disque.
+# - seau de jetons par utilisateur : THROTTLE_BURST mises à jour d'un coup, puis THROTTLE_RATE/s ;
+# - plafond global : au-delà de THROTTLE_MAX_PENDING mises à jour admises et pas encore
+#   traitées, tout nouvel arrivant est refusé (inondation répartie sur beaucoup de comptes).
+# Une mise à jour refusée n'a pas de réponse : le sablier du bouton s'arrête seul côté client.
+
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "8"))
+THROTTLE_MAX_PENDING = int(os.getenv("THROTTLE_MAX_PENDING", "256"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+
+
+class UserBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class FloodGuard:
+    def __init__(self, rate, burst, max_pending, max_users):
+        self.rate = rate
+        self.burst = burst
+        self.max_pending = max_pending
+        self.max_users = max_users
+        # Un seau inactif depuis idle_after secondes est de nouveau plein : l'oublier ne change
+        # rien. Les seaux sont rangés du moins au plus récemment actif, l'éviction s'arrête
+        # donc au premier seau encore utile.
+        self.idle_after = burst / rate
+        self._buckets = OrderedDict()  # user_id -> UserBucket
+        self.pending = 0
+        # id() des Update admis par admit_update() et pas encore traités : done() ne décompte
+        # que ceux-là (un process_update direct, hors file, ne touche pas à pending)
+        self._admitted = set()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def admit(self, user_id):
+        if self.pending >= self.max_pending:
+            metrics.inc("bot_throttled_updates_total", (("reason", "global"),))
+            return False
+        if user_id is not None:
+            now = time.monotonic()
+            self._evict_idle(now)
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = UserBucket(self.burst, now)
+                if len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+                self._buckets.move_to_end(user_id)
+            if bucket.tokens < 1:
+                metrics.inc("bot_throttled_updates_total", (("reason", "user"),))
+                return False
+            bucket.tokens -= 1
+        self.pending += 1
+        return True
+
+    def admit_update(self, update):
+        if not self.admit(update.effective_user.id if update.effective_user else None):
+            return False
+        self._admitted.add(id(update))
+        return True
+
+    def done(self, update):
+        try:
+            self._admitted.remove(id(update))
+        except KeyError:
+            return
+        self.pending = max(0, self.pending - 1)
+
+    def _evict_idle(self, now):
+        buckets = self._buckets
+        while buckets:
+            bucket = next(iter(buckets.values()))
+            if now - bucket.updated < self.idle_after:
+                break
+            buckets.popitem(last=False)
+
+
+flood_guard = FloodGuard(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_PENDING, THROTTLE_MAX_USERS)
+metrics.describe("bot_throttled_updates_total", "counter", "Mises à jour refusées par la protection anti-flood")
+metrics.gauge("bot_throttle_tracked_users", "Utilisateurs ayant un seau de jetons en mémoire", lambda: len(flood_guard))
+metrics.gauge("bot_updates_pending", "Mises à jour admises et pas encore traitées", lambda: flood_guard.pending)
+
+
+class ThrottledQueue(asyncio.Queue):
+    # File d'entrée de l'Application : put() passe aussi par put_nowait()
+    def put_nowait(self, item):
+        if isinstance(item, Update) and not flood_guard.admit_update(item):
+            return
+        super().put_nowait(item)
+
+
+class ThrottledApplication(Application):
+    async def process_update(self, update):
+        try:
+            await super().process_update(update)
+        finally:
+            if isinstance(update, Update):
+                flood_guard.done(update)
+
+
+# ─── Duplicate Updates ────────────────────────────
+# Telegram renvoie une mise à jour quand le webhook a tardé à répondre, et les utilisateurs
+# tapent souvent deux fois sur un bouton. Un TypeHandler du groupe -1 voit chaque mise à jour
+# avant les autres handlers et arrête les doublons avant tout appel API ou écriture disque :
+# - même update_id déjà reçu dans les UPDATE_ID_TTL dernières secondes (renvoi de Telegram) ;
+# - même bouton (utilisateur, callback_data) dans la fenêtre CALLBACK_DEBOUNCE_SECONDS.
+# Les deux caches sont des StateStore : TTL fixe et nombre d'entrées plafonné (LRU).
+
+UPDATE_ID_TTL = int(os.getenv("UPDATE_ID_TTL", "600"))
+CALLBACK_DEBOUNCE_SECONDS = float(os.getenv("CALLBACK_DEBOUNCE_SECONDS", "1.5"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "50000"))
+
+seen_updates = StateStore(UPDATE_ID_TTL, DEDUP_MAX_ENTRIES)
+recent_taps = StateStore(CALLBACK_DEBOUNCE_SECONDS, DEDUP_MAX_ENTRIES)
+metrics.describe("bot_duplicate_updates_total", "counter", "Mises à jour ignorées car déjà traitées")
+
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if seen_updates.get(update.update_id) is not None:
+        reason = "update_id"
+    else:
+        seen_updates.set(update.update_id, True)
+        query = update.callback_query
+        if query is None or update.effective_user is None:
+            return
+        key = (update.effective_user.id, query.data)
+        if recent_taps.get(key) is None:
+            recent_taps.set(key, True)
+            return
+        reason = "double_tap"
+        # Le premier tap fait le travail ; celui-ci arrête seulement le sablier du bouton
+        await query.answer()
+    metrics.inc("bot_duplicate_updates_total", (("reason", reason),))
+    raise ApplicationHandlerStop
+
+
+# ─── Callback Router ──────────────────────────────
+# Un seul CallbackQueryHandler : le callback_data est cherché dans un dict (O(1)) au lieu
+# de tester une regex par page. Les pages statiques s'ajoutent dans pages.json ; seules
+# les pages dynamiques ont besoin d'une entrée ici.
+
+CALLBACK_ROUTES = {
+    "fr_Remise": handle_fr_remise,
+}
+
+# Espaces de noms ("fr_", "faq_", "coaching_", "ressources_"…) : un handler peut prendre en
+# charge toutes les clés d'un préfixe qui n'ont pas d'entrée exacte dans CALLBACK_ROUTES.
+# Les pages statiques de pages.json sont toutes servies par handle_page.
+CALLBACK_NAMESPACES = {
+    "start_": handle_page,
+    "fr_": handle_page,
+    "faq_": handle_page,
+    "coaching_": handle_page,
+    "ressources_": handle_page,
+}
+
+catalog = ContentCatalog(PAGES_FILE, LOCALES_DIR, extra_targets=CALLBACK_ROUTES)
+
+
+def callback_namespace(callback_data):
+    prefix, sep, _ = callback_data.partition("_")
+    return prefix + sep
+
+
+def callback_series(name):
+    return name, handler_series(f"callback:{name}")
+
+
+# callback_data -> (nom, série) des clés connues, résolues avec la table de routage. Une page
+# ajoutée par un rechargement de pages.json est ajoutée à son premier tap ; les clés inconnues
+# partagent la série "unknown" et ne sont pas retenues (le dict reste borné)
+CALLBACK_SERIES = {data: callback_series(data) for data in (*CALLBACK_ROUTES, *catalog.pages)}
+UNKNOWN_CALLBACK_SERIES = callback_series("unknown")
+
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = update.callback_query.data or ""
+    handler = CALLBACK_ROUTES.get(data) or CALLBACK_NAMESPACES.get(callback_namespace(data))
+    if handler is None:
+        logging.warning("Unknown callback_data %r", data)
+        await update.callback_query.answer()
+        return
+    series = CALLBACK_SERIES.get(data)
+    if series is None:
+        series = UNKNOWN_CALLBACK_SERIES
+        if data in catalog.pages:
+            series = CALLBACK_SERIES[data] = callback_series(data)
+    name, timing = series
+    if analytics is not None:
+        analytics.record(update.effective_user.id, name)
+    await call_instrumented(timing, handler, update, context)
 
 
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-
 # ─── Handler Setup Function ───────────────────────
 def setup_handlers(app):
+    # Doublons (renvois de Telegram, double tap) arrêtés avant tous les autres groupes
+    app.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
+
     # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("code", show_user_code))
-    app.add_handler(CommandHandler("faq", handle_fr_faq))
-
-    # Menu navigation
-    app.add_handler(CallbackQueryHandler(handle_start_menu, pattern="^start_menu$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_livres, pattern="^fr_Livres$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_cours, pattern="^fr_Cours$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_videos, pattern="^fr_Videos$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_seminaires, pattern="^fr_Seminaires$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_faq, pattern="^fr_FAQ$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_remise, pattern="^fr_Remise$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_agent, pattern="^fr_Agent$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_ressources, pattern="^fr_ressources$"))
-    app.add_handler(CallbackQueryHandler(handle_fr_coaching, pattern="^fr_coaching$"))
-    app.add_handler(CallbackQueryHandler(handle_reseaux_sociaux, pattern="^fr_reseaux$"))
-    app.add_handler(CallbackQueryHandler(handle_donation, pattern="^fr_donation$"))
-
-    # Submenus
-    app.add_handler(CallbackQueryHandler(handle_ressources_audios, pattern="^ressources_audios$"))
-    app.add_handler(CallbackQueryHandler(handle_ressources_articles, pattern="^ressources_articles$"))
-    app.add_handler(CallbackQueryHandler(handle_ressources_bio, pattern="^ressources_bio$"))
-    app.add_handler(CallbackQueryHandler(handle_ressources_livres, pattern="^ressources_livres$"))
-    app.add_handler(CallbackQueryHandler(handle_ressources_videos, pattern="^ressources_videos$"))
-    app.add_handler(CallbackQueryHandler(handle_ressources_references, pattern="^ressources_references$"))
-
-    app.add_handler(CallbackQueryHandler(handle_coaching_standard, pattern="^coaching_standard$"))
-    app.add_handler(CallbackQueryHandler(handle_coaching_intermediaire, pattern="^coaching_intermediaire$"))
-    app.add_handler(CallbackQueryHandler(handle_coaching_avance, pattern="^coaching_avance$"))
-
-    app.add_handler(CallbackQueryHandler(handle_faq_acces, pattern="^faq_acces$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_paiement, pattern="^faq_paiement$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_plateformes, pattern="^faq_plateformes$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_dates, pattern="^faq_dates$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_accompagnement, pattern="^faq_accompagnement$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_international, pattern="^faq_international$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_contact, pattern="^faq_contact$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_livraison, pattern="^faq_livraison$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_inscription, pattern="^faq_inscription$"))
-    app.add_handler(CallbackQueryHandler(handle_faq_videos, pattern="^faq_videos$"))
+    app.add_handler(CommandHandler("start", instrumented("start", start)))
+    app.add_handler(CommandHandler("code", instrumented("code", show_user_code)))
+    app.add_handler(CommandHandler("faq", instrumented("faq", handle_faq_command)))
+    app.add_handler(CommandHandler(["langue", "language"], instrumented("langue", handle_language_command)))
+    app.add_handler(CommandHandler("diffusion", instrumented("diffusion", handle_broadcast_command)))
 
-    # Email entry
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Menu buttons (see CALLBACK_ROUTES) — chronométrés par clé dans route_callback
+    app.add_handler(CallbackQueryHandler(route_callback))
 
-# ─── Entry Point for Render ───────────────────────
-if __name__ == "__main__":
-    from dotenv import load_dotenv
-    import os
+    # Email entry
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented("message", handle_message)))
 
-    load_dotenv()
-    TOKEN = os.getenv("TELEGRAM_TOKEN")
+# ─── Webhook Server (Render) ──────────────────────
+# Serveur tornado maison plutôt que app.run_webhook() : on garde la main sur les routes,
+# ce qui permet de répondre au health check « / » déclaré dans render.yaml.
 
-    app = ApplicationBuilder().token(TOKEN).build()
-    setup_handlers(app)
+class HealthCheckHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("OK")
 
-    # 🚫 DO NOT wrap in asyncio.run(...)
-    app.run_polling()  # ⬅️ Direct call, no 'await'
+    def head(self):
+        self.set_status(200)
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        token = os.getenv("METRICS_TOKEN")
+        authorization = self.request.headers.get("Authorization", "")
+        if token and not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+            raise tornado.web.HTTPError(401)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render(read_worker_metrics() if BOT_WORKERS > 1 and WORKER_INDEX is None else ()))
 
 
+# API de validation des codes pour le checkout du site (et tout autre service interne) :
+#   GET  /codes/<code>        -> {"code", "valid", "reason"?, "expires_at"?, "discount_percent"?}
+#   POST /codes/validate      {"codes": [...]} -> {"results": [...]} (CODES_API_MAX_BATCH max)
+# Authentification par l'en-tête X-Api-Key (CODES_API_KEY) ; sans clé configurée, les routes
+# ne sont pas exposées. La réponse ne contient jamais l'id Telegram du titulaire.
+# Chaque code est résolu par code_index (une lecture de dict puis une du store).
 
+CODES_API_KEY = os.getenv("CODES_API_KEY")
+CODES_API_MAX_BATCH = int(os.getenv("CODES_API_MAX_BATCH", "500"))
+metrics.describe("bot_code_validations_total", "counter", "Codes vérifiés par l'API, par résultat")
 
 
+def validate_code(code, now=None):
+    code = unicodedata.normalize("NFC", code.strip().upper())  # Préfixes accentués (INITIÉ, ÉCLAT…)
+    found = code_index.lookup(code)
+    if found is None:
+        result = {"code": code, "valid": False, "reason": "unknown"}
+    elif is_expired(found[1], now):
+        result = {"code": code, "valid": False, "reason": "expired", "expires_at": entry_expires_at(found[1])}
+    else:
+        result = {"code": code, "valid": True, "expires_at": entry_expires_at(found[1]), "discount_percent": DISCOUNT_PERCENT}
+    metrics.inc("bot_code_validations_total", (("result", result.get("reason", "valid")),))
+    return result
+
+
+class CodesApiHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        # En octets : compare_digest refuse les chaînes non ASCII (en-tête forgé -> 500)
+        if not hmac.compare_digest(self.request.headers.get("X-Api-Key", "").encode(), (CODES_API_KEY or "").encode()):
+            raise tornado.web.HTTPError(401)
+        if not remises_store.loaded:
+            # Démarrage : remises.json pas encore lu, un code valide serait annoncé inconnu
+            self.set_header("Retry-After", "1")
+            raise tornado.web.HTTPError(503)
+
+
+class CodeHandler(CodesApiHandler):
+    def get(self, code):
+        result = validate_code(code)
+        if result.get("reason") == "unknown":
+            self.set_status(404)
+        self.write(result)
+
+
+class CodeBatchHandler(CodesApiHandler):
+    def post(self):
+        try:
+            codes = json.loads(self.request.body)["codes"]
+        except (ValueError, KeyError, TypeError):
+            raise tornado.web.HTTPError(400)
+        if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+            raise tornado.web.HTTPError(400)
+        if len(codes) > CODES_API_MAX_BATCH:
+            raise tornado.web.HTTPError(413)
+        now = time.time()
+        self.write({"results": [validate_code(code, now) for code in codes]})
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, dispatch, secret_token):
+        self.dispatch = dispatch
+        self.secret_token = secret_token
+
+    async def post(self):
+        header = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(header.encode(), self.secret_token.encode()):
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        # On rend la main à Telegram tout de suite, le traitement se fait dans l'Application
+        # (ou dans un worker, en multi-worker)
+        await self.dispatch(data)
+
+
+def make_web_app(dispatch, webhook_path, secret_token):
+    routes = [
+        (r"/", HealthCheckHandler),
+        (r"/metrics", MetricsHandler),
+        (rf"/{webhook_path}", TelegramWebhookHandler, {"dispatch": dispatch, "secret_token": secret_token}),
+    ]
+    if CODES_API_KEY:
+        routes += [
+            (r"/codes/validate", CodeBatchHandler),
+            (r"/codes/([^/]+)", CodeHandler),
+        ]
+    return tornado.web.Application(routes)
+
+
+def webhook_settings(token):
+    webhook_path = os.getenv("WEBHOOK_PATH", "telegram")
+    # Le secret par défaut est dérivé du token : Telegram le renvoie dans chaque requête
+    secret_token = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(token.encode()).hexdigest()[:32]
+    return webhook_path, secret_token
+
+
+def enqueue_updates(app):
+    # dispatch du webhook en mode un seul processus : la mise à jour entre dans la file de
+    # l'Application, admission anti-flood comprise (ThrottledQueue)
+    async def enqueue(data):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    return enqueue
+
+
+def stop_on_signals():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows : Ctrl+C lève KeyboardInterrupt à la place
+    return stop_event
+
+
+async def run_webhook(app, webhook_url, port):
+    webhook_path, secret_token = webhook_settings(app.bot.token)
+
+    # Le port est ouvert avant tout le reste : le health check de Render répond tout de suite
+    # et les mises à jour reçues pendant le démarrage attendent dans app.update_queue
+    server = make_web_app(enqueue_updates(app), webhook_path, secret_token).listen(port)
+    logging.info("Webhook server listening on port %s", port)
+    stop_event = stop_on_signals()
+
+    try:
+        await load_stores()  # Avant app.start() : aucun handler ne voit un store pas encore lu
+        async with app:
+            await app.start()
+            if app.post_init:
+                await app.post_init(app)
+            await app.bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}/{webhook_path}",
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await stop_event.wait()
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+    finally:
+        server.stop()
+
+
+# ─── Multi-Worker Mode ────────────────────────────
+# BOT_WORKERS > 1 (webhook uniquement) : ce processus ne fait que recevoir le webhook et
+# pousser chaque mise à jour dans la file du worker n° user_id % BOT_WORKERS. Un utilisateur
+# est donc toujours servi par le même worker, qui traite ses mises à jour une par une dans
+# l'ordre d'arrivée, tandis que les utilisateurs différents avancent en parallèle.
+# Les workers sont des processus « spawn » qui réimportent ce module avec BOT_WORKER_INDEX.
+
+# /metrics est servi par le processus frontal : chaque worker y publie ses propres séries
+# (label worker="N") en écrivant toutes les WORKER_METRICS_INTERVAL secondes un instantané
+# dans metrics.wN.json, que le frontal fusionne avec les siennes à chaque scrape.
+
+WORKER_CHECK_INTERVAL = 5
+WORKER_METRICS_FILE = "metrics.json"
+WORKER_METRICS_INTERVAL = float(os.getenv("WORKER_METRICS_INTERVAL", "5"))
+
+
+def write_worker_metrics(samples):
+    path = worker_path(WORKER_METRICS_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(samples, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+async def export_worker_metrics():
+    loop = asyncio.get_running_loop()
+    labels = (("worker", str(WORKER_INDEX)),)
+    while True:
+        # Séries lues sur la boucle (cohérentes), fichier écrit par le thread disque
+        await loop.run_in_executor(STORAGE_EXECUTOR, write_worker_metrics, metrics.samples(labels))
+        await asyncio.sleep(WORKER_METRICS_INTERVAL)
+
+
+def worker_metrics_files():
+    root, ext = os.path.splitext(WORKER_METRICS_FILE)
+    return sorted(glob.glob(f"{glob.escape(root)}.w*{ext}"))
+
+
+def read_worker_metrics():
+    snapshots = []
+    for path in worker_metrics_files():
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            logging.warning("Unreadable worker metrics %s", path)
+    return snapshots
+
+
+def update_user_id(data):
+    # Sans construire l'objet Update : l'expéditeur du premier champ qui en a un
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+class UserOrderedDispatcher:
+    def __init__(self, app, max_concurrent):
+        self.app = app
+        self._limit = asyncio.Semaphore(max_concurrent)
+        self._tails = {}  # user_id -> dernière tâche de cet utilisateur
+
+    def submit(self, update):
+        key = update.effective_user.id if update.effective_user else None
+        if not flood_guard.admit_update(update):
+            return
+        task = asyncio.create_task(self._process(self._tails.get(key), update))
+        self._tails[key] = task
+        task.add_done_callback(lambda _: self._release(key, task))
+
+    def _release(self, key, task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _process(self, previous, update):
+        # Attend la mise à jour précédente du même utilisateur avant de prendre une place
+        if previous is not None:
+            await asyncio.wait((previous,))
+        async with self._limit:
+            await self.app.process_update(update)
+
+    async def drain(self):
+        if self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+def run_worker(queue):
+    # SIGINT/SIGTERM sont gérés par le processus frontal, qui envoie None à chaque worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_logging()
+    app = build_application(os.getenv("TELEGRAM_TOKEN"))
+    asyncio.run(serve_worker(app, queue))
+
+
+async def serve_worker(app, queue):
+    loop = asyncio.get_running_loop()
+    dispatcher = UserOrderedDispatcher(app, MAX_CONCURRENT_UPDATES)
+    async with app:
+        await app.start()
+        if app.post_init:
+            await app.post_init(app)
+        logging.info("Worker %s ready", WORKER_INDEX)
+        exporter = asyncio.create_task(export_worker_metrics())
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            dispatcher.submit(Update.de_json(data, app.bot))
+        await dispatcher.drain()
+        exporter.cancel()
+        write_worker_metrics(metrics.samples((("worker", str(WORKER_INDEX)),)))
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
+class WorkerPool:
+    def __init__(self, count):
+        import multiprocessing  # Seulement pour le processus frontal multi-worker
+
+        context = multiprocessing.get_context("spawn")
+        for path in worker_metrics_files():
+            os.remove(path)  # Instantanés d'un lancement précédent (autre nombre de workers)
+        self.queues = [context.Queue() for _ in range(count)]
+        self.processes = []
+        for index, queue in enumerate(self.queues):
+            # Lu à l'import du module par le worker (environnement copié au démarrage)
+            os.environ["BOT_WORKER_INDEX"] = str(index)
+            process = context.Process(target=run_worker, args=(queue,), name=f"bot-worker-{index}")
+            process.start()
+            self.processes.append(process)
+        del os.environ["BOT_WORKER_INDEX"]
+
+    async def dispatch(self, data):
+        user_id = update_user_id(data)
+        self.queues[0 if user_id is None else user_id % len(self.queues)].put(data)
+
+    def alive(self):
+        return all(process.is_alive() for process in self.processes)
+
+    def stop(self, timeout=30):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning("Worker %s did not stop in %ss, terminating", process.name, timeout)
+                process.terminate()
+
+
+async def run_front(token, webhook_url, port):
+    webhook_path, secret_token = webhook_settings(token)
+    workers = WorkerPool(BOT_WORKERS)
+    server = make_web_app(workers.dispatch, webhook_path, secret_token).listen(port)
+    logging.info("Webhook server listening on port %s, %d workers", port, BOT_WORKERS)
+    stop_event = stop_on_signals()
+
+    try:
+        async with Bot(token) as bot:
+            await bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}/{webhook_path}",
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        # Un worker mort perdrait ses utilisateurs : on s'arrête pour que Render relance le service
+        while workers.alive():
+            try:
+                await asyncio.wait_for(stop_event.wait(), WORKER_CHECK_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                pass
+        else:
+            logging.error("A worker process died, shutting down")
+    finally:
+        server.stop()
+        await asyncio.get_running_loop().run_in_executor(None, workers.stop)
+
+
+# ─── Application Lifecycle ────────────────────────
+# Sous-systèmes de fond démarrés/arrêtés avec l'Application (polling comme webhook).
+# En webhook, on_startup tourne après app.start() : le bot répond déjà pendant qu'ils démarrent.
+# Les index sont construits par SubsystemWarmUp, en tâche de fond : on_startup ne les attend pas.
+
+class SubsystemWarmUp:
+    def __init__(self, subsystems):
+        self.subsystems = subsystems
+        self._task = None
+        self.duration = None  # Secondes entre start() et le dernier index prêt
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        started = time.perf_counter()
+        for subsystem in self.subsystems:
+            for _ in subsystem.warming():
+                await asyncio.sleep(0)  # Fin de tranche : les handlers en attente passent
+        self.duration = time.perf_counter() - started
+        logging.info("Subsystems warmed up in %.2fs", self.duration)
+
+    async def wait(self):
+        if self._task is not None:
+            await self._task
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+subsystem_warm_up = SubsystemWarmUp([code_pool, code_index, expiry_index, page_search])
+metrics.gauge("bot_warm_up_seconds", "Durée de construction des index au démarrage (0 : en cours)", lambda: subsystem_warm_up.duration or 0)
+
+
+async def on_startup(app):
+    await load_stores()  # Déjà fait par run_webhook ; en polling, avant app.start()
+    subsystem_warm_up.start()
+    if coupon_sync is not None:
+        await coupon_sync.start()
+    if book_catalog is not None:
+        await book_catalog.start()
+    broadcaster.start(app.bot)
+    if analytics is not None:
+        analytics.start()
+    if app.job_queue is not None:
+        app.job_queue.run_repeating(sweep_discount_codes, interval=EXPIRY_SWEEP_INTERVAL, first=60, name="expiry-sweep")
+    else:
+        logging.warning("JobQueue unavailable (python-telegram-bot[job-queue]), discount codes will not expire")
+
+
+async def on_stop(app):
+    # Avant app.shutdown() : les campagnes en cours s'arrêtent pendant que le bot est encore ouvert
+    await broadcaster.stop()
+
+
+async def on_shutdown(app):
+    await subsystem_warm_up.stop()
+    if coupon_sync is not None:
+        await coupon_sync.stop()
+    if book_catalog is not None:
+        await book_catalog.stop()
+    if analytics is not None:
+        await analytics.stop()
+    await remises_store.flush()
+    await issued_codes.flush()
+    await subscribers_store.flush()
+    if user_states.backend is not None:
+        await user_states.backend.flush()
+    await user_languages.flush()
+
+
+# Nombre max de mises à jour traitées en parallèle (un utilisateur lent ne bloque plus les autres)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+# Serveur Bot API local (telegram-bot-api) ou bouchon de bench.py ; défaut : api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+
+def build_application(token, request=None):
+    # request : couche HTTP de remplacement (bench.py), getUpdates compris, sinon l'API
+    # Telegram instrumentée
+    builder = (
+        ApplicationBuilder()
+        .application_class(ThrottledApplication)
+        .update_queue(ThrottledQueue())
+        .token(token)
+        .request(request or InstrumentedRequest(connection_pool_size=MAX_CONCURRENT_UPDATES * 2))
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_API_URL.rstrip('/')}/file/bot")
+    app = builder.build()
+    setup_handlers(app)
+    return app
 
 
+# ─── Entry Point for Render ───────────────────────
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seshat Telegram bot (sans argument : lance le bot)")
+    commands = parser.add_subparsers(dest="command")
+    links_parser = commands.add_parser("deeplinks", help="Génère des liens /start signés vers des pages (CSV)")
+    links_parser.add_argument("--source", required=True, help="Source enregistrée à l'arrivée, ex. tiktok")
+    links_parser.add_argument("--username", default=os.getenv("BOT_USERNAME"), help="Nom du bot pour les liens t.me")
+    links_parser.add_argument("pages", nargs="*", help="Pages de pages.json (défaut : toutes)")
+    args = parser.parse_args()
+    if args.command == "deeplinks":
+        sys.exit(write_deep_links(args.source, args.pages or list(catalog.pages), args.username))
+    setup_logging()
 
+    TOKEN = os.getenv("TELEGRAM_TOKEN")
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+    PORT = int(os.getenv("PORT", "8443"))
+
+    if WEBHOOK_URL and BOT_WORKERS > 1:
+        # Mode production multi-processus : ce processus répartit, les workers traitent
+        asyncio.run(run_front(TOKEN, WEBHOOK_URL, PORT))
+    elif WEBHOOK_URL:
+        # Mode production (Render) : Telegram pousse les mises à jour sur notre serveur
+        asyncio.run(run_webhook(build_application(TOKEN), WEBHOOK_URL, PORT))
+    else:
+        if BOT_WORKERS > 1:
+            logging.warning("BOT_WORKERS is only used in webhook mode, polling runs a single process")
+        app = build_application(TOKEN)
+        # Mode local : long polling
+        # 🚫 DO NOT wrap in asyncio.run(...)
+        app.run_polling()  # ⬅️ Direct call, no 'await'
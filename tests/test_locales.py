@@ -0,0 +1,62 @@
+# Les traductions livrées (locales/*.json) doivent couvrir exactement les pages de pages.json :
+# le catalogue refuse de démarrer sinon. Compilées ici comme au lancement du bot.
+
+import copy
+import json
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    # bot ouvre ses fichiers (remises.json…) dans le dossier courant dès l'import
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp("bot"))
+        patch.setenv("SUPABASE_URL", "")
+        patch.setenv("NEXT_PUBLIC_SUPABASE_URL", "")
+        patch.syspath_prepend(ROOT)
+        import bot
+        yield bot
+
+
+@pytest.fixture(scope="module")
+def sources(bot):
+    with open(bot.PAGES_FILE, encoding="utf-8") as f:
+        raw = json.load(f)
+    translations = {}
+    for name in sorted(os.listdir(bot.LOCALES_DIR)):
+        if name.endswith(".json"):
+            with open(os.path.join(bot.LOCALES_DIR, name), encoding="utf-8") as f:
+                translations[os.path.splitext(name)[0]] = json.load(f)
+    return raw, translations
+
+
+def test_shipped_locales_cover_every_page(bot, sources):
+    raw, translations = sources
+    bundles = bot.compile_locales(raw, translations, bot.CALLBACK_ROUTES)
+    assert set(bundles) == {bot.DEFAULT_LOCALE, *translations}
+    for locale, bundle in bundles.items():
+        assert set(bundle.pages) == set(raw["pages"]), locale
+        assert set(bundle.messages) == set(raw["messages"]), locale
+
+
+def test_missing_page_translation_is_rejected(bot, sources):
+    raw, translations = sources
+    for locale in translations:
+        broken = copy.deepcopy(translations)
+        page_id = next(iter(broken[locale]["pages"]))
+        del broken[locale]["pages"][page_id]
+        with pytest.raises(bot.CatalogError, match=page_id):
+            bot.compile_locales(raw, broken, bot.CALLBACK_ROUTES)
+
+
+def test_unknown_page_translation_is_rejected(bot, sources):
+    raw, translations = sources
+    broken = copy.deepcopy(translations)
+    locale = next(iter(broken))
+    broken[locale]["pages"]["fr_Inexistante"] = {"title": "?"}
+    with pytest.raises(bot.CatalogError, match="fr_Inexistante"):
+        bot.compile_locales(raw, broken, bot.CALLBACK_ROUTES)